@@ -1,64 +1,103 @@
+import asyncio
+import json
 import os
 import re
+from datetime import datetime
 from hashlib import md5
-from tkinter import N
 
 import structlog
-from aiocache import cached
-from aiohttp import ClientSession
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
 
+from api.images import ImageStore
 from db import MongoDB
 from templates import Template
+from throttle import TokenBucket
 
-from .error import AiUtilsError
+from .cache import TitleCache
+from .error import AiRateLimitError
+from .provider import ChatProvider, get_provider
+from .token import AccessTokenProvider
 
 logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
 
+# 批量生成标题的提示词，每个任务是按模板渲染后的单个提示词
+BATCH_PROMPT = """下面有{count}个相互独立的任务，每个任务要求写一个商品标题。
+请分别完成每个任务，只输出一个JSON数组，不要输出其它任何内容。
+数组中每个元素的格式为{{"id": 任务编号, "title": "标题"}}，共{count}个元素。
+
+{tasks}
+"""
+
 
 class AIUtils:
     """
     AI工具类，用于处理与人工智能相关的操作，主要与百度AI服务交互。
     """
 
-    @cached(ttl=60 * 10)
+    # 对话服务，首次使用时创建
+    _provider: ChatProvider | None = None
+
     @staticmethod
-    async def _get_access_token():
+    def provider() -> ChatProvider:
         """
-        从百度OAuth服务获取访问令牌。
+        获取对话服务，由AI_PROVIDER等环境变量配置。
 
-        令牌会被缓存10分钟，以避免频繁API调用。
+        MongoDB已初始化且BAIDU_TOKEN_SHARED不为"false"时，百度访问令牌通过数据库在多个进程间共用。
 
         返回:
-            str: 百度AI API的访问令牌
+            ChatProvider: 对话服务
+        """
+        if AIUtils._provider is None:
+            shared = os.getenv("BAIDU_TOKEN_SHARED", "true").lower() != "false"
+            tokens = AccessTokenProvider(
+                MongoDB.get_db() if shared and MongoDB._instance else None
+            )
+            AIUtils._provider = get_provider(tokens)
+        return AIUtils._provider
 
-        异常:
-            AiUtilsError: 如果令牌获取失败
-        """
-        url = "https://aip.baidubce.com/oauth/2.0/token"
-        # 设置请求参数
-        params = {
-            "grant_type": "client_credentials",
-            "client_id": os.getenv("BAIDU_API_KEY"),
-            "client_secret": os.getenv("BAIDU_SECRET_KEY"),
-        }
-        async with ClientSession() as session:
-            async with session.post(url, params=params) as response:
-                data = await response.json()
-
-                token = data.get("access_token")
-                # 检查是否成功获取令牌
-                if token is None:
-                    raise AiUtilsError(
-                        response.status,
-                        "无法从百度OAuth服务获取访问令牌",
-                    )
+    @staticmethod
+    def model_ids() -> list[str]:
+        """
+        获取可能作答的所有模型标识，用于查找不同模型生成的标题缓存。
 
-                return token
+        返回:
+            list[str]: 主服务在前、备用服务在后的模型标识，百度服务优先使用BAIDU_MODEL，
+                否则使用BAIDU_API_URL
+        """
+        return AIUtils.provider().models
 
     @staticmethod
-    async def generate_title(
+    async def render_prompt(
         title: str, description: str, price: float, *, template_text: str | None = None
+    ) -> str:
+        """
+        使用模板渲染生成标题的提示词。
+
+        参数:
+            title (str): 原始产品标题/名称
+            description (str): 产品描述文本
+            price (float): 产品价格
+            template_text (str, optional): 自定义模板字符串，如果为None，则从数据库获取模板
+
+        返回:
+            str: 渲染后的提示词
+        """
+        if template_text is None:
+            template = Template(MongoDB.get_db())
+            template_text = await template.get("prompt")
+
+        return template_text.format(title=title, description=description, price=price)
+
+    @staticmethod
+    async def generate_title(
+        title: str,
+        description: str,
+        price: float,
+        *,
+        template_text: str | None = None,
+        cache: TitleCache | None = None,
+        limiter: TokenBucket | None = None,
     ):
         """
         使用百度AI服务生成优化的产品标题。
@@ -68,124 +107,477 @@ class AIUtils:
             description (str): 产品描述文本
             price (float): 产品价格
             template_text (str, optional): 自定义模板字符串，如果为None，则从数据库获取模板
+            cache (TitleCache, optional): 标题缓存，提示词相同时直接返回缓存的标题
+            limiter (TokenBucket, optional): 限流器，只在实际调用AI服务前获取令牌
 
         返回:
             str: AI生成的优化产品标题
-        """
-        # 获取百度API的授权令牌
-        token = await AIUtils._get_access_token()
-        url = os.getenv("BAIDU_API_URL") + token
 
+        异常:
+            AiRateLimitError: AI服务返回限流错误
+            AiUtilsError: AI服务返回其它错误
+        """
         # 准备提示模板
+        prompt = await AIUtils.render_prompt(
+            title, description, price, template_text=template_text
+        )
+
+        models = AIUtils.model_ids()
+        if cache is not None and (cached_title := await cache.get(prompt, models)):
+            logger.debug("Title cache hit", title=cached_title)
+            return cached_title
+
+        result, answered_by = await AIUtils._chat(prompt, limiter=limiter)
+        if cache is not None:
+            await cache.put(prompt, answered_by, result)
+
+        return result
+
+    @staticmethod
+    async def generate_titles(
+        products: list[dict],
+        *,
+        template_text: str | None = None,
+        cache: TitleCache | None = None,
+        limiter: TokenBucket | None = None,
+    ) -> list[str | None]:
+        """
+        在一次请求中为多个产品生成标题。
+
+        多个产品的提示词被打包为一个要求以JSON数组回答的提示词，解析失败或缺失的条目
+        回退为逐个生成。缓存以单个产品的提示词为键，与generate_title共用。
+
+        参数:
+            products (list[dict]): 产品列表，每项包含title、description和price
+            template_text (str, optional): 自定义模板字符串，如果为None，则从数据库获取模板
+            cache (TitleCache, optional): 标题缓存
+            limiter (TokenBucket, optional): 限流器，只在实际调用AI服务前获取令牌
+
+        返回:
+            list[str | None]: 与products顺序一致的标题列表，生成失败的条目为None
+
+        异常:
+            AiRateLimitError: 批量请求被限流
+        """
         if template_text is None:
             template = Template(MongoDB.get_db())
-            prompt = await template.get("prompt")
-            prompt = prompt.format(title=title, description=description, price=price)
-        else:
-            prompt = template_text.format(
-                title=title, description=description, price=price
+            template_text = await template.get("prompt")
+
+        models = AIUtils.model_ids()
+        prompts = [
+            await AIUtils.render_prompt(
+                product["title"],
+                product["description"],
+                product["price"],
+                template_text=template_text,
+            )
+            for product in products
+        ]
+        titles: list[str | None] = [None] * len(prompts)
+
+        if cache is not None:
+            for i, prompt in enumerate(prompts):
+                titles[i] = await cache.get(prompt, models)
+
+        missing = [i for i, title in enumerate(titles) if title is None]
+        if len(missing) > 1:
+            batch_prompt = BATCH_PROMPT.format(
+                count=len(missing),
+                tasks="\n\n".join(
+                    f"### 任务{n}\n{prompts[i]}" for n, i in enumerate(missing, 1)
+                ),
             )
+            try:
+                answer, answered_by = await AIUtils._chat(batch_prompt, limiter=limiter)
+            except AiRateLimitError:
+                raise
+            except Exception as e:
+                # 批量请求失败（超时、服务错误等）时逐个生成
+                logger.warn("Batch title generation failed", error=str(e))
+                answer, answered_by = "", models[0]
+            answers = AIUtils._parse_batch(answer, len(missing)) if answer else {}
+            for n, i in enumerate(missing, 1):
+                if title := answers.get(n):
+                    titles[i] = title
+                    if cache is not None:
+                        await cache.put(prompts[i], answered_by, title)
+
+            logger.info(
+                "Batch titles generated", requested=len(missing), parsed=len(answers)
+            )
+
+        # 批量结果中缺失的条目逐个生成
+        for i, title in enumerate(titles):
+            if title is not None:
+                continue
+
+            try:
+                titles[i], answered_by = await AIUtils._chat(prompts[i], limiter=limiter)
+            except AiRateLimitError:
+                raise
+            except Exception as e:
+                logger.warn("生成标题失败", error=str(e))
+                continue
+
+            if cache is not None:
+                await cache.put(prompts[i], answered_by, titles[i])
+
+        return titles
+
+    @staticmethod
+    def _parse_batch(answer: str, count: int) -> dict[int, str]:
+        """
+        解析批量生成的回答。
+
+        参数:
+            answer (str): AI服务的回答，应包含形如[{"id": 1, "title": "..."}]的JSON数组
+            count (int): 任务数量
+
+        返回:
+            dict[int, str]: 任务序号（从1开始）到标题的映射，只包含校验通过的条目
+        """
+        match = re.search(r"\[.*\]", answer, re.S)
+        if match is None:
+            logger.warn("Batch answer contains no JSON array")
+            return {}
+
+        try:
+            entries = json.loads(match.group())
+        except json.JSONDecodeError as e:
+            logger.warn("Failed to parse batch answer", error=str(e))
+            return {}
+
+        titles = {}
+        for entry in entries if isinstance(entries, list) else []:
+            if not isinstance(entry, dict):
+                continue
 
-        data = {"messages": [{"role": "user", "content": prompt}]}
+            n, title = entry.get("id"), entry.get("title")
+            if (
+                isinstance(n, int)
+                and 1 <= n <= count
+                and isinstance(title, str)
+                and title.strip()
+            ):
+                titles[n] = title.strip()
 
-        # 调用百度AI服务生成标题
-        async with ClientSession() as session:
-            async with session.post(url, json=data) as response:
-                data = await response.json()
+        return titles
 
-                return data["result"]
+    @staticmethod
+    async def _chat(
+        prompt: str, *, limiter: TokenBucket | None = None
+    ) -> tuple[str, str]:
+        """
+        调用对话服务完成一次对话，受AI_TIMEOUT截止时间限制，配置了备用服务时可能发出对冲请求。
+
+        参数:
+            prompt (str): 提示词
+            limiter (TokenBucket, optional): 限流器
+
+        返回:
+            tuple[str, str]: AI服务的回答和作答模型的标识，备用服务作答时标题按备用服务的模型缓存
+
+        异常:
+            AiRateLimitError: AI服务返回限流错误
+            AiTimeoutError: 请求超过截止时间
+            AiUtilsError: AI服务返回其它错误
+        """
+        if limiter is not None:
+            await limiter.acquire()
+
+        return await AIUtils.provider().answer(prompt)
 
 
 class GoodsManager:
     """
     商品管理类，负责商品数据的聚合与处理。
     """
-    def __init__(self, db: AsyncIOMotorDatabase) -> None:
+
+    # 被限流时的最大重试次数
+    RATE_LIMIT_RETRIES = 3
+
+    def __init__(self, db: AsyncIOMotorDatabase, *, batch_size: int = 100) -> None:
         """
         初始化方法。
 
         参数:
             db (AsyncIOMotorDatabase): MongoDB数据库实例
+            batch_size (int, optional): 聚合游标每批返回的分组数
         """
         self._db = db
-
-    async def merge_all(self, *, template: str | None = None):
+        self._batch_size = batch_size
+        self._images = ImageStore(db)
+        self._titles = TitleCache(db)
+
+    async def merge_all(
+        self,
+        *,
+        template: str | None = None,
+        full: bool = False,
+        concurrency: int = 1,
+        limiter: TokenBucket | None = None,
+        title_batch_size: int = 1,
+    ):
         """
-        聚合所有商品数据，并生成优化后的商品信息。
+        聚合商品数据，并生成优化后的商品信息。
+
+        只重新处理爬虫标记为待合并的分组（goods_dirty集合），未变化的商品保留原有标题。
+        标题由多个工作协程并发生成，结果按分组顺序写回items集合。
 
         参数:
             template (str, optional): 自定义AI提示模板
+            full (bool, optional): 是否忽略待合并标记，重新处理所有分组
+            concurrency (int, optional): 并发生成标题的工作协程数
+            limiter (TokenBucket, optional): 调用AI服务的限流器
+            title_batch_size (int, optional): 每次请求生成标题的分组数，大于1时使用批量提示词
 
         返回:
             None
         """
+        started = datetime.now()
+        dirty = [group["_id"] async for group in self._db.goods_dirty.find()]
+        if not full and not dirty:
+            logger.info("No dirty groups, skip merging")
+            return
+
+        logger.info("Merging goods", groups="all" if full else len(dirty))
+        concurrency = max(1, concurrency)
+        title_batch_size = max(1, title_batch_size)
+        failed = []
+        writer = _OrderedBulkWriter(self._db.items, batch_size=self._batch_size)
+        queue: asyncio.Queue[list[tuple[int, dict]] | None] = asyncio.Queue(
+            maxsize=concurrency * 2
+        )
+
+        # 只投影合并所需的字段，分组首个商品的字段在排序后用$first获取，避免推入整个文档
         pipeline = [
+            {"$match": {} if full else {"subName": {"$in": dirty}}},
+            {"$sort": {"subName": 1, "productId": 1}},
             {
                 "$group": {
                     "_id": "$subName",
                     "count": {"$sum": 1},
                     "price": {"$min": "$price"},
-                    "items": {"$push": "$$ROOT"},
+                    "imgList": {"$first": "$imgList"},
+                    "copywriterInfo": {
+                        "$first": {"$arrayElemAt": ["$copywriterInfo.copywriter", 0]}
+                    },
+                    "endSaleTimeDesc": {"$first": "$endSaleTimeDesc"},
+                    "items": {
+                        "$push": {
+                            "productId": "$productId",
+                            "productName": "$productName",
+                        }
+                    },
                 }
-            }
+            },
+        ]
+
+        async def produce():
+            # 遍历聚合后的商品分组，每title_batch_size个分组作为一批
+            index = 0
+            batch = []
+            try:
+                async for group in self._db.goods.aggregate(
+                    pipeline, allowDiskUse=True, batchSize=self._batch_size
+                ):
+                    batch.append((index, group))
+                    index += 1
+                    if len(batch) == title_batch_size:
+                        await queue.put(batch)
+                        batch = []
+
+                if batch:
+                    await queue.put(batch)
+            finally:
+                for _ in range(concurrency):
+                    await queue.put(None)
+
+        async def work():
+            while (batch := await queue.get()) is not None:
+                items = {}
+                for index, group in batch:
+                    try:
+                        items[index] = await self._build_item(group)
+                    except Exception as e:
+                        logger.warn(f"处理商品分组失败，原因：{e}", subName=group["_id"])
+
+                try:
+                    # 调用AI生成商品标题
+                    titles = await self._generate_titles(
+                        list(items.values()), template, limiter
+                    )
+                except Exception as e:
+                    logger.warn(f"生成标题失败，原因：{e}")
+                    titles = [None] * len(items)
+
+                titles = dict(zip(items.keys(), titles))
+                for index, group in batch:
+                    item = items.get(index)
+                    if item is None or not (title := titles.get(index)):
+                        failed.append(group["_id"])
+                        await writer.put(index, None)
+                        continue
+
+                    item["title"] = title
+                    logger.info(f"为商品{item['productId']}生成标题：{title}")
+
+                    # 更新或插入商品信息到items集合
+                    await writer.put(
+                        index,
+                        UpdateOne(
+                            {"productId": item.pop("productId")},
+                            {"$set": item},
+                            upsert=True,
+                        ),
+                    )
+
+        await asyncio.gather(produce(), *(work() for _ in range(concurrency)))
+        await writer.flush()
+
+        # 清除已处理分组的待合并标记，生成失败或合并期间再次变化的分组保留标记
+        await self._db.goods_dirty.delete_many(
+            {"_id": {"$nin": failed}, "markedAt": {"$lte": started}}
+        )
+
+    async def _build_item(self, group: dict) -> dict:
+        """
+        根据聚合分组构建商品信息（不含标题）。
+
+        参数:
+            group (dict): 聚合后的商品分组
+
+        返回:
+            dict: 商品信息
+        """
+        # 获取原始商品ID列表，并排序
+        originalProductId = sorted([item["productId"] for item in group["items"]])
+
+        # 生成唯一的商品ID
+        productId = md5("".join(originalProductId).encode("utf-8")).hexdigest()
+        # 处理图片列表，将URL文件名解析为内容哈希并去重
+        imgList = await self._images.resolve(
+            [ImageStore.alias_of(image) for image in group["imgList"]]
+        )
+
+        # 构建短链接描述信息列表，短链接因用户而异，使用时按productId从short_urls集合获取
+        shortUrls = [
+            {"productId": item["productId"], "description": item["productName"]}
+            for item in group["items"]
         ]
+        # 获取商品文案信息，并去除'-'字符
+        copywriterInfo = group["copywriterInfo"].replace("-", "")
+
+        # 获取商品结束销售时间，并提取日期
+        endSaleTimeDesc = re.search(r"\d{4}-\d{2}-\d{2}", group["endSaleTimeDesc"])
+        assert endSaleTimeDesc is not None
+
+        return {
+            "productId": productId,
+            "originalProductId": originalProductId,
+            "imgList": imgList,
+            "price": group["price"],
+            "subName": group["_id"],
+            "shortUrls": shortUrls,
+            "copywriterInfo": copywriterInfo,
+            "endSaleTimeDesc": endSaleTimeDesc.group(),
+        }
+
+    async def _generate_titles(
+        self, items: list[dict], template: str | None, limiter: TokenBucket | None
+    ) -> list[str | None]:
+        """
+        为一批商品生成标题，遇到限流响应时按指数退避重试。
 
-        # 遍历聚合后的商品分组
-        async for group in self._db.goods.aggregate(pipeline):
-            # 获取原始商品ID列表，并排序
-            originalProductId = sorted([item["productId"] for item in group["items"]])
-
-            # 生成唯一的商品ID
-            productId = md5("".join(originalProductId).encode("utf-8")).hexdigest()
-            # 处理图片列表，仅保留文件名部分
-            imgList = [image.split("/")[-1] for image in group["items"][0]["imgList"]]
-            price = group["price"]
-            subName = group["_id"]
-
-            # 构建短链接及描述信息列表
-            shortUrls = [
-                {"shortUrl": item["shortUrl"], "description": item["productName"]}
-                for item in group["items"]
-            ]
-            # 获取商品文案信息，并去除'-'字符
-            copywriterInfo = group["items"][0]["copywriterInfo"][0][
-                "copywriter"
-            ].replace("-", "")
-
-            # 获取商品结束销售时间，并提取日期
-            endSaleTimeDesc = group["items"][0]["endSaleTimeDesc"]
-            endSaleTimeDesc = re.search(r"\d{4}-\d{2}-\d{2}", endSaleTimeDesc)
-            assert endSaleTimeDesc is not None
-            endSaleTimeDesc = endSaleTimeDesc.group()
+        参数:
+            items (list[dict]): 商品信息列表
+            template (str, optional): 自定义AI提示模板
+            limiter (TokenBucket, optional): 调用AI服务的限流器
 
+        返回:
+            list[str | None]: 与items顺序一致的标题列表，生成失败的条目为None
+
+        异常:
+            AiRateLimitError: 重试次数用尽后仍被限流
+        """
+        if not items:
+            return []
+
+        products = [
+            {
+                "title": item["subName"],
+                "description": item["copywriterInfo"],
+                "price": item["price"],
+            }
+            for item in items
+        ]
+        for attempt in range(self.RATE_LIMIT_RETRIES + 1):
             try:
-                # 调用AI生成商品标题
-                title = await AIUtils.generate_title(
-                    title=subName,
-                    description=copywriterInfo,
-                    price=price,
-                    template_text=template,
+                if len(products) == 1:
+                    return [
+                        await AIUtils.generate_title(
+                            **products[0],
+                            template_text=template,
+                            cache=self._titles,
+                            limiter=limiter,
+                        )
+                    ]
+
+                return await AIUtils.generate_titles(
+                    products, template_text=template, cache=self._titles, limiter=limiter
                 )
-            except Exception as e:
-                logger.warn(f"生成标题失败，原因：{e}")
-                continue
+            except AiRateLimitError as e:
+                if attempt == self.RATE_LIMIT_RETRIES:
+                    raise
 
-            logger.info(f"为商品{productId}生成标题：{title}")
-
-            # 更新或插入商品信息到items集合
-            await self._db.items.update_one(
-                {"productId": productId},
-                {
-                    "$set": {
-                        "originalProductId": originalProductId,
-                        "title": title,
-                        "imgList": imgList,
-                        "price": price,
-                        "subName": subName,
-                        "shortUrls": shortUrls,
-                        "copywriterInfo": copywriterInfo,
-                        "endSaleTimeDesc": endSaleTimeDesc,
-                    }
-                },
-                upsert=True,
-            )
+                delay = 2**attempt
+                logger.info("Rate limited, retrying", delay=delay, error=str(e))
+                await asyncio.sleep(delay)
+
+        raise AssertionError("unreachable")
+
+
+class _OrderedBulkWriter:
+    """
+    按序批量写入器。
+
+    并发产生的写操作按序号缓存，只有序号连续的前缀才会按批写入，保证写入顺序与分组顺序一致。
+    """
+
+    def __init__(self, collection, *, batch_size: int = 100) -> None:
+        self._collection = collection
+        self._batch_size = batch_size
+        self._pending: dict[int, UpdateOne | None] = {}
+        self._ready: list[UpdateOne] = []
+        self._next = 0
+        self._lock = asyncio.Lock()
+
+    async def put(self, index: int, operation: UpdateOne | None):
+        """
+        提交序号为index的写操作，None表示该序号没有写操作
+
+        参数:
+            index (int): 序号
+            operation (UpdateOne | None): 写操作
+        """
+        async with self._lock:
+            self._pending[index] = operation
+            while self._next in self._pending:
+                if (operation := self._pending.pop(self._next)) is not None:
+                    self._ready.append(operation)
+                self._next += 1
+
+            if len(self._ready) >= self._batch_size:
+                await self._write()
+
+    async def flush(self):
+        """
+        写入所有已就绪的写操作
+        """
+        async with self._lock:
+            await self._write()
+
+    async def _write(self):
+        if self._ready:
+            operations, self._ready = self._ready, []
+            await self._collection.bulk_write(operations, ordered=True)
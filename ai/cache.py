@@ -0,0 +1,101 @@
+import os
+from datetime import datetime, timedelta
+from hashlib import sha256
+
+import structlog
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class TitleCache:
+    """
+    AI标题缓存。
+
+    以渲染后的完整提示词和模型标识的哈希为键保存生成的标题，提示词不变时直接复用，
+    记录在有效期后由MongoDB的TTL索引自动删除。
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase, *, ttl: timedelta | None = None) -> None:
+        """
+        初始化标题缓存
+
+        参数:
+            db (AsyncIOMotorDatabase): MongoDB数据库实例
+            ttl (timedelta, optional): 缓存有效期，默认读取AI_TITLE_CACHE_TTL（秒），未设置时为7天
+        """
+        self._db = db
+        self._ttl = ttl or timedelta(
+            seconds=int(os.getenv("AI_TITLE_CACHE_TTL", 7 * 24 * 3600))
+        )
+
+    @staticmethod
+    def key(prompt: str, model: str) -> str:
+        """
+        计算提示词指纹
+
+        参数:
+            prompt (str): 渲染后的完整提示词
+            model (str): 模型标识
+
+        返回:
+            str: 缓存键
+        """
+        return sha256(f"{model}\n{prompt}".encode("utf-8")).hexdigest()
+
+    async def get(self, prompt: str, model: str | list[str]) -> str | None:
+        """
+        获取缓存的标题
+
+        参数:
+            prompt (str): 渲染后的完整提示词
+            model (str | list[str]): 模型标识，为列表时按顺序优先返回靠前模型的标题
+
+        返回:
+            str | None: 缓存的标题，不存在或已过期时返回None
+        """
+        models = [model] if isinstance(model, str) else model
+        keys = [self.key(prompt, model) for model in models]
+        cached = {
+            entry["_id"]: entry["title"]
+            async for entry in self._db.title_cache.find(
+                {"_id": {"$in": keys}, "expiresAt": {"$gt": datetime.now()}},
+                {"title": 1},
+            )
+        }
+        return next((cached[key] for key in keys if key in cached), None)
+
+    async def put(self, prompt: str, model: str, title: str):
+        """
+        保存生成的标题
+
+        参数:
+            prompt (str): 渲染后的完整提示词
+            model (str): 模型标识
+            title (str): 生成的标题
+        """
+        now = datetime.now()
+        await self._db.title_cache.update_one(
+            {"_id": self.key(prompt, model)},
+            {
+                "$set": {
+                    "title": title,
+                    "model": model,
+                    "createdAt": now,
+                    "expiresAt": now + self._ttl,
+                }
+            },
+            upsert=True,
+        )
+
+    async def clear(self, model: str | None = None):
+        """
+        清空缓存
+
+        参数:
+            model (str, optional): 只清空指定模型的缓存，为None时清空全部
+        """
+        result = await self._db.title_cache.delete_many(
+            {} if model is None else {"model": model}
+        )
+        logger.info("Title cache cleared", model=model, count=result.deleted_count)
@@ -26,3 +26,17 @@ class AiUtilsError(Exception):
             str - 格式化的错误信息，包含状态码和错误信息
         """
         return f"AiUtilsError with status code {self.status_code}: {self.message}"
+
+
+class AiRateLimitError(AiUtilsError):
+    """
+    AI服务限流异常类
+    用于表示请求因超过服务配额被拒绝，调用方可在等待后重试
+    """
+
+
+class AiTimeoutError(AiUtilsError):
+    """
+    AI服务超时异常类
+    用于表示请求在截止时间内未完成
+    """
@@ -0,0 +1,391 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+import structlog
+from aiohttp import ClientSession, ClientTimeout
+
+from .error import AiRateLimitError, AiTimeoutError, AiUtilsError
+from .token import TOKEN_ERROR_CODES, AccessTokenProvider
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+# 百度AI服务表示请求被限流的错误码
+RATE_LIMIT_ERROR_CODES = {4, 17, 18, 336501, 336502}
+
+
+class ChatProvider:
+    """
+    对话模型服务的基类。
+
+    子类实现complete，完成一次单轮对话并返回模型的回答。
+    """
+
+    # 服务名称，用于日志
+    name = "base"
+
+    @property
+    def model(self) -> str:
+        """模型标识，用于区分不同模型生成的标题缓存"""
+        raise NotImplementedError
+
+    @property
+    def models(self) -> list[str]:
+        """可能作答的所有模型标识，主服务在前"""
+        return [self.model]
+
+    async def complete(self, prompt: str, *, timeout: float | None = None) -> str:
+        """
+        完成一次对话
+
+        参数:
+            prompt (str): 提示词
+            timeout (float, optional): 请求超时时间（秒）
+
+        返回:
+            str: 模型的回答
+
+        异常:
+            AiRateLimitError: 服务返回限流错误
+            AiUtilsError: 服务返回其它错误
+        """
+        raise NotImplementedError
+
+    async def answer(
+        self, prompt: str, *, timeout: float | None = None
+    ) -> tuple[str, str]:
+        """
+        完成一次对话，并返回实际作答的模型
+
+        参数:
+            prompt (str): 提示词
+            timeout (float, optional): 请求超时时间（秒）
+
+        返回:
+            tuple[str, str]: 模型的回答和作答模型的标识
+
+        异常:
+            AiRateLimitError: 服务返回限流错误
+            AiUtilsError: 服务返回其它错误
+        """
+        return await self.complete(prompt, timeout=timeout), self.model
+
+
+class BaiduProvider(ChatProvider):
+    """
+    百度千帆对话服务，接口地址由BAIDU_API_URL指定，访问令牌由AccessTokenProvider提供。
+    """
+
+    name = "baidu"
+
+    def __init__(self, tokens: AccessTokenProvider) -> None:
+        """
+        初始化百度对话服务
+
+        参数:
+            tokens (AccessTokenProvider): 访问令牌提供者
+        """
+        self.tokens = tokens
+
+    @property
+    def model(self) -> str:
+        return os.getenv("BAIDU_MODEL") or os.getenv("BAIDU_API_URL", "")
+
+    async def complete(self, prompt: str, *, timeout: float | None = None) -> str:
+        for attempt in range(2):
+            # 获取百度API的授权令牌
+            token = await self.tokens.get()
+            url = os.getenv("BAIDU_API_URL") + token
+
+            data = {"messages": [{"role": "user", "content": prompt}]}
+
+            async with ClientSession(timeout=ClientTimeout(total=timeout)) as session:
+                async with session.post(url, json=data) as response:
+                    if response.status == 429:
+                        raise AiRateLimitError(response.status, "请求过于频繁")
+
+                    data = await response.json()
+
+            # 令牌失效时废弃令牌并重试一次
+            if data.get("error_code") in TOKEN_ERROR_CODES and attempt == 0:
+                logger.info("Baidu access token rejected, refreshing")
+                self.tokens.invalidate(token)
+                continue
+
+            break
+
+        # 检查百度AI服务返回的错误码
+        if error_code := data.get("error_code"):
+            error_cls = (
+                AiRateLimitError if error_code in RATE_LIMIT_ERROR_CODES else AiUtilsError
+            )
+            raise error_cls(error_code, data.get("error_msg", "生成标题失败"))
+
+        return data["result"]
+
+
+class OpenAIProvider(ChatProvider):
+    """
+    OpenAI兼容的对话服务（/chat/completions接口），也可指向本地的ai.standin替身服务。
+    """
+
+    name = "openai"
+
+    def __init__(self, base_url: str, model: str, api_key: str | None = None) -> None:
+        """
+        初始化OpenAI兼容对话服务
+
+        参数:
+            base_url (str): 服务地址，如http://localhost:8001/v1
+            model (str): 模型名称
+            api_key (str, optional): API密钥
+        """
+        self._url = base_url.rstrip("/") + "/chat/completions"
+        self._model = model
+        self._api_key = api_key
+
+    @property
+    def model(self) -> str:
+        return f"openai:{self._model}"
+
+    async def complete(self, prompt: str, *, timeout: float | None = None) -> str:
+        headers = {"Authorization": f"Bearer {self._api_key}"} if self._api_key else {}
+        data = {"model": self._model, "messages": [{"role": "user", "content": prompt}]}
+
+        async with ClientSession(timeout=ClientTimeout(total=timeout)) as session:
+            async with session.post(self._url, json=data, headers=headers) as response:
+                if response.status == 429:
+                    raise AiRateLimitError(response.status, "请求过于频繁")
+
+                data = await response.json(content_type=None)
+                if response.status >= 400:
+                    error = data.get("error") or {}
+                    raise AiUtilsError(
+                        response.status, error.get("message", "生成标题失败")
+                    )
+
+        return data["choices"][0]["message"]["content"]
+
+
+class LatencyTracker:
+    """
+    记录最近若干次请求的耗时，用于计算对冲请求的等待时间。
+    """
+
+    def __init__(self, window: int = 200) -> None:
+        """
+        初始化耗时记录
+
+        参数:
+            window (int): 保留的最近记录数
+        """
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float):
+        """
+        记录一次请求耗时
+
+        参数:
+            seconds (float): 耗时（秒）
+        """
+        self._samples.append(seconds)
+
+    def percentile(self, p: float) -> float:
+        """
+        计算耗时的百分位数
+
+        参数:
+            p (float): 百分位，0-100
+
+        返回:
+            float: 耗时（秒），没有记录时返回0
+        """
+        if not self._samples:
+            return 0.0
+
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        return ordered[index]
+
+
+class HedgedProvider(ChatProvider):
+    """
+    带截止时间和对冲请求的对话服务。
+
+    每次调用受timeout限制。主服务耗时超过近期耗时的hedge_percentile百分位时，
+    向备用服务发出同样的请求，先成功的结果被采用，另一个请求被取消；
+    主服务出错时立即改用备用服务。
+    """
+
+    # 开始对冲前至少需要的耗时记录数
+    MIN_SAMPLES = 20
+
+    def __init__(
+        self,
+        primary: ChatProvider,
+        secondary: ChatProvider | None = None,
+        *,
+        timeout: float = 30,
+        hedge_percentile: float = 95,
+    ) -> None:
+        """
+        初始化对冲对话服务
+
+        参数:
+            primary (ChatProvider): 主服务
+            secondary (ChatProvider, optional): 备用服务，为None时只应用截止时间
+            timeout (float): 每次调用的截止时间（秒）
+            hedge_percentile (float): 触发对冲的耗时百分位，为0时不对冲，只在主服务出错时改用备用服务
+        """
+        self.primary = primary
+        self.secondary = secondary
+        self._timeout = timeout
+        self._hedge_percentile = hedge_percentile
+        self.latency = LatencyTracker()
+
+    @property
+    def name(self) -> str:
+        if self.secondary is None:
+            return self.primary.name
+        return f"{self.primary.name}+{self.secondary.name}"
+
+    @property
+    def model(self) -> str:
+        """主服务的模型标识，备用服务的回答通过answer返回备用服务的模型标识"""
+        return self.primary.model
+
+    @property
+    def models(self) -> list[str]:
+        if self.secondary is None:
+            return self.primary.models
+        return list(dict.fromkeys(self.primary.models + self.secondary.models))
+
+    def _hedge_delay(self) -> float | None:
+        """
+        计算发出对冲请求前的等待时间
+
+        返回:
+            float | None: 等待时间（秒），不对冲时返回None
+        """
+        if (
+            self.secondary is None
+            or not self._hedge_percentile
+            or len(self.latency) < self.MIN_SAMPLES
+        ):
+            return None
+        return self.latency.percentile(self._hedge_percentile)
+
+    async def _timed(
+        self, provider: ChatProvider, prompt: str, timeout: float
+    ) -> tuple[str, str]:
+        """
+        调用服务，主服务成功的调用计入耗时记录
+        """
+        started = time.monotonic()
+        result = await provider.answer(prompt, timeout=timeout)
+        if provider is self.primary:
+            self.latency.record(time.monotonic() - started)
+        return result
+
+    async def complete(self, prompt: str, *, timeout: float | None = None) -> str:
+        result, _ = await self.answer(prompt, timeout=timeout)
+        return result
+
+    async def answer(
+        self, prompt: str, *, timeout: float | None = None
+    ) -> tuple[str, str]:
+        timeout = timeout or self._timeout
+        deadline = time.monotonic() + timeout
+        tasks = {
+            asyncio.create_task(self._timed(self.primary, prompt, timeout)): self.primary
+        }
+        # 备用服务每次调用最多请求一次
+        secondary = self.secondary
+        hedge_delay = self._hedge_delay()
+        error: Exception | None = None
+
+        try:
+            while tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                wait = remaining
+                if secondary is not None and hedge_delay is not None:
+                    wait = min(remaining, hedge_delay)
+
+                done, _ = await asyncio.wait(
+                    tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    provider = tasks.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+
+                    logger.warn(
+                        "Chat provider failed",
+                        provider=provider.name,
+                        error=str(task.exception()),
+                    )
+                    # 保留主服务的错误，使调用方能够识别限流
+                    if error is None:
+                        error = task.exception()
+
+                # 主服务出错或超过对冲等待时间，向备用服务发出请求
+                remaining = deadline - time.monotonic()
+                if secondary is not None and remaining > 0 and (done or hedge_delay is not None):
+                    logger.info(
+                        "Falling back to secondary provider"
+                        if done
+                        else "Hedging chat request",
+                        provider=secondary.name,
+                    )
+                    tasks[
+                        asyncio.create_task(self._timed(secondary, prompt, remaining))
+                    ] = secondary
+                    secondary = None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if error is not None and not tasks:
+            raise error
+        raise AiTimeoutError(408, f"对话请求超过{timeout}秒未完成")
+
+
+def get_provider(tokens: AccessTokenProvider) -> ChatProvider:
+    """
+    根据环境变量创建对话服务
+
+    AI_PROVIDER选择主服务（baidu或openai，默认为baidu），AI_SECONDARY_PROVIDER选择备用服务，
+    AI_TIMEOUT为每次调用的截止时间（秒），AI_HEDGE_PERCENTILE为触发对冲的耗时百分位。
+
+    参数:
+        tokens (AccessTokenProvider): 百度访问令牌提供者
+
+    返回:
+        ChatProvider: 对话服务
+    """
+
+    def create(name: str) -> ChatProvider:
+        if name == "openai":
+            return OpenAIProvider(
+                os.getenv("OPENAI_BASE_URL", "http://localhost:8001/v1"),
+                os.getenv("OPENAI_MODEL", "standin"),
+                os.getenv("OPENAI_API_KEY"),
+            )
+        if name == "baidu":
+            return BaiduProvider(tokens)
+        raise ValueError(f"Unknown AI provider: {name}")
+
+    secondary = os.getenv("AI_SECONDARY_PROVIDER")
+    return HedgedProvider(
+        create(os.getenv("AI_PROVIDER", "baidu")),
+        create(secondary) if secondary else None,
+        timeout=float(os.getenv("AI_TIMEOUT", 30)),
+        hedge_percentile=float(os.getenv("AI_HEDGE_PERCENTILE", 95)),
+    )
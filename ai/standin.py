@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+import json
+import re
+import time
+from hashlib import sha256
+
+from aiohttp import web
+
+# 批量提示词中的任务标题
+TASK_PATTERN = re.compile(r"^### 任务(\d+)$", re.M)
+
+
+def _digest(text: str) -> str:
+    return sha256(text.encode("utf-8")).hexdigest()
+
+
+def title_for(prompt: str) -> str:
+    """
+    计算提示词对应的固定标题
+
+    参数:
+        prompt (str): 单个商品的提示词
+
+    返回:
+        str: 标题
+    """
+    return f"替身标题{_digest(prompt.strip())[:12]}"
+
+
+def answer_for(prompt: str) -> str:
+    """
+    计算提示词对应的回答，批量提示词返回JSON数组
+
+    参数:
+        prompt (str): 提示词
+
+    返回:
+        str: 回答
+    """
+    matches = list(TASK_PATTERN.finditer(prompt))
+    if not matches:
+        return title_for(prompt)
+
+    answers = []
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(prompt)
+        task = prompt[match.end() : end]
+        answers.append({"id": int(match.group(1)), "title": title_for(task)})
+    return json.dumps(answers, ensure_ascii=False)
+
+
+def create_app(latency: float = 0.0, jitter: float = 0.0) -> web.Application:
+    """
+    创建OpenAI兼容的本地替身服务。
+
+    返回由提示词决定的固定标题，用于离线测试商品合并的吞吐量，批量提示词按任务编号返回JSON数组。
+    通过python -m ai.standin --port 8001启动后，设置AI_PROVIDER=openai、
+    OPENAI_BASE_URL=http://localhost:8001/v1即可使用。
+
+    参数:
+        latency (float): 每次请求的基础延迟（秒）
+        jitter (float): 附加延迟的上限（秒），实际附加延迟由提示词决定
+
+    返回:
+        web.Application: aiohttp应用
+    """
+    stats = {"requests": 0}
+
+    async def completions(request: web.Request) -> web.Response:
+        body = await request.json()
+        prompt = "\n".join(
+            message.get("content", "") for message in body.get("messages", [])
+        )
+        stats["requests"] += 1
+
+        delay = latency + jitter * int(_digest(prompt)[:4], 16) / 0xFFFF
+        if delay:
+            await asyncio.sleep(delay)
+
+        content = answer_for(prompt)
+        return web.json_response(
+            {
+                "id": f"chatcmpl-{_digest(prompt)[:24]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "standin"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": len(prompt),
+                    "completion_tokens": len(content),
+                    "total_tokens": len(prompt) + len(content),
+                },
+            }
+        )
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI兼容的本地替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0, help="基础延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="附加延迟上限（秒）")
+    args = parser.parse_args()
+
+    web.run_app(create_app(args.latency, args.jitter), host=args.host, port=args.port)
@@ -0,0 +1,194 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from hashlib import sha256
+
+import structlog
+from aiohttp import ClientSession
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from .error import AiUtilsError
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+# 百度OAuth服务地址
+OAUTH_URL = "https://aip.baidubce.com/oauth/2.0/token"
+
+# 百度AI服务表示访问令牌无效或过期的错误码
+TOKEN_ERROR_CODES = {110, 111}
+
+
+class AccessTokenProvider:
+    """
+    百度AI访问令牌提供者。
+
+    令牌按OAuth响应中的expires_in缓存，在到期前refresh_ahead时间内提前在后台刷新，
+    调用方继续使用当前令牌；并发的刷新请求合并为一次。
+    提供db时令牌同时保存在ai_tokens集合中，多个进程共用同一个令牌。
+    """
+
+    def __init__(
+        self,
+        db: AsyncIOMotorDatabase | None = None,
+        *,
+        refresh_ahead: timedelta | None = None,
+    ) -> None:
+        """
+        初始化令牌提供者
+
+        参数:
+            db (AsyncIOMotorDatabase, optional): MongoDB数据库实例，为None时只在进程内缓存
+            refresh_ahead (timedelta, optional): 提前刷新的时间，
+                默认读取BAIDU_TOKEN_REFRESH_AHEAD（秒），未设置时为1天
+        """
+        self._db = db
+        self._refresh_ahead = refresh_ahead or timedelta(
+            seconds=int(os.getenv("BAIDU_TOKEN_REFRESH_AHEAD", 24 * 3600))
+        )
+        self._token: str | None = None
+        self._expires_at = datetime.min
+        self._refresh_at = datetime.min
+        self._refreshing: asyncio.Task | None = None
+        self._rejected: str | None = None
+
+    @staticmethod
+    def _client_id() -> str:
+        """百度AI应用的API Key"""
+        return os.getenv("BAIDU_API_KEY", "")
+
+    @property
+    def _key(self) -> str:
+        """ai_tokens集合中的文档ID，不同应用的令牌互不共用"""
+        return sha256(self._client_id().encode("utf-8")).hexdigest()
+
+    async def get(self) -> str:
+        """
+        获取访问令牌
+
+        返回:
+            str: 百度AI API的访问令牌
+
+        异常:
+            AiUtilsError: 如果令牌获取失败
+        """
+        now = datetime.now()
+        if self._token is not None and now < self._expires_at:
+            if now >= self._refresh_at:
+                # 令牌即将过期，后台刷新，本次仍使用当前令牌
+                self._refresh()
+            return self._token
+
+        return await asyncio.shield(self._refresh())
+
+    def invalidate(self, token: str):
+        """
+        废弃被AI服务拒绝的令牌，下次获取时重新请求
+
+        参数:
+            token (str): 被拒绝的令牌，与当前令牌不同时（已被刷新）不做处理
+        """
+        if token == self._token:
+            self._rejected = token
+            self._token = None
+            self._expires_at = datetime.min
+
+    def _refresh(self) -> asyncio.Task:
+        """
+        启动令牌刷新，已有刷新正在进行时复用该刷新
+
+        返回:
+            asyncio.Task: 刷新任务，结果为新的令牌
+        """
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(self._load())
+            self._refreshing.add_done_callback(self._log_failure)
+        return self._refreshing
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task):
+        """记录后台刷新失败的原因，当前令牌在过期前继续可用"""
+        if not task.cancelled() and (error := task.exception()) is not None:
+            logger.warn("Failed to refresh Baidu access token", error=str(error))
+
+    async def _load(self) -> str:
+        """
+        加载令牌，优先使用其它进程保存在数据库中的有效令牌，否则向OAuth服务请求
+
+        返回:
+            str: 访问令牌
+        """
+        if self._db is not None:
+            shared = await self._db.ai_tokens.find_one(
+                {
+                    "_id": self._key,
+                    "refreshAt": {"$gt": datetime.now()},
+                    "token": {"$ne": self._rejected},
+                }
+            )
+            if shared is not None:
+                self._set(shared["token"], shared["expiresAt"], shared["refreshAt"])
+                logger.debug("Using shared Baidu access token")
+                return shared["token"]
+
+        token, expires_in = await self._fetch()
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=expires_in)
+        # 有效期较短时至少保留一半的有效期再刷新
+        refresh_at = expires_at - min(
+            self._refresh_ahead, timedelta(seconds=expires_in / 2)
+        )
+        self._set(token, expires_at, refresh_at)
+
+        if self._db is not None:
+            await self._db.ai_tokens.update_one(
+                {"_id": self._key},
+                {
+                    "$set": {
+                        "token": token,
+                        "expiresAt": expires_at,
+                        "refreshAt": refresh_at,
+                        "updatedAt": now,
+                    }
+                },
+                upsert=True,
+            )
+
+        logger.info("Baidu access token refreshed", expiresAt=expires_at)
+        return token
+
+    def _set(self, token: str, expires_at: datetime, refresh_at: datetime):
+        """更新进程内缓存的令牌"""
+        self._token = token
+        self._expires_at = expires_at
+        self._refresh_at = refresh_at
+
+    async def _fetch(self) -> tuple[str, int]:
+        """
+        从百度OAuth服务获取访问令牌
+
+        返回:
+            tuple[str, int]: 访问令牌及其有效期（秒）
+
+        异常:
+            AiUtilsError: 如果令牌获取失败
+        """
+        # 设置请求参数
+        params = {
+            "grant_type": "client_credentials",
+            "client_id": self._client_id(),
+            "client_secret": os.getenv("BAIDU_SECRET_KEY"),
+        }
+        async with ClientSession() as session:
+            async with session.post(OAUTH_URL, params=params) as response:
+                data = await response.json()
+
+        token = data.get("access_token")
+        # 检查是否成功获取令牌
+        if token is None:
+            raise AiUtilsError(
+                response.status,
+                "无法从百度OAuth服务获取访问令牌",
+            )
+
+        # 百度访问令牌默认有效期为30天
+        return token, int(data.get("expires_in", 30 * 24 * 3600))
@@ -1,3 +1,8 @@
 from .agiso import AgisoApi
+from .crawl import CrawlCoordinator
 from .ctrip import CtripApi
-from .error import ApiError
\ No newline at end of file
+from .error import ApiError, MediaRejectedError
+from .images import ImageStore
+from .media import AgisoMediaCache
+from .mirror import AgisoGoodsMirror
+from .short_urls import ShortUrlStore
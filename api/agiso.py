@@ -1,4 +1,6 @@
+import asyncio
 import os
+import re
 from hashlib import md5
 from pathlib import Path
 from typing import Literal
@@ -8,15 +10,35 @@ import aiohttp
 import structlog
 from minio import Minio, S3Error
 
-from .error import ApiError
+from throttle import TokenBucket
+
+from .error import ApiError, MediaRejectedError
+from .media import AgisoMediaCache
+from .mirror import AgisoGoodsMirror
+from .types import ImageUploadResult, ItemUploadResult
 
 logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
 
+MD5_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+# 发布失败的错误信息中表示图片被拒绝的关键字
+MEDIA_ERROR_PATTERN = re.compile(r"图片|主图|img|image|media|pic", re.I)
+
 
 class AgisoApi:
     """Agiso API 客户端类，用于与 Agiso 系统进行交互"""
     
-    def __init__(self, cookies: list, token: str, minio: Minio) -> None:
+    def __init__(
+        self,
+        cookies: list,
+        token: str,
+        minio: Minio,
+        *,
+        media_cache: AgisoMediaCache | None = None,
+        image_concurrency: int = 4,
+        limiter: TokenBucket | None = None,
+        mirror: AgisoGoodsMirror | None = None,
+    ) -> None:
         """
         初始化 AgisoApi 实例
         
@@ -24,45 +46,85 @@ class AgisoApi:
             cookies: API 请求所需的 cookies
             token: 认证令牌
             minio: Minio 客户端实例，用于存储和获取图片
+            media_cache: 已上传图片缓存，为None时每次都重新上传图片
+            image_concurrency: 单个商品图片并发处理数
+            limiter: 账号级别的请求限流器，为None时不限流
+            mirror: 本地商品镜像，发布和上下架时同步更新
         """
         self._cookies = cookies
         self._token = token
         self._headers = {"Authorization": f"Bearer {self._token}"}
         self._minio = minio
+        self._media_cache = media_cache
+        self._image_concurrency = image_concurrency
+        self._limiter = limiter
+        self._mirror = mirror
+
+    async def _throttle(self):
+        """
+        请求前获取限流令牌，未设置限流器时直接返回
+        """
+        if self._limiter is not None:
+            await self._limiter.acquire()
 
-    async def search_good_list(self):
+    async def search_good_list(self, *, concurrency: int = 1):
         """
         搜索商品列表
         
+        参数:
+            concurrency: 同时请求的页数，默认为1即逐页请求
+        
         返回:
             list: 包含所有商品信息的列表
         
         异常:
             ApiError: 当API请求失败时抛出
         """
-        url = os.getenv("AGISO_SEARCH_GOODS_LIST_API", "")
-        body = {"pageSize": 100, "page": 1, "status": "0", "categoryId": ""}
         goods = []
+        page = 1
 
         async with aiohttp.ClientSession(
             cookies=self._cookies, headers=self._headers
         ) as session:
             while True:
-                async with session.post(url, json=body) as response:
-                    if response.status != 200:
-                        raise ApiError(f"Response with status code {response.status}")
+                # 并发请求一批页面，遇到没有下一页的页面后停止
+                pages = await asyncio.gather(
+                    *(
+                        self._search_good_page(session, page + i)
+                        for i in range(concurrency)
+                    )
+                )
+                page += concurrency
 
-                    data = await response.json()
-                    for good in data["data"]["data"]["items"]:
-                        goods.append(good)
+                for data in pages:
+                    goods.extend(data["items"])
+                    if not data["hasNextPages"]:
+                        return goods
 
-                # 检查是否有下一页，有则继续请求
-                if data["data"]["data"]["hasNextPages"]:
-                    body["page"] += 1
-                else:
-                    break
+    async def _search_good_page(self, session: aiohttp.ClientSession, page: int):
+        """
+        请求商品列表的一页
 
-        return goods
+        参数:
+            session: 客户端会话
+            page: 页码，从1开始
+
+        返回:
+            dict: 包含items和hasNextPages的分页数据
+
+        异常:
+            ApiError: 当API请求失败时抛出
+        """
+        url = os.getenv("AGISO_SEARCH_GOODS_LIST_API", "")
+        body = {"pageSize": 100, "page": page, "status": "0", "categoryId": ""}
+
+        await self._throttle()
+        async with session.post(url, json=body) as response:
+            if response.status != 200:
+                raise ApiError(f"Response with status code {response.status}")
+
+            data = await response.json()
+            return data["data"]["data"]
 
     async def update_item_status(self, id: str, online: bool):
         """
@@ -81,6 +143,7 @@ class AgisoApi:
         async with aiohttp.ClientSession(
             cookies=self._cookies, headers=self._headers
         ) as session:
+            await self._throttle()
             async with session.post(url, json=body) as response:
                 if response.status != 200:
                     raise ApiError(f"Response with status code {response.status}")
@@ -89,12 +152,21 @@ class AgisoApi:
                 if not data.get("data", {}).get("isSuccess", False):
                     raise ApiError(f"Failed to update item status")
 
-    async def upload_images(self, image: Path | str | bytes):
+        if self._mirror is not None:
+            await self._mirror.record_status(id, online)
+
+    async def upload_images(
+        self,
+        image: Path | str | bytes,
+        *,
+        session: aiohttp.ClientSession | None = None,
+    ):
         """
         上传图片到 Agiso 系统
         
         参数:
             image: 可以是图片路径、图片路径字符串或图片二进制数据
+            session: 可复用的客户端会话，为None时新建会话
             
         返回:
             dict: 上传成功后的图片信息
@@ -103,6 +175,12 @@ class AgisoApi:
             FileExistsError: 当指定的图片文件不存在时抛出
             ApiError: 当API请求失败时抛出
         """
+        if session is None:
+            async with aiohttp.ClientSession(
+                cookies=self._cookies, headers=self._headers
+            ) as session:
+                return await self.upload_images(image, session=session)
+
         # 如果提供的是文件路径，读取文件内容
         if isinstance(image, (Path, str)):
             if not os.path.exists(image):
@@ -120,19 +198,17 @@ class AgisoApi:
             content_type="image/png",
         )
 
-        async with aiohttp.ClientSession(
-            cookies=self._cookies, headers=self._headers
-        ) as session:
-            async with session.post(url, data=form) as response:
-                if response.status != 200:
-                    raise ApiError(f"Response code: {response.status}")
+        await self._throttle()
+        async with session.post(url, data=form) as response:
+            if response.status != 200:
+                raise ApiError(f"Response code: {response.status}")
 
-                data = await response.json()
-                statusCode = data.get("statusCode")
-                if statusCode != 200:
-                    raise ApiError(f"Response code: {statusCode}")
+            data = await response.json()
+            statusCode = data.get("statusCode")
+            if statusCode != 200:
+                raise ApiError(f"Response code: {statusCode}")
 
-                return data["data"]["data"]
+            return data["data"]["data"]
 
     async def upload_item(
         self,
@@ -153,40 +229,22 @@ class AgisoApi:
             price: 当price_mode为"fixed"时使用的价格，默认为0.01
             template: 商品描述模板，为None时使用商品原有描述
             
+        返回:
+            ItemUploadResult: 上传结果，包含每张图片的处理结果
+            
         异常:
             ApiError: 当API请求失败时抛出
         """
-        # 上传商品图片
-        imgs = []
-        for image in item["imgList"]:
-            try:
-                # 获取图片元数据
-                obj = self._minio.stat_object(bucket_name="images", object_name=image)
-                assert obj.size is not None
-
-                # 检查图片大小是否超过10MB
-                if obj.size >= 10 * 1024 * 1024:
-                    logger.warn(
-                        "Image size is larger than 10MB", image=image, size=obj.size
-                    )
-                    continue
-
-                # 从Minio获取图片数据
-                obj = self._minio.get_object(bucket_name="images", object_name=image)
-                image_bytes = obj.read()
-
-                # 上传图片到Agiso
-                imgs.append(await self.upload_images(image_bytes))
-            except S3Error as e:
-                if e.code == "NoSuchKey":
-                    logger.warn("No such image", image=image)
-            except Exception as e:
-                logger.error("Upload image error", error=e)
+        # 上传商品图片，优先复用缓存的媒体记录
+        result = ItemUploadResult(
+            outer_id=item.get("productId"),
+            images=await self._upload_item_images(item),
+        )
 
         # 如果没有成功上传任何图片，则跳过
-        if not imgs:
+        if not result.records:
             logger.warn("Failed to upload any images, skip.")
-            return
+            return result
 
         # 处理商品描述模板
         if template:
@@ -233,14 +291,180 @@ class AgisoApi:
             "stuffStatus": 0,
             "transportFee": 0,
             "itemSkuList": [],
-            "imgList": imgs,
+            "imgList": result.records,
             "categoryName": "卡券/票务/旅游出行/旅游出行/其他酒店优惠券",
         }
 
+        try:
+            result.goods_id = await self._publish(body, draft=draft)
+        except MediaRejectedError:
+            reused = [image.md5 for image in result.images if image.cached]
+            if not reused or self._media_cache is None:
+                raise
+
+            # 缓存的媒体记录可能已被Agiso拒绝，使其失效后重新上传图片再发布一次
+            logger.warn(
+                "Publish failed with cached images, refreshing",
+                item_id=item.get("productId", "unknown"),
+                count=len(reused),
+            )
+            await self._media_cache.invalidate(reused)
+            result.images = await self._upload_item_images(item, refresh=True)
+            body["imgList"] = result.records
+            result.goods_id = await self._publish(body, draft=draft)
+
+        result.published = True
+        if self._mirror is not None and not draft:
+            await self._mirror.record_published(item.get("productId"), result.goods_id)
+
+        return result
+
+    async def _upload_item_images(self, item, *, refresh=False):
+        """
+        并发上传商品的所有图片，结果保持原有图片顺序
+
+        参数:
+            item: 商品信息字典
+            refresh: 是否忽略缓存强制重新上传
+
+        返回:
+            list[ImageUploadResult]: 每张图片的处理结果
+        """
+        semaphore = asyncio.Semaphore(self._image_concurrency)
+
+        async with aiohttp.ClientSession(
+            cookies=self._cookies, headers=self._headers
+        ) as session:
+
+            async def prepare(image: str):
+                async with semaphore:
+                    return await self._prepare_image(session, image, refresh=refresh)
+
+            results = await asyncio.gather(
+                *(prepare(image) for image in dict.fromkeys(item["imgList"]))
+            )
+
+        # 不同对象名可能是相同内容，只保留第一次出现的图片，其余标记为跳过
+        uploaded = set()
+        for result in results:
+            if result.record is None:
+                continue
+
+            if result.md5 in uploaded:
+                result.record = None
+                result.skipped = True
+            uploaded.add(result.md5)
+
+        return results
+
+    async def _prepare_image(
+        self, session: aiohttp.ClientSession, image: str, *, refresh=False
+    ) -> ImageUploadResult:
+        """
+        读取并上传单张图片，已缓存的图片直接复用媒体记录
+
+        参数:
+            session: 客户端会话
+            image: MinIO中的图片对象名
+            refresh: 是否忽略缓存强制重新上传
+
+        返回:
+            ImageUploadResult: 图片处理结果，失败时包含错误信息
+        """
+        result = ImageUploadResult(image=image)
+        try:
+            # 内容寻址的图片名即为MD5，命中缓存时无需读取图片
+            if not refresh and (record := await self._cached_media(image)):
+                result.md5, result.record, result.cached = image, record, True
+                return result
+
+            # 获取图片元数据
+            obj = await asyncio.to_thread(
+                self._minio.stat_object, bucket_name="images", object_name=image
+            )
+            assert obj.size is not None
+
+            # 检查图片大小是否超过10MB
+            if obj.size >= 10 * 1024 * 1024:
+                logger.warn("Image size is larger than 10MB", image=image, size=obj.size)
+                result.error = "too large"
+                return result
+
+            # 从Minio获取图片数据
+            image_bytes = await asyncio.to_thread(self._read_image, image)
+            result.md5 = md5(image_bytes).hexdigest()
+
+            if not refresh and (record := await self._cached_media(result.md5)):
+                result.record, result.cached = record, True
+                return result
+
+            # 上传图片到Agiso
+            result.record = await self.upload_images(image_bytes, session=session)
+
+            if self._media_cache is not None:
+                await self._media_cache.put(result.md5, result.record)
+        except S3Error as e:
+            if e.code == "NoSuchKey":
+                logger.warn("No such image", image=image)
+            result.error = e.code
+        except Exception as e:
+            logger.error("Upload image error", error=e)
+            result.error = str(e)
+
+        return result
+
+    def _read_image(self, image: str) -> bytes:
+        """
+        从MinIO读取图片数据
+
+        参数:
+            image: MinIO中的图片对象名
+
+        返回:
+            bytes: 图片二进制数据
+        """
+        obj = self._minio.get_object(bucket_name="images", object_name=image)
+        try:
+            return obj.read()
+        finally:
+            obj.close()
+            obj.release_conn()
+
+    async def _cached_media(self, digest: str):
+        """
+        查询图片的缓存媒体记录
+
+        参数:
+            digest: 图片内容MD5
+
+        返回:
+            dict | None: 媒体记录，未启用缓存或未命中时返回None
+        """
+        if self._media_cache is None or not MD5_PATTERN.fullmatch(digest):
+            return None
+
+        return await self._media_cache.get(digest)
+
+    async def _publish(self, body: dict, *, draft=False):
+        """
+        发布商品或保存为草稿
+
+        参数:
+            body: 商品数据
+            draft: 是否仅保存为草稿
+
+        返回:
+            str | None: 发布后的商品ID，响应中不包含时返回None
+
+        异常:
+            MediaRejectedError: 商品图片被拒绝时抛出
+            ApiError: 当API请求失败时抛出
+        """
         # 根据draft参数决定是保存草稿还是直接发布
         async with aiohttp.ClientSession(
             cookies=self._cookies, headers=self._headers
         ) as session:
+            await self._throttle()
             async with session.post(
                 (
                     os.getenv("AGISO_INSERT_DRAFT_API", "")
@@ -257,6 +481,34 @@ class AgisoApi:
                 data = await response.json()
                 status_code = data.get("statusCode")
                 if status_code != 200 or data.get("succeeded") != True:
-                    raise ApiError(
-                        f"Failed to insert draft, status code: {status_code}"
+                    message = str(data.get("message") or data.get("errorMessage") or "")
+                    error_cls = (
+                        MediaRejectedError
+                        if MEDIA_ERROR_PATTERN.search(message)
+                        else ApiError
+                    )
+                    raise error_cls(
+                        f"Failed to insert draft, status code: {status_code}, {message}"
                     )
+
+                return self._goods_id_of(data)
+
+    @staticmethod
+    def _goods_id_of(data: dict) -> str | None:
+        """
+        从发布接口的响应中提取商品ID
+
+        参数:
+            data: 发布接口的响应数据
+
+        返回:
+            str | None: 商品ID，响应中不包含时返回None
+        """
+        result = (data.get("data") or {}).get("data")
+        if isinstance(result, dict):
+            result = result.get("goodsId") or result.get("itemId") or result.get("id")
+
+        if isinstance(result, (str, int)) and not isinstance(result, bool):
+            return str(result)
+
+        return None
@@ -0,0 +1,163 @@
+from datetime import datetime, timedelta
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+
+class CrawlCheckpoint:
+    """
+    分片爬取检查点。
+
+    保存在crawls集合中分片文档的checkpoint字段，记录最后完成的页码和尚未保存详情的产品ID。
+    爬取中断后，在有效期内重新爬取时从检查点继续，爬取完成后清除。
+    """
+
+    def __init__(
+        self, db: AsyncIOMotorDatabase, shard: str, *, max_age: timedelta
+    ) -> None:
+        """
+        初始化检查点
+
+        参数:
+            db: MongoDB异步数据库实例
+            shard: 分片标识
+            max_age: 检查点有效期，从最后一次更新开始计算
+        """
+        self._db = db
+        self._shard = shard
+        self._max_age = max_age
+
+    @property
+    def shard(self) -> str:
+        """分片标识"""
+        return self._shard
+
+    async def load(self) -> dict | None:
+        """
+        读取有效的检查点
+
+        返回:
+            dict | None: 包含page和pending的检查点，不存在或已过期时返回None
+        """
+        state = await self._db.crawls.find_one({"_id": self._shard}, {"checkpoint": 1})
+        checkpoint = state.get("checkpoint") if state else None
+        if checkpoint and checkpoint["updatedAt"] >= datetime.now() - self._max_age:
+            return checkpoint
+        return None
+
+    async def save(self, page: int, pending: list[str]):
+        """
+        保存检查点
+
+        参数:
+            page: 最后完成的页码
+            pending: 尚未保存详情的产品ID
+        """
+        await self._db.crawls.update_one(
+            {"_id": self._shard},
+            {
+                "$set": {
+                    "checkpoint": {
+                        "page": page,
+                        "pending": pending,
+                        "updatedAt": datetime.now(),
+                    }
+                }
+            },
+            upsert=True,
+        )
+
+    async def clear(self):
+        """
+        爬取完成后清除检查点
+        """
+        await self._db.crawls.update_one(
+            {"_id": self._shard}, {"$unset": {"checkpoint": ""}}
+        )
+
+
+class ImageQueue:
+    """
+    持久化的图片下载队列。
+
+    待下载的图片URL保存在image_queue集合中，下载成功后删除；进程重启后未完成的图片
+    在下一轮爬取开始时重新下载，多次下载失败的图片不再重试，由TTL索引在7天后清除。
+    """
+
+    # 最多尝试下载的次数
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, db: AsyncIOMotorDatabase) -> None:
+        """
+        初始化图片下载队列
+
+        参数:
+            db: MongoDB异步数据库实例
+        """
+        self._db = db
+
+    async def put_many(self, urls: list[str], *, bucket_name: str):
+        """
+        加入待下载的图片
+
+        参数:
+            urls: 图片URL列表
+            bucket_name: MinIO中的桶名称
+        """
+        if not urls:
+            return
+
+        now = datetime.now()
+        await self._db.image_queue.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": url},
+                    {
+                        "$setOnInsert": {
+                            "bucket": bucket_name,
+                            "attempts": 0,
+                            "enqueuedAt": now,
+                        }
+                    },
+                    upsert=True,
+                )
+                for url in set(urls)
+            ],
+            ordered=False,
+        )
+
+    def pending(self, *, bucket_name: str):
+        """
+        查询尚未下载的图片
+
+        参数:
+            bucket_name: MinIO中的桶名称
+
+        返回:
+            AsyncIOMotorCursor: 图片游标，_id为图片URL
+        """
+        return self._db.image_queue.find(
+            {"bucket": bucket_name, "attempts": {"$lt": self.MAX_ATTEMPTS}}, {"_id": 1}
+        )
+
+    async def done(self, url: str):
+        """
+        标记图片下载完成
+
+        参数:
+            url: 图片URL
+        """
+        await self._db.image_queue.delete_one({"_id": url})
+
+    async def failed(self, url: str, error: str):
+        """
+        记录图片下载失败
+
+        参数:
+            url: 图片URL
+            error: 失败原因
+        """
+        await self._db.image_queue.update_one(
+            {"_id": url},
+            {"$inc": {"attempts": 1}, "$set": {"error": error, "failedAt": datetime.now()}},
+        )
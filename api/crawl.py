@@ -0,0 +1,275 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Iterable
+
+import structlog
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from jobs.lease import Lease
+
+from .checkpoint import CrawlCheckpoint
+from .ctrip import CtripApi
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class CrawlCoordinator:
+    """
+    爬取协调器。
+
+    同一分片（城市和标签）在新鲜期内只爬取一次，结果写入共享的goods集合供所有用户使用。
+    进程内对同一分片的并发请求合并为一次爬取，多个进程之间通过名为crawl:<分片>的租约互斥，
+    未取得租约的进程等待持有者完成后直接使用其结果。分片的完成时间、统计信息和检查点保存在
+    crawls集合中。
+    """
+
+    # 租约有效期，爬取期间定期续期
+    LEASE = timedelta(minutes=5)
+
+    # 等待其它进程完成爬取时的轮询间隔（秒）
+    POLL_INTERVAL = 10
+
+    # 进程内正在进行的分片爬取
+    _running: dict[str, asyncio.Task] = {}
+
+    def __init__(self, db: AsyncIOMotorDatabase) -> None:
+        """
+        初始化爬取协调器
+
+        参数:
+            db: MongoDB异步数据库实例
+        """
+        self._db = db
+
+    @staticmethod
+    def shard(city_name: str, tab_value: str) -> str:
+        """
+        计算分片标识
+
+        参数:
+            city_name: 城市名称
+            tab_value: 商品列表标签
+
+        返回:
+            str: 分片标识
+        """
+        return f"{city_name}:{tab_value}"
+
+    async def stale(
+        self, cities: Iterable[str], tabs: Iterable[str], *, max_age: timedelta
+    ) -> list[str]:
+        """
+        查询城市和标签组合中不在新鲜期内的分片
+
+        参数:
+            cities: 城市名称列表
+            tabs: 商品列表标签列表
+            max_age: 新鲜期
+
+        返回:
+            list[str]: 需要爬取的分片标识
+        """
+        shards = [
+            self.shard(city_name, tab_value) for city_name in cities for tab_value in tabs
+        ]
+        fresh = set(
+            await self._db.crawls.distinct(
+                "_id",
+                {"_id": {"$in": shards}, "finishedAt": {"$gte": datetime.now() - max_age}},
+            )
+        )
+        return [shard for shard in shards if shard not in fresh]
+
+    async def ensure(
+        self,
+        shard: str,
+        crawl: Callable[[], Awaitable[dict | None]],
+        *,
+        max_age: timedelta,
+    ) -> bool:
+        """
+        确保分片的爬取结果在新鲜期内，过期时执行爬取
+
+        参数:
+            shard: 分片标识
+            crawl: 执行爬取的函数，返回的统计信息保存到分片状态中
+            max_age: 新鲜期
+
+        返回:
+            bool: 本次执行了爬取返回True，使用已有结果返回False
+
+        异常:
+            爬取失败时抛出crawl中的异常，租约被释放，下次调用重新爬取
+        """
+        task = self._running.get(shard)
+        if task is None or task.done():
+            task = asyncio.create_task(self._ensure(shard, crawl, max_age))
+            self._running[shard] = task
+        return await asyncio.shield(task)
+
+    async def _ensure(
+        self,
+        shard: str,
+        crawl: Callable[[], Awaitable[dict | None]],
+        max_age: timedelta,
+    ) -> bool:
+        lease = Lease(self._db, f"crawl:{shard}", ttl=self.LEASE)
+        while True:
+            if await self._fresh(shard, max_age):
+                return False
+
+            if await lease.acquire():
+                break
+
+            logger.info("Crawl is running in another process, waiting", shard=shard)
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+        try:
+            # 检查新鲜度之后、取得租约之前，持有者可能刚完成爬取并释放租约
+            if await self._fresh(shard, max_age):
+                return False
+
+            logger.info("Crawling shard", shard=shard)
+            await self._db.crawls.update_one(
+                {"_id": shard}, {"$set": {"startedAt": datetime.now()}}, upsert=True
+            )
+            heartbeat = asyncio.create_task(self._renew(lease))
+            try:
+                metrics = await crawl()
+            finally:
+                heartbeat.cancel()
+
+            await self._db.crawls.update_one(
+                {"_id": shard},
+                {"$set": {"finishedAt": datetime.now(), "metrics": metrics}},
+            )
+            return True
+        finally:
+            await lease.release()
+
+    async def _fresh(self, shard: str, max_age: timedelta) -> bool:
+        """
+        检查分片的爬取结果是否在新鲜期内
+        """
+        state = await self._db.crawls.find_one({"_id": shard}, {"finishedAt": 1})
+        finished_at = state.get("finishedAt") if state else None
+        if finished_at and finished_at >= datetime.now() - max_age:
+            logger.info("Crawl is fresh, skip", shard=shard, finishedAt=finished_at)
+            return True
+        return False
+
+    async def ensure_matrix(
+        self,
+        ctrip_api: CtripApi,
+        cities: Iterable[str],
+        tabs: Iterable[str],
+        *,
+        max_age: timedelta,
+        checkpoint_age: timedelta = timedelta(hours=6),
+        concurrency: int = 10,
+        page_size: int = 10,
+        on_shard: Callable[[str, bool | BaseException], Awaitable[None]] | None = None,
+    ) -> dict[str, bool | BaseException]:
+        """
+        并行确保城市和标签组合的每个分片都在新鲜期内
+
+        所有分片共用concurrency个并发请求的预算，同一产品在多个分片中出现时只获取一次详情。
+        单个分片失败不影响其它分片，失败的分片在checkpoint_age内再次爬取时从检查点继续。
+
+        参数:
+            ctrip_api: 携程API客户端
+            cities: 城市名称列表
+            tabs: 商品列表标签列表
+            max_age: 新鲜期
+            checkpoint_age: 检查点有效期
+            concurrency: 所有分片共用的并发请求数
+            page_size: 每页记录数
+            on_shard: 每个分片完成后调用，参数为分片标识和该分片的结果
+
+        返回:
+            dict[str, bool | BaseException]: 各分片的结果，True为本次爬取，False为使用已有结果，
+                爬取失败时为异常
+        """
+        budget = asyncio.Semaphore(max(1, concurrency))
+        seen: set[str] = set()
+        shards = {
+            self.shard(city_name, tab_value): (city_name, tab_value)
+            for city_name in cities
+            for tab_value in tabs
+        }
+
+        async def crawl(city_name: str, tab_value: str) -> dict:
+            metrics = await ctrip_api.run(
+                city_name,
+                tab_value=tab_value,
+                page_size=page_size,
+                budget=budget,
+                seen=seen,
+                checkpoint=CrawlCheckpoint(
+                    self._db,
+                    self.shard(city_name, tab_value),
+                    max_age=checkpoint_age,
+                ),
+            )
+            return {**metrics.model_dump(), "throughput": metrics.throughput}
+
+        async def run_shard(shard: str, city_name: str, tab_value: str) -> bool:
+            try:
+                result = await self.ensure(
+                    shard, lambda: crawl(city_name, tab_value), max_age=max_age
+                )
+            except Exception as e:
+                result = e
+
+            if on_shard is not None:
+                try:
+                    await on_shard(shard, result)
+                except Exception as e:
+                    logger.error("Shard callback failed", shard=shard, error=str(e))
+
+            if isinstance(result, BaseException):
+                raise result
+            return result
+
+        async def resume_images():
+            # 上次未完成的图片每轮只下载一次，不随分片重复下载
+            try:
+                await ctrip_api.resume_images()
+            except Exception as e:
+                logger.error("Failed to resume image downloads", error=str(e))
+
+        started = datetime.now()
+        results = await asyncio.gather(
+            *(
+                run_shard(shard, city_name, tab_value)
+                for shard, (city_name, tab_value) in shards.items()
+            ),
+            resume_images(),
+            return_exceptions=True,
+        )
+        results = dict(zip(shards, results))
+
+        for shard, result in results.items():
+            if isinstance(result, BaseException):
+                logger.error("Failed to crawl shard", shard=shard, error=str(result))
+
+        logger.info(
+            "Crawl matrix finished",
+            shards=len(shards),
+            crawled=sum(result is True for result in results.values()),
+            failed=sum(isinstance(result, BaseException) for result in results.values()),
+            products=len(seen),
+            elapsed=(datetime.now() - started).total_seconds(),
+        )
+        return results
+
+    @staticmethod
+    async def _renew(lease: Lease):
+        """
+        爬取期间定期续期租约，租约丢失时停止续期
+        """
+        while True:
+            await asyncio.sleep(lease.ttl.total_seconds() / 3)
+            if not await lease.renew():
+                logger.warning("Crawl lease lost", lease=lease.name)
+                return
@@ -1,13 +1,20 @@
 import asyncio
-import errno
+import json
 import os
-from io import BytesIO
+from datetime import datetime
+from hashlib import md5
 
-import aiofiles
 import structlog
 from aiohttp import ClientSession
 from minio import Minio, S3Error
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+from .checkpoint import CrawlCheckpoint, ImageQueue
+from .error import ApiError
+from .images import ImageStore
+from .short_urls import ShortUrlStore
+from .types import CrawlMetrics
 
 logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
 
@@ -17,6 +24,9 @@ class CtripApi:
     携程API客户端类，用于与携程旅游API进行交互，包括获取产品列表、产品详情、创建短链接等功能。
     同时支持将图片下载并存储到MinIO对象存储中，并将产品信息保存到MongoDB数据库。
     """
+
+    # 连续多少页的产品详情全部获取失败时中止爬取
+    ERROR_STREAK = 3
     def __init__(
         self,
         cookies: list,
@@ -40,6 +50,8 @@ class CtripApi:
         self._db = db
         self._alliance_id = alliance_id
         self._sid = sid
+        self._images = ImageStore(db, minio)
+        self._image_queue = ImageQueue(db)
 
     async def create_short_url(self, session: ClientSession, url: str) -> str:
         """
@@ -52,13 +64,13 @@ class CtripApi:
         返回:
             str: 生成的短链接URL
         """
-        url = os.getenv("CTRIP_CREATE_SHORT_URL_API", "")
+        api = os.getenv("CTRIP_CREATE_SHORT_URL_API", "")
         body = {
             "url": f"{url}&allianceid={self._alliance_id}&sid={self._sid}",
             "clientFrom": "PC",
         }
 
-        async with session.post(url, json=body) as response:
+        async with session.post(api, json=body) as response:
             return (await response.json()).get("shortUrl")
 
     async def find_product_detail(self, session: ClientSession, product_id: str):
@@ -83,7 +95,15 @@ class CtripApi:
         async with session.post(url, json=body) as response:
             return await response.json()
 
-    async def get_product_list(self, session, page: int, city_name: str) -> list[dict]:
+    async def get_product_list(
+        self,
+        session,
+        page: int,
+        city_name: str,
+        *,
+        tab_value: str = "hotPush",
+        page_size: int = 10,
+    ) -> list[dict]:
         """
         获取产品列表
         
@@ -91,6 +111,8 @@ class CtripApi:
             session: aiohttp客户端会话
             page: 页码，从1开始
             city_name: 城市名称，用于筛选特定城市的产品
+            tab_value: 商品列表标签，默认为热门推荐
+            page_size: 每页记录数，默认为10
             
         返回:
             list[dict]: 产品信息列表
@@ -99,10 +121,10 @@ class CtripApi:
         body = {
             "cityName": city_name,
             "pageIndex": page,
-            "pageSize": 10,  # 每页10条记录
+            "pageSize": page_size,
             "subTabType": "",
             "subTabValue": "",
-            "tabValue": "hotPush",  # 热门推荐类型
+            "tabValue": tab_value,
             "clientFrom": "PC",
         }
 
@@ -113,33 +135,39 @@ class CtripApi:
         self, session: ClientSession, img_url: str, *, bucket_name="images"
     ):
         """
-        下载单张图片并保存到MinIO中
+        下载单张图片并按内容哈希保存到MinIO中
         
         参数:
             session: aiohttp客户端会话
             img_url: 图片URL
             bucket_name: MinIO中的桶名称，默认为"images"
         """
-        img_name = img_url.split("/")[-1]  # 从URL中提取图片名称
+        img_name = ImageStore.alias_of(img_url)  # 从URL中提取图片名称
+        # 别名已记录，说明图片内容已存储过
+        if await self._images.lookup(img_name):
+            return
+
+        def read_object() -> bytes:
+            obj = self._minio.get_object(bucket_name, img_name)
+            try:
+                return obj.read()
+            finally:
+                obj.close()
+                obj.release_conn()
+
         try:
-            # 检查图片是否已存在于MinIO中
-            await asyncio.to_thread(self._minio.stat_object, bucket_name, img_name)
+            # 兼容旧数据：图片以URL文件名存储过时直接从MinIO读取，无需重新下载
+            data = await asyncio.to_thread(read_object)
         except S3Error as e:
-            if e.code == "NoSuchKey":  # 图片不存在，需要下载
-                async with session.get(img_url) as response:
-                    data = await response.read()
-
-                    # 将图片上传到MinIO
-                    await asyncio.to_thread(
-                        self._minio.put_object,
-                        bucket_name,
-                        img_name,
-                        BytesIO(data),
-                        len(data),
-                        content_type="image/jpeg",
-                    )
-            else:
+            if e.code != "NoSuchKey":
                 logger.error(f"S3Error: {e}")
+                raise
+
+            async with session.get(img_url) as response:
+                data = await response.read()
+
+        # 按内容哈希保存图片并记录别名
+        await self._images.put(img_name, data, url=img_url, bucket_name=bucket_name)
 
     async def _download_images(self, q: asyncio.Queue, *, bucket_name="images"):
         """
@@ -161,24 +189,156 @@ class CtripApi:
                     await self._download_image(
                         session, img_url, bucket_name=bucket_name
                     )
+                    await self._image_queue.done(img_url)
                 except Exception as e:
                     logger.error(f"Failed when download {img_url}, skip it: {e}")
+                    await self._image_queue.failed(img_url, str(e))
                 finally:
                     q.task_done()  # 通知队列任务已完成
 
+    async def resume_images(
+        self, *, download_images_task_num=10, bucket_name="images"
+    ) -> int:
+        """
+        下载持久化队列中上次未完成的图片
+
+        每轮爬取开始时调用一次，各分片的run只下载本分片新加入的图片。
+
+        参数:
+            download_images_task_num: 图片下载任务的并发数，默认为10
+            bucket_name: MinIO中的桶名称，默认为"images"
+
+        返回:
+            int: 尝试下载的图片数
+        """
+        images_queue = asyncio.Queue()
+        async for image in self._image_queue.pending(bucket_name=bucket_name):
+            await images_queue.put(image["_id"])
+
+        count = images_queue.qsize()
+        if not count:
+            return 0
+
+        logger.info("Resuming image downloads", count=count)
+        tasks = [
+            asyncio.create_task(
+                self._download_images(images_queue, bucket_name=bucket_name)
+            )
+            for _ in range(min(download_images_task_num, count))
+        ]
+        for _ in tasks:
+            await images_queue.put(None)
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return count
+
+    async def _store_details(self, details: list[dict]):
+        """
+        保存产品详情，内容发生变化的产品所在分组（subName）会被标记为待合并
+
+        产品内容以指纹比较，未变化的产品不会更新，也不会触发合并。
+
+        参数:
+            details: 产品详情列表
+        """
+        if not details:
+            return
+
+        existing = {
+            good["productId"]: good
+            async for good in self._db.goods.find(
+                {"productId": {"$in": [detail["productId"] for detail in details]}},
+                {"productId": 1, "subName": 1, "fingerprint": 1},
+            )
+        }
+
+        now = datetime.now()
+        operations = []
+        dirty_groups = set()
+        for detail in details:
+            fingerprint = md5(
+                json.dumps(detail, sort_keys=True, ensure_ascii=False, default=str).encode()
+            ).hexdigest()
+            previous = existing.get(detail["productId"], {})
+            if previous.get("fingerprint") == fingerprint:
+                continue
+
+            # 产品移动到其它分组时，原分组同样需要重新合并
+            dirty_groups.update(
+                group
+                for group in (detail.get("subName"), previous.get("subName"))
+                if group is not None
+            )
+            operations.append(
+                UpdateOne(
+                    {"productId": detail["productId"]},
+                    {"$set": {**detail, "fingerprint": fingerprint, "updatedAt": now}},
+                    upsert=True,  # 不存在则插入
+                )
+            )
+
+        if operations:
+            await self._db.goods.bulk_write(operations, ordered=False)
+
+        if dirty_groups:
+            await self._db.goods_dirty.bulk_write(
+                [
+                    UpdateOne({"_id": group}, {"$set": {"markedAt": now}}, upsert=True)
+                    for group in dirty_groups
+                ],
+                ordered=False,
+            )
+
+        logger.debug(
+            "Stored product details",
+            changed=len(operations),
+            unchanged=len(details) - len(operations),
+            dirty_groups=len(dirty_groups),
+        )
+
     async def run(
-        self, city_name: str, *, download_images_task_num=10, bucket_name="images"
-    ):
+        self,
+        city_name: str,
+        *,
+        tab_value: str = "hotPush",
+        page_size: int = 10,
+        budget: asyncio.Semaphore | None = None,
+        seen: set[str] | None = None,
+        checkpoint: CrawlCheckpoint | None = None,
+        download_images_task_num=10,
+        bucket_name="images",
+    ) -> CrawlMetrics:
         """
         运行主流程，获取产品列表和详情，下载图片并存储数据
+
+        爬取结果为所有用户共享，不生成带推广参数的短链接，短链接由bind_short_urls为每个用户生成。
+        每页完成后保存检查点，中断后再次运行时从检查点继续；待下载的图片保存在持久化队列中，
+        中断后由resume_images继续下载。
         
         参数:
             city_name: 城市名称
+            tab_value: 商品列表标签，默认为热门推荐
+            page_size: 每页记录数，默认为10
+            budget: 多个分片共用的并发请求预算，为None时不限制
+            seen: 多个分片共用的已获取productId集合，已获取的产品不再重复获取详情
+            checkpoint: 分片的检查点，为None时不保存进度
             download_images_task_num: 图片下载任务的并发数，默认为10
             bucket_name: MinIO中的桶名称，默认为"images"
+
+        返回:
+            CrawlMetrics: 本次爬取的进度和吞吐量
+
+        异常:
+            ApiError: 连续多页的产品详情全部获取失败，检查点保留，下次从中断处继续
         """
-        # 创建图片下载队列
+        metrics = CrawlMetrics(shard=f"{city_name}:{tab_value}")
+        # 创建图片下载队列，上次未完成的图片由resume_images在每轮爬取开始时统一下载
         images_queue = asyncio.Queue()
+
         # 创建多个图片下载任务
         download_images_tasks = [
             asyncio.create_task(
@@ -186,58 +346,93 @@ class CtripApi:
             )
             for _ in range(download_images_task_num)
         ]
-        page = 1
-        async with ClientSession(cookies=self._cookies) as session:
-            # 循环获取所有页的产品列表，当没有更多产品时退出
-            while products := await self.get_product_list(session, page, city_name):
-                logger.info(f"Collecting page {page}")
-                page += 1
-
-                # 为每个产品创建获取详情的任务
-                find_details_tasks = [
-                    self.find_product_detail(session, product["productId"])
-                    for product in products
-                ]
 
-                # 并发获取所有产品详情
-                responses = await asyncio.gather(
-                    *find_details_tasks, return_exceptions=True
-                )
+        state = await checkpoint.load() if checkpoint else None
+        page = state["page"] + 1 if state else 1
+        pending: list[str] = list(state["pending"]) if state else []
+        if state:
+            logger.info(
+                "Resuming crawl from checkpoint",
+                shard=metrics.shard,
+                page=page,
+                pending=len(pending),
+            )
+
+        try:
+            async with ClientSession(cookies=self._cookies) as session:
+
+                async def collect(product_ids: list[str]) -> list[str]:
+                    return await self._collect(
+                        session,
+                        product_ids,
+                        images_queue,
+                        metrics,
+                        budget=budget,
+                        bucket_name=bucket_name,
+                    )
+
+                # 先获取上次中断时尚未保存的产品详情
+                if pending:
+                    pending = await collect(pending)
 
-                store_details_tasks = []
+                streak = 0
+                # 循环获取所有页的产品列表，当没有更多产品时退出
+                while products := await self._limited(
+                    budget,
+                    self.get_product_list(
+                        session, page, city_name, tab_value=tab_value, page_size=page_size
+                    ),
+                ):
+                    logger.info(f"Collecting page {page}", shard=metrics.shard)
+                    metrics.pages += 1
+                    metrics.products += len(products)
 
-                # 处理每个产品的详情
-                for response in responses:
-                    if isinstance(response, BaseException):
-                        logger.warn("Exception, skip.")
-                        continue
+                    # 跳过其它分片已获取的产品
+                    if seen is not None:
+                        fresh = [p for p in products if p["productId"] not in seen]
+                        metrics.duplicates += len(products) - len(fresh)
+                        seen.update(product["productId"] for product in fresh)
+                        products = fresh
 
-                    if "productDetail" not in response:
-                        logger.info("Not found the product details, skip.")
-                        continue
+                    product_ids = [product["productId"] for product in products]
+                    if checkpoint:
+                        await checkpoint.save(page - 1, pending + product_ids)
 
-                    response = response["productDetail"]
-                    # 将产品的所有图片URL加入下载队列
-                    for img_url in response["imgList"]:
-                        await images_queue.put(img_url)
+                    failed = await collect(product_ids)
+                    pending += failed
+                    if checkpoint:
+                        await checkpoint.save(page, pending)
 
-                    # 创建短链接
-                    response["shortUrl"] = await self.create_short_url(
-                        session, response["skipUrl"]
+                    # 连续多页全部失败时中止爬取，保留检查点等待下次继续
+                    streak = streak + 1 if product_ids and failed == product_ids else 0
+                    if streak >= self.ERROR_STREAK:
+                        raise ApiError(
+                            f"Product details failed on {streak} consecutive pages"
+                        )
+
+                    page += 1
+                    metrics.tick()
+                    logger.debug(
+                        "Shard progress",
+                        throughput=metrics.throughput,
+                        **metrics.model_dump(),
                     )
 
-                    # 创建数据库更新任务
-                    task = self._db.goods.update_one(
-                        {
-                            "productId": response["productId"],
-                        },
-                        {"$set": response},
-                        upsert=True,  # 不存在则插入
+                # 重试获取失败的产品详情一次
+                if pending and (pending := await collect(pending)):
+                    logger.warn(
+                        "Dropped products whose details could not be fetched",
+                        shard=metrics.shard,
+                        count=len(pending),
                     )
-                    store_details_tasks.append(task)
+        except BaseException:
+            # 未完成的图片保留在持久化队列中，下次爬取时继续下载
+            for task in download_images_tasks:
+                task.cancel()
+            raise
 
-                # 并发执行所有数据库更新任务
-                await asyncio.gather(*store_details_tasks, return_exceptions=True)
+        if checkpoint:
+            await checkpoint.clear()
 
         logger.info("Waiting for download images tasks to complete...")
 
@@ -249,4 +444,148 @@ class CtripApi:
         await images_queue.join()
         await asyncio.gather(*download_images_tasks)
 
-        logger.info("All tasks completed.")
+        metrics.tick()
+        logger.info(
+            "All tasks completed.", throughput=metrics.throughput, **metrics.model_dump()
+        )
+        return metrics
+
+    async def _collect(
+        self,
+        session: ClientSession,
+        product_ids: list[str],
+        images_queue: asyncio.Queue,
+        metrics: CrawlMetrics,
+        *,
+        budget: asyncio.Semaphore | None,
+        bucket_name: str,
+    ) -> list[str]:
+        """
+        获取并保存一批产品的详情，并将产品图片加入下载队列
+
+        参数:
+            session: aiohttp客户端会话
+            product_ids: 产品ID列表
+            images_queue: 图片下载队列
+            metrics: 爬取统计
+            budget: 并发请求预算
+            bucket_name: MinIO中的桶名称
+
+        返回:
+            list[str]: 获取详情失败的产品ID
+        """
+        # 并发获取所有产品详情
+        responses = await asyncio.gather(
+            *(
+                self._limited(budget, self.find_product_detail(session, product_id))
+                for product_id in product_ids
+            ),
+            return_exceptions=True,
+        )
+
+        details = []
+        failed = []
+
+        # 处理每个产品的详情
+        for product_id, response in zip(product_ids, responses):
+            if isinstance(response, BaseException):
+                logger.warn("Exception, skip.", productId=product_id)
+                metrics.errors += 1
+                failed.append(product_id)
+                continue
+
+            if "productDetail" not in response:
+                logger.info("Not found the product details, skip.")
+                continue
+
+            details.append(response["productDetail"])
+
+        # 将产品的所有图片URL加入持久化队列和下载队列
+        images = [img_url for detail in details for img_url in detail["imgList"]]
+        await self._image_queue.put_many(images, bucket_name=bucket_name)
+        for img_url in images:
+            await images_queue.put(img_url)
+        metrics.images += len(images)
+
+        # 保存产品详情，并标记内容发生变化的分组
+        await self._store_details(details)
+        metrics.details += len(details)
+        return failed
+
+    @staticmethod
+    async def _limited(budget: asyncio.Semaphore | None, aw):
+        """
+        在并发请求预算内等待请求完成
+
+        参数:
+            budget: 并发请求预算，为None时不限制
+            aw: 请求协程
+
+        返回:
+            请求的结果
+        """
+        if budget is None:
+            return await aw
+
+        async with budget:
+            return await aw
+
+    async def bind_short_urls(
+        self, store: ShortUrlStore, *, concurrency: int = 5, batch_size: int = 50
+    ) -> int:
+        """
+        为尚未生成短链接的共享商品生成带有该用户推广参数的短链接
+
+        参数:
+            store: 该用户的短链接存储
+            concurrency: 并发创建短链接的请求数
+            batch_size: 每批保存的短链接数
+
+        返回:
+            int: 生成的短链接数量
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def create(session: ClientSession, good: dict) -> dict | None:
+            async with semaphore:
+                try:
+                    short_url = await self.create_short_url(session, good["skipUrl"])
+                except Exception as e:
+                    logger.warn(
+                        "Failed to create short url",
+                        productId=good["productId"],
+                        error=str(e),
+                    )
+                    return None
+
+            if not short_url:
+                return None
+            return {**good, "shortUrl": short_url}
+
+        created = 0
+        batch = []
+        async with ClientSession(cookies=self._cookies) as session:
+
+            async def flush():
+                nonlocal created
+                short_urls = [
+                    short_url
+                    for short_url in await asyncio.gather(
+                        *(create(session, good) for good in batch)
+                    )
+                    if short_url is not None
+                ]
+                await store.put_many(short_urls)
+                created += len(short_urls)
+                batch.clear()
+
+            async for good in store.missing(batch_size=batch_size):
+                batch.append(good)
+                if len(batch) == batch_size:
+                    await flush()
+
+            if batch:
+                await flush()
+
+        logger.info("Short urls bound", created=created)
+        return created
@@ -4,3 +4,7 @@ class ApiError(Exception):
 
     def __str__(self) -> str:
         return self.message
+
+
+class MediaRejectedError(ApiError):
+    """发布时商品图片（媒体记录）被拒绝，重新上传图片后可以重试"""
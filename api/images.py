@@ -0,0 +1,122 @@
+import asyncio
+from hashlib import md5
+from io import BytesIO
+
+import structlog
+from minio import Minio, S3Error
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class ImageStore:
+    """
+    内容寻址图片存储。
+
+    图片在MinIO中以内容MD5命名，每张图片只保存一次；
+    image_aliases集合记录URL文件名到内容哈希的映射，相同图片以不同URL出现时只增加一条别名。
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase, minio: Minio | None = None) -> None:
+        """
+        初始化图片存储
+
+        参数:
+            db: MongoDB异步数据库实例，用于保存别名表
+            minio: MinIO客户端实例，只做别名解析时可以为None
+        """
+        self._db = db
+        self._minio = minio
+
+    @staticmethod
+    def alias_of(img_url: str) -> str:
+        """
+        从图片URL中提取别名（URL路径的最后一段）
+
+        参数:
+            img_url: 图片URL
+
+        返回:
+            str: 图片别名
+        """
+        return img_url.split("/")[-1]
+
+    async def lookup(self, name: str) -> str | None:
+        """
+        查询别名对应的内容哈希
+
+        参数:
+            name: 图片别名
+
+        返回:
+            str | None: 内容哈希，不存在时返回None
+        """
+        alias = await self._db.image_aliases.find_one({"name": name}, {"hash": 1})
+        return alias["hash"] if alias else None
+
+    async def put(
+        self,
+        name: str,
+        data: bytes,
+        *,
+        url: str | None = None,
+        bucket_name="images",
+        content_type="image/jpeg",
+    ) -> str:
+        """
+        按内容哈希保存图片，并记录别名
+
+        参数:
+            name: 图片别名
+            data: 图片二进制数据
+            url: 图片原始URL，仅作记录
+            bucket_name: MinIO中的桶名称，默认为"images"
+            content_type: 图片的MIME类型
+
+        返回:
+            str: 图片内容哈希，同时也是MinIO中的对象名
+        """
+        assert self._minio is not None
+        digest = md5(data).hexdigest()
+
+        try:
+            # 相同内容的图片已经存在则不再重复上传
+            await asyncio.to_thread(self._minio.stat_object, bucket_name, digest)
+        except S3Error as e:
+            if e.code != "NoSuchKey":
+                raise
+
+            await asyncio.to_thread(
+                self._minio.put_object,
+                bucket_name,
+                digest,
+                BytesIO(data),
+                len(data),
+                content_type=content_type,
+            )
+
+        await self._db.image_aliases.update_one(
+            {"name": name},
+            {"$set": {"hash": digest, "url": url}},
+            upsert=True,
+        )
+        return digest
+
+    async def resolve(self, names: list[str]) -> list[str]:
+        """
+        将别名列表解析为去重后的内容哈希列表，保持原有顺序
+
+        没有别名记录的图片（旧数据）保留原名。
+
+        参数:
+            names: 图片别名列表
+
+        返回:
+            list[str]: 去重后的对象名列表
+        """
+        aliases = self._db.image_aliases.find(
+            {"name": {"$in": names}}, {"name": 1, "hash": 1}
+        )
+        mapping = {alias["name"]: alias["hash"] async for alias in aliases}
+
+        return list(dict.fromkeys(mapping.get(name, name) for name in names))
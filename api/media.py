@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+
+import structlog
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class AgisoMediaCache:
+    """
+    Agiso已上传图片缓存。
+
+    以账号和图片内容MD5为键保存Agiso返回的媒体记录，相同图片再次发布时直接复用，
+    被Agiso拒绝或超过有效期的记录会被标记失效并重新上传。
+    """
+
+    def __init__(
+        self,
+        db: AsyncIOMotorDatabase,
+        account: str,
+        *,
+        max_age: timedelta = timedelta(days=30),
+    ) -> None:
+        """
+        初始化缓存
+
+        参数:
+            db: MongoDB异步数据库实例
+            account: 账号标识，不同Agiso账号的媒体记录互不共用
+            max_age: 媒体记录的有效期
+        """
+        self._db = db
+        self._account = account
+        self._max_age = max_age
+
+    async def get(self, digest: str) -> dict | None:
+        """
+        获取图片对应的有效媒体记录
+
+        参数:
+            digest: 图片内容MD5
+
+        返回:
+            dict | None: 媒体记录，不存在或已失效时返回None
+        """
+        media = await self._db.agiso_media.find_one(
+            {
+                "account": self._account,
+                "md5": digest,
+                "valid": True,
+                "uploadedAt": {"$gte": datetime.now() - self._max_age},
+            },
+            {"record": 1},
+        )
+        return media["record"] if media else None
+
+    async def put(self, digest: str, record: dict):
+        """
+        保存图片上传后的媒体记录
+
+        参数:
+            digest: 图片内容MD5
+            record: Agiso返回的媒体记录
+        """
+        await self._db.agiso_media.update_one(
+            {"account": self._account, "md5": digest},
+            {"$set": {"record": record, "valid": True, "uploadedAt": datetime.now()}},
+            upsert=True,
+        )
+
+    async def invalidate(self, digests: list[str]):
+        """
+        将媒体记录标记为失效，下次使用时重新上传
+
+        参数:
+            digests: 图片内容MD5列表
+        """
+        if not digests:
+            return
+
+        await self._db.agiso_media.update_many(
+            {"account": self._account, "md5": {"$in": digests}},
+            {"$set": {"valid": False}},
+        )
+        logger.info("Invalidated Agiso media", account=self._account, count=len(digests))
@@ -0,0 +1,217 @@
+from datetime import datetime, timedelta
+
+import structlog
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class AgisoGoodsMirror:
+    """
+    Agiso商品目录的本地镜像。
+
+    agiso_goods集合保存每个账号在Agiso上的商品，发布和上下架时同步更新，
+    并定期以远程商品列表对账，"是否已上传"的判断由此变为本地索引查询。
+    """
+
+    # 新发布的商品出现在远程列表之前的宽限时间
+    PUBLISH_GRACE = timedelta(minutes=10)
+
+    # 发布商品时需要的items字段
+    ITEM_FIELDS = (
+        "productId",
+        "title",
+        "subName",
+        "copywriterInfo",
+        "price",
+        "imgList",
+        "shortUrls",
+    )
+
+    def __init__(self, db: AsyncIOMotorDatabase, account: str) -> None:
+        """
+        初始化商品镜像
+
+        参数:
+            db: MongoDB异步数据库实例
+            account: 账号标识
+        """
+        self._db = db
+        self._account = account
+
+    async def record_published(self, outer_id: str, goods_id: str | None):
+        """
+        记录发布成功的商品
+
+        参数:
+            outer_id: 商品外部ID，即items中的productId
+            goods_id: Agiso商品ID，发布响应中不包含时为None，等待对账补全
+        """
+        fields = {"online": True, "updatedAt": datetime.now()}
+        if goods_id is not None:
+            fields["goodsId"] = goods_id
+
+        await self._db.agiso_goods.update_one(
+            {"account": self._account, "outerGoodsId": outer_id},
+            {"$set": fields},
+            upsert=True,
+        )
+
+    async def record_status(self, goods_id: str, online: bool):
+        """
+        记录商品上下架状态
+
+        参数:
+            goods_id: Agiso商品ID
+            online: 是否上架
+        """
+        await self._db.agiso_goods.update_one(
+            {"account": self._account, "goodsId": goods_id},
+            {"$set": {"online": online, "updatedAt": datetime.now()}},
+        )
+
+    async def contains(self, outer_id: str) -> bool:
+        """
+        检查商品是否已上传
+
+        参数:
+            outer_id: 商品外部ID
+
+        返回:
+            bool: 已上传返回True
+        """
+        good = await self._db.agiso_goods.find_one(
+            {"account": self._account, "outerGoodsId": outer_id}, {"_id": 1}
+        )
+        return good is not None
+
+    def pending_items(
+        self,
+        limit: int,
+        *,
+        exclude: list[str] | None = None,
+        batch_size: int = 50,
+    ):
+        """
+        查询尚未上传到该账号的商品
+
+        在MongoDB中以$lookup与agiso_goods做反连接，投影和数量限制均在服务端完成。
+
+        参数:
+            limit: 最多返回的商品数量
+            exclude: 需要排除的商品productId列表
+            batch_size: 游标每批返回的文档数
+
+        返回:
+            AsyncIOMotorCommandCursor: 商品游标
+        """
+        match = {"productId": {"$nin": exclude}} if exclude else {}
+        pipeline = [
+            {"$match": match},
+            {
+                "$lookup": {
+                    "from": "agiso_goods",
+                    "localField": "productId",
+                    "foreignField": "outerGoodsId",
+                    "pipeline": [
+                        {"$match": {"account": self._account}},
+                        {"$limit": 1},
+                        {"$project": {"_id": 1}},
+                    ],
+                    "as": "uploaded",
+                }
+            },
+            {"$match": {"uploaded": {"$size": 0}}},
+            {"$project": {field: 1 for field in self.ITEM_FIELDS}},
+            {"$limit": limit},
+        ]
+        return self._db.items.aggregate(pipeline, batchSize=batch_size)
+
+    async def count(self) -> int:
+        """
+        统计账号中的商品数量
+
+        返回:
+            int: 商品数量
+        """
+        return await self._db.agiso_goods.count_documents({"account": self._account})
+
+    async def goods(self) -> list[dict]:
+        """
+        获取账号中所有商品的outerGoodsId和goodsId
+
+        返回:
+            list[dict]: 商品列表
+        """
+        return await self._db.agiso_goods.find(
+            {"account": self._account},
+            {"_id": 0, "outerGoodsId": 1, "goodsId": 1},
+        ).to_list()
+
+    async def stale(self, max_age: timedelta) -> bool:
+        """
+        检查镜像距上次对账是否已超过指定时间
+
+        参数:
+            max_age: 对账间隔
+
+        返回:
+            bool: 需要对账返回True
+        """
+        sync = await self._db.agiso_sync.find_one({"account": self._account})
+        return sync is None or sync["syncedAt"] < datetime.now() - max_age
+
+    async def reconcile(self, goods: list[dict]):
+        """
+        以远程商品列表对账，新增或更新列表中的商品，删除列表中不存在的商品
+
+        参数:
+            goods: Agiso商品列表
+        """
+        synced_at = datetime.now()
+        operations = []
+        for good in goods:
+            if not good.get("goodsId"):
+                continue
+
+            goods_id = str(good["goodsId"])
+            # 没有outerGoodsId的商品（如手动发布的商品）以goodsId为键，只计入商品数量
+            key = (
+                {"outerGoodsId": good["outerGoodsId"]}
+                if good.get("outerGoodsId")
+                else {"goodsId": goods_id}
+            )
+            operations.append(
+                UpdateOne(
+                    {"account": self._account, **key},
+                    {"$set": {"goodsId": goods_id, "data": good, "syncedAt": synced_at}},
+                    upsert=True,
+                )
+            )
+
+        if operations:
+            await self._db.agiso_goods.bulk_write(operations, ordered=False)
+
+        # 删除列表中已不存在的商品，最近发布的商品可能尚未出现在列表中，予以保留
+        removed = await self._db.agiso_goods.delete_many(
+            {
+                "account": self._account,
+                "syncedAt": {"$ne": synced_at},
+                "$or": [
+                    {"updatedAt": {"$lt": synced_at - self.PUBLISH_GRACE}},
+                    {"updatedAt": None},
+                ],
+            }
+        )
+        await self._db.agiso_sync.update_one(
+            {"account": self._account},
+            {"$set": {"syncedAt": synced_at}},
+            upsert=True,
+        )
+        logger.info(
+            "Agiso goods mirror reconciled",
+            account=self._account,
+            goods=len(operations),
+            removed=removed.deleted_count,
+        )
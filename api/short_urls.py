@@ -0,0 +1,110 @@
+from datetime import datetime
+
+import structlog
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class ShortUrlStore:
+    """
+    用户推广短链接。
+
+    商品由所有用户共享爬取，带有allianceId/sid推广参数的短链接因用户而异，
+    以token和productId为键保存在short_urls集合中；商品跳转地址变化时重新生成。
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase, token: str) -> None:
+        """
+        初始化短链接存储
+
+        参数:
+            db: MongoDB异步数据库实例
+            token: 用户认证令牌
+        """
+        self._db = db
+        self._token = token
+
+    async def get(self, product_ids: list[str]) -> dict[str, str]:
+        """
+        获取商品的短链接
+
+        参数:
+            product_ids: 商品productId列表
+
+        返回:
+            dict[str, str]: productId到短链接的映射，不包含尚未生成短链接的商品
+        """
+        return {
+            short_url["productId"]: short_url["shortUrl"]
+            async for short_url in self._db.short_urls.find(
+                {"token": self._token, "productId": {"$in": product_ids}},
+                {"productId": 1, "shortUrl": 1},
+            )
+        }
+
+    def missing(self, *, batch_size: int = 100):
+        """
+        查询尚未为该用户生成短链接，或跳转地址已变化的商品
+
+        参数:
+            batch_size: 游标每批返回的文档数
+
+        返回:
+            AsyncIOMotorCommandCursor: 包含productId和skipUrl的商品游标
+        """
+        pipeline = [
+            {"$match": {"skipUrl": {"$type": "string"}}},
+            {
+                "$lookup": {
+                    "from": "short_urls",
+                    "localField": "productId",
+                    "foreignField": "productId",
+                    "let": {"skipUrl": "$skipUrl"},
+                    "pipeline": [
+                        {
+                            "$match": {
+                                "token": self._token,
+                                "$expr": {"$eq": ["$skipUrl", "$$skipUrl"]},
+                            }
+                        },
+                        {"$limit": 1},
+                        {"$project": {"_id": 1}},
+                    ],
+                    "as": "bound",
+                }
+            },
+            {"$match": {"bound": {"$size": 0}}},
+            {"$project": {"_id": 0, "productId": 1, "skipUrl": 1}},
+        ]
+        return self._db.goods.aggregate(pipeline, batchSize=batch_size)
+
+    async def put_many(self, short_urls: list[dict]):
+        """
+        保存生成的短链接
+
+        参数:
+            short_urls: 短链接列表，每项包含productId、skipUrl和shortUrl
+        """
+        if not short_urls:
+            return
+
+        now = datetime.now()
+        await self._db.short_urls.bulk_write(
+            [
+                UpdateOne(
+                    {"token": self._token, "productId": short_url["productId"]},
+                    {
+                        "$set": {
+                            "skipUrl": short_url["skipUrl"],
+                            "shortUrl": short_url["shortUrl"],
+                            "createdAt": now,
+                        }
+                    },
+                    upsert=True,
+                )
+                for short_url in short_urls
+            ],
+            ordered=False,
+        )
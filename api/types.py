@@ -1,3 +1,4 @@
+import time
 from typing import List, Union
 
 from pydantic import BaseModel, Field
@@ -32,3 +33,43 @@ class Item(BaseModel):
 
     def to_dict(self, merge={}):
         return self.model_dump(by_alias=True) | merge
+
+
+class ImageUploadResult(BaseModel):
+    image: str
+    md5: str | None = None
+    record: dict | None = None
+    cached: bool = False
+    skipped: bool = False
+    error: str | None = None
+
+
+class CrawlMetrics(BaseModel):
+    shard: str
+    pages: int = 0
+    products: int = 0
+    details: int = 0
+    duplicates: int = 0
+    errors: int = 0
+    images: int = 0
+    elapsed: float = 0.0
+    started: float = Field(default_factory=time.monotonic, exclude=True)
+
+    def tick(self):
+        self.elapsed = round(time.monotonic() - self.started, 3)
+
+    @property
+    def throughput(self) -> float:
+        """每秒获取的产品详情数"""
+        return round(self.details / self.elapsed, 2) if self.elapsed else 0.0
+
+
+class ItemUploadResult(BaseModel):
+    outer_id: str | None = None
+    images: List[ImageUploadResult] = []
+    published: bool = False
+    goods_id: str | None = None
+
+    @property
+    def records(self) -> list[dict]:
+        return [image.record for image in self.images if image.record is not None]
@@ -2,12 +2,16 @@ import argparse
 import asyncio
 import os
 
+import dotenv
 import structlog
 from playwright.async_api import async_playwright
 
+from ai.cache import TitleCache
+from db import MongoDB
 from helpers.base import LoginState
 from helpers.ctrip import CtripLoginHelper
 from helpers.goofish import GoofishLoginHelper
+from templates import Template
 
 # 获取结构化日志记录器
 logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
@@ -79,12 +83,64 @@ async def goofish():
         logger.info("Goofish cookies saved successfully")
 
 
+def _connect():
+    """
+    按环境变量MONGO_URI和MONGO_DB连接MongoDB
+
+    Returns:
+        AsyncIOMotorDatabase: MongoDB数据库连接
+    """
+    dotenv.load_dotenv()
+    MONGO_URI = os.getenv("MONGO_URI")
+    MONGO_DB = os.getenv("MONGO_DB")
+    assert MONGO_URI is not None and MONGO_DB is not None
+
+    MongoDB(MONGO_URI, MONGO_DB)
+    return MongoDB.get_db()
+
+
+async def set_template(name: str, path: str):
+    """
+    写入模板。
+
+    模板经Template.set校验格式化字段并递增版本号，运行中的服务在TEMPLATE_CACHE_TTL内读取到新模板。
+
+    Args:
+        name (str): 模板名称，如prompt
+        path (str): 模板内容所在的文本文件
+
+    Returns:
+        None
+    """
+    with open(path, encoding="utf-8") as file:
+        value = file.read()
+
+    template = Template(_connect())
+    await template.set(name, value, upsert=True)
+    logger.info("Template saved", name=name, version=await template.version(name))
+
+
+async def clear_title_cache(model: str | None = None):
+    """
+    清空AI标题缓存。
+
+    修改提示词以外的生成逻辑（如更换模型版本但模型标识不变）后，需要重新生成标题时使用。
+
+    Args:
+        model (str, optional): 只清空指定模型标识的缓存，为None时清空全部
+
+    Returns:
+        None
+    """
+    await TitleCache(_connect()).clear(model)
+
+
 async def main():
     """
     CLI工具的主函数，处理命令行参数并执行相应的操作。
     
     该函数解析命令行参数，根据用户输入的子命令调用对应的登录处理函数。
-    目前支持 'ctrip' 和 'goofish' 两个子命令。
+    目前支持 'ctrip'、'goofish'、'set-template' 和 'clear-title-cache' 四个子命令。
     
     Returns:
         None
@@ -96,6 +152,13 @@ async def main():
     # 添加子命令
     subparsers.add_parser("ctrip", help="Run ctrip command")
     subparsers.add_parser("goofish", help="Run goofish command")
+    template_parser = subparsers.add_parser("set-template", help="Save a template")
+    template_parser.add_argument("name", help="Template name, e.g. prompt")
+    template_parser.add_argument("path", help="Text file with the template")
+    clear_parser = subparsers.add_parser(
+        "clear-title-cache", help="Clear cached AI titles"
+    )
+    clear_parser.add_argument("--model", help="Only clear titles of this model")
 
     # 解析命令行参数
     args = parser.parse_args()
@@ -105,6 +168,10 @@ async def main():
         await ctrip()
     elif args.command == "goofish":
         await goofish()
+    elif args.command == "set-template":
+        await set_template(args.name, args.path)
+    elif args.command == "clear-title-cache":
+        await clear_title_cache(args.model)
 
 
 if __name__ == "__main__":
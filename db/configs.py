@@ -0,0 +1,54 @@
+import copy
+import os
+import time
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+
+class ConfigCache:
+    """
+    用户配置缓存。
+
+    以token为键缓存configs集合中的用户配置，route/config写入配置时调用invalidate清除缓存；
+    其它进程写入的配置在缓存超过CONFIG_CACHE_TTL（秒）后重新读取。
+    """
+
+    # token到（配置，读取时间）的缓存
+    _configs: dict[str, tuple[dict, float]] = {}
+    _max_age = float(os.getenv("CONFIG_CACHE_TTL", 60))
+
+    @classmethod
+    async def get(cls, db: AsyncIOMotorDatabase, token: str) -> dict:
+        """
+        获取用户配置
+
+        参数:
+            db: MongoDB异步数据库实例
+            token: 用户认证令牌
+
+        返回:
+            dict: 配置名称到配置内容的字典，调用方修改返回值不影响缓存
+        """
+        cached = cls._configs.get(token)
+        if cached is None or time.monotonic() - cached[1] >= cls._max_age:
+            built_config = {}
+            async for item in db.configs.find({"token": token}):
+                built_config[item["name"]] = item["value"]
+
+            cached = (built_config, time.monotonic())
+            cls._configs[token] = cached
+
+        return copy.deepcopy(cached[0])
+
+    @classmethod
+    def invalidate(cls, token: str | None = None):
+        """
+        清除配置缓存
+
+        参数:
+            token: 用户认证令牌，为None时清除全部
+        """
+        if token is None:
+            cls._configs.clear()
+        else:
+            cls._configs.pop(token, None)
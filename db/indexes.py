@@ -0,0 +1,103 @@
+import structlog
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+# 各集合需要的索引
+INDEXES: dict[str, list[IndexModel]] = {
+    "image_aliases": [
+        IndexModel([("name", ASCENDING)], unique=True),
+        IndexModel([("hash", ASCENDING)]),
+    ],
+    "agiso_media": [
+        IndexModel([("account", ASCENDING), ("md5", ASCENDING)], unique=True),
+    ],
+    "agiso_goods": [
+        # 没有outerGoodsId的商品（如手动发布的商品）以goodsId为键，不受唯一约束
+        IndexModel(
+            [("account", ASCENDING), ("outerGoodsId", ASCENDING)],
+            name="account_1_outerGoodsId_1_unique",
+            unique=True,
+            partialFilterExpression={"outerGoodsId": {"$exists": True}},
+        ),
+        IndexModel([("account", ASCENDING), ("goodsId", ASCENDING)]),
+    ],
+    "goods": [
+        IndexModel([("productId", ASCENDING)]),
+        IndexModel([("subName", ASCENDING), ("productId", ASCENDING)]),
+    ],
+    "items": [
+        IndexModel([("productId", ASCENDING)]),
+    ],
+    "title_cache": [
+        IndexModel([("expiresAt", ASCENDING)], expireAfterSeconds=0),
+        IndexModel([("model", ASCENDING)]),
+    ],
+    "agiso_sync": [
+        IndexModel([("account", ASCENDING)], unique=True),
+    ],
+    "image_queue": [
+        IndexModel([("bucket", ASCENDING), ("attempts", ASCENDING)]),
+        # 达到最多尝试次数（ImageQueue.MAX_ATTEMPTS）的图片不再重试，7天后清除
+        IndexModel(
+            [("failedAt", ASCENDING)],
+            expireAfterSeconds=7 * 24 * 3600,
+            partialFilterExpression={"attempts": {"$gte": 3}},
+        ),
+    ],
+    "short_urls": [
+        IndexModel([("token", ASCENDING), ("productId", ASCENDING)], unique=True),
+        IndexModel([("productId", ASCENDING)]),
+    ],
+    "chats": [
+        IndexModel([("sessionId", ASCENDING), ("messageId", ASCENDING)], unique=True),
+    ],
+    "jobs": [
+        IndexModel(
+            [("pendingKey", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"pendingKey": {"$exists": True}},
+        ),
+        IndexModel([("type", ASCENDING), ("status", ASCENDING), ("runAt", ASCENDING)]),
+        # 已完成和失败的任务保留30天，排队和执行中的任务没有finishedAt，不会过期
+        IndexModel([("finishedAt", ASCENDING)], expireAfterSeconds=30 * 24 * 3600),
+    ],
+    "schedules": [
+        IndexModel([("nextRunAt", ASCENDING)]),
+    ],
+    "runs": [
+        IndexModel([("token", ASCENDING), ("startedAt", DESCENDING)]),
+        IndexModel([("startedAt", ASCENDING)], expireAfterSeconds=30 * 24 * 3600),
+    ],
+    "uploads": [
+        IndexModel([("token", ASCENDING), ("cycle", ASCENDING)]),
+        IndexModel([("token", ASCENDING), ("productId", ASCENDING)]),
+        # 发布结果保留30天
+        IndexModel([("at", ASCENDING)], expireAfterSeconds=30 * 24 * 3600),
+    ],
+}
+
+# 已被替换的索引，创建索引前删除
+OBSOLETE_INDEXES: dict[str, list[str]] = {
+    "agiso_goods": ["account_1_outerGoodsId_1"],
+}
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase):
+    """
+    创建所有集合所需的索引，已存在的索引不会重复创建
+
+    参数:
+        db: MongoDB异步数据库实例
+    """
+    for collection, names in OBSOLETE_INDEXES.items():
+        existing = await db[collection].index_information()
+        for name in names:
+            if name in existing:
+                await db[collection].drop_index(name)
+                logger.info("Obsolete index dropped", collection=collection, index=name)
+
+    for collection, indexes in INDEXES.items():
+        await db[collection].create_indexes(indexes)
+        logger.info("Indexes ensured", collection=collection, count=len(indexes))
@@ -0,0 +1,239 @@
+import hashlib
+import json
+from collections import deque
+from typing import Any, Iterable
+
+import structlog
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+# 默认参与关键词匹配的商品字段
+DEFAULT_FIELDS = ("subName", "copywriterInfo", "title")
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick多模式匹配自动机。
+
+    一次构建后，对任意文本的匹配只需扫描文本一遍，耗时与关键词数量无关。
+    """
+
+    def __init__(self, keywords: Iterable[str]) -> None:
+        """
+        构建自动机
+
+        参数:
+            keywords: 关键词列表，空字符串会被忽略
+        """
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[str | None] = [None]
+
+        for keyword in keywords:
+            if keyword:
+                self._add(keyword)
+        self._build()
+
+    def __len__(self) -> int:
+        return sum(1 for output in self._output if output is not None)
+
+    def _add(self, keyword: str):
+        """
+        将关键词加入字典树
+
+        参数:
+            keyword: 关键词
+        """
+        node = 0
+        for char in keyword:
+            if char not in self._goto[node]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+                self._goto[node][char] = len(self._goto) - 1
+            node = self._goto[node][char]
+        self._output[node] = keyword
+
+    def _build(self):
+        """
+        按广度优先顺序计算失败指针，并让每个节点继承失败指针上的匹配结果
+        """
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+
+                # 自身不是关键词结尾时，沿失败指针继承最长的后缀关键词
+                if self._output[child] is None:
+                    self._output[child] = self._output[self._fail[child]]
+                queue.append(child)
+
+    def search(self, text: str) -> str | None:
+        """
+        查找文本中出现的第一个关键词
+
+        参数:
+            text: 待匹配文本
+
+        返回:
+            str | None: 匹配到的关键词，没有匹配时返回None
+        """
+        node = 0
+        for char in text:
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+
+            if self._output[node] is not None:
+                return self._output[node]
+
+        return None
+
+
+class ItemFilter:
+    """
+    商品关键词过滤器。
+
+    排除关键词命中任一目标字段的商品会被过滤；设置了包含关键词时，商品必须命中至少一个。
+    关键词可写成"字段:关键词"只匹配指定字段，否则匹配所有默认字段。
+    """
+
+    def __init__(
+        self,
+        exclude: Iterable[str] = (),
+        include: Iterable[str] = (),
+        *,
+        fields: Iterable[str] = DEFAULT_FIELDS,
+    ) -> None:
+        """
+        编译过滤器
+
+        参数:
+            exclude: 排除关键词列表
+            include: 包含关键词列表
+            fields: 默认参与匹配的商品字段
+        """
+        self._fields = tuple(fields)
+        self._exclude = self._compile(exclude)
+        self._include = self._compile(include)
+
+    def _compile(self, keywords: Iterable[str]) -> dict[str, KeywordAutomaton]:
+        """
+        按目标字段分组关键词，并为每个字段构建自动机
+
+        参数:
+            keywords: 关键词列表
+
+        返回:
+            dict[str, KeywordAutomaton]: 字段名到自动机的映射
+        """
+        grouped: dict[str, list[str]] = {}
+        for keyword in keywords:
+            field, sep, word = keyword.partition(":")
+            if sep and field in self._fields:
+                grouped.setdefault(field, []).append(word)
+            else:
+                for field in self._fields:
+                    grouped.setdefault(field, []).append(keyword)
+
+        return {
+            field: automaton
+            for field, words in grouped.items()
+            if len(automaton := KeywordAutomaton(words))
+        }
+
+    @staticmethod
+    def _search(automata: dict[str, KeywordAutomaton], item: dict) -> str | None:
+        """
+        在商品各字段中查找关键词
+
+        参数:
+            automata: 字段名到自动机的映射
+            item: 商品信息
+
+        返回:
+            str | None: 匹配到的关键词
+        """
+        for field, automaton in automata.items():
+            if keyword := automaton.search(str(item.get(field) or "")):
+                return keyword
+        return None
+
+    def reject_reason(self, item: dict) -> str | None:
+        """
+        检查商品是否应被过滤
+
+        参数:
+            item: 商品信息
+
+        返回:
+            str | None: 被过滤的原因，商品通过过滤时返回None
+        """
+        if keyword := self._search(self._exclude, item):
+            return f"matched keyword {keyword}"
+
+        if self._include and not self._search(self._include, item):
+            return "matched no include keyword"
+
+        return None
+
+    def accepts(self, item: dict) -> bool:
+        """
+        检查商品是否通过过滤
+
+        参数:
+            item: 商品信息
+
+        返回:
+            bool: 通过过滤返回True
+        """
+        return self.reject_reason(item) is None
+
+
+# 按过滤配置指纹缓存已编译的过滤器
+_compiled: dict[str, ItemFilter] = {}
+_COMPILED_LIMIT = 128
+
+
+def compile_filter(config: dict[str, Any] | None) -> ItemFilter | None:
+    """
+    根据过滤配置获取编译好的过滤器，相同配置只编译一次
+
+    参数:
+        config: 过滤配置，即名为filter的配置项
+
+    返回:
+        ItemFilter | None: 过滤器，未启用过滤或没有关键词时返回None
+    """
+    if not config or not config.get("keywords_filter_enabled"):
+        return None
+
+    exclude = config.get("keywords_filter") or []
+    include = config.get("keywords_include") or []
+    if not exclude and not include:
+        return None
+
+    fields = config.get("fields") or DEFAULT_FIELDS
+    fingerprint = hashlib.md5(
+        json.dumps([exclude, include, fields], ensure_ascii=False).encode()
+    ).hexdigest()
+
+    if (item_filter := _compiled.get(fingerprint)) is None:
+        if len(_compiled) >= _COMPILED_LIMIT:
+            _compiled.pop(next(iter(_compiled)))
+
+        item_filter = _compiled[fingerprint] = ItemFilter(
+            exclude, include, fields=fields
+        )
+        logger.info(
+            "Compiled keyword filter",
+            exclude=len(exclude),
+            include=len(include),
+            fields=fields,
+        )
+
+    return item_filter
@@ -1,7 +1,7 @@
 from enum import Enum
 from pathlib import Path
 
-from playwright.async_api import Playwright
+from playwright.async_api import Browser, Playwright
 
 from .error import LoginHelperError
 
@@ -24,18 +24,29 @@ class LoginHelper:
         self._playwright = playwright
         self._initialized = False
 
-    async def init(self, headless: bool = False, *, cookies=None):
+    async def init(
+        self,
+        headless: bool = False,
+        *,
+        cookies=None,
+        browser: Browser | None = None,
+    ):
         """
         初始化浏览器环境。
         
         Args:
             headless (bool, optional): 是否使用无头模式。默认为 False。
             cookies (list, optional): 要添加的 cookies 列表。默认为 None。
+            browser (Browser, optional): 共享的浏览器进程，提供时在其中创建独立的上下文，
+                不再启动新的浏览器。默认为 None。
             
         Note:
             在使用其他方法前必须先调用此方法。
         """
-        self._browser = await self._playwright.chromium.launch(headless=headless)
+        self._owns_browser = browser is None
+        self._browser = browser or await self._playwright.chromium.launch(
+            headless=headless
+        )
         self._context = await self._browser.new_context()
 
         if cookies is not None:
@@ -74,6 +85,18 @@ class LoginHelper:
 
         await self._context.storage_state(path=path)
 
+    async def close(self):
+        """
+        关闭浏览器上下文，浏览器由本实例启动时一并关闭。
+        """
+        if not self._initialized:
+            return
+
+        await self._context.close()
+        if self._owns_browser:
+            await self._browser.close()
+        self._initialized = False
+
     def _check_initialized(self):
         """
         检查是否已初始化。
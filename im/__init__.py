@@ -5,8 +5,11 @@ from urllib.parse import parse_qs, urlparse
 import structlog
 from aiohttp import ClientSession
 from motor.motor_asyncio import AsyncIOMotorDatabase
-from playwright.async_api import Playwright, Route
+from playwright.async_api import Browser, Playwright, Route
+from pymongo.errors import DuplicateKeyError
 
+from api.short_urls import ShortUrlStore
+from db.configs import ConfigCache
 from helpers.base import LoginHelper, LoginState
 
 from .types import IMContext, IMTask, IMTaskType
@@ -43,19 +46,28 @@ class GoofishIM(LoginHelper):
         self._task_queue: asyncio.Queue[IMTask | None] = asyncio.Queue()
         self._initialized_users = False
         self._received: set[tuple[str, int]] = set()
+        self._inflight: dict[asyncio.Task, tuple[str, int]] = {}
+        self._since: int | None = None
         self._token = token
         logger.info("GoofishIM instance created", token_provided=token is not None)
 
-    async def init(self, headless: bool = False, *, cookies=None):
+    async def init(
+        self,
+        headless: bool = False,
+        *,
+        cookies=None,
+        browser: Browser | None = None,
+    ):
         """
         初始化浏览器环境和页面。
         
         参数:
             headless: 是否使用无头模式运行浏览器
             cookies: 可选的cookie列表，若提供则会覆盖实例化时的cookies
+            browser: 共享的浏览器进程，提供时在其中创建独立的上下文
         """
-        logger.info("Initializing GoofishIM", headless=headless)
-        await super().init(headless, cookies=cookies)
+        logger.info("Initializing GoofishIM", headless=headless, shared=browser is not None)
+        await super().init(headless, cookies=cookies, browser=browser)
 
         await self._context.add_cookies(cookies=self._cookies)
         logger.debug("Cookies added to browser context")
@@ -70,15 +82,22 @@ class GoofishIM(LoginHelper):
         await self._page.goto("https://www.goofish.com/im", wait_until="networkidle")
         logger.info("Navigation to Goofish IM complete")
 
-    async def start(self):
+    async def start(self, *, pending=(), since: int | None = None):
         """
         启动咸鱼IM服务，开始监听和处理消息。
         
-        创建任务执行器、消息接收处理器和登录状态检查器。
+        创建任务执行器、消息接收处理器和登录状态检查器。会话切换时由上一个实例交接
+        尚未回复的会话，以及切换开始的时间，此后收到的消息即使在加载历史消息期间也会回复。
+        
+        参数:
+            pending: 上一个实例尚未回复的(会话ID, 发送者ID)列表
+            since: 切换开始的时间戳（毫秒）
         """
-        logger.info("Starting GoofishIM service")
+        logger.info("Starting GoofishIM service", pending=len(pending))
+        self._since = since
         await self._click_all_users()
         self._initialized_users = True
+        self._received.update((session_id, sender_id) for session_id, sender_id in pending)
         self._task_executor_task = asyncio.create_task(self._task_executor())
         self._on_received_task = asyncio.create_task(self._on_received())
         self._check_login_state_task = asyncio.create_task(self._check_login_state())
@@ -92,14 +111,80 @@ class GoofishIM(LoginHelper):
         """
         停止咸鱼IM服务，清理资源。
         
-        终止任务队列处理、消息接收任务，并关闭浏览器。
+        终止任务队列处理、消息接收任务，并关闭浏览器上下文；共享的浏览器进程不会被关闭。
         """
         logger.info("Stopping GoofishIM service")
         await self._task_queue.put(None)
         self._on_received_task.cancel()
-        await self._playwright.stop()
+        self._check_login_state_task.cancel()
+        await self.close()
         logger.info("GoofishIM service stopping tasks completed")
 
+    async def handover(self, timeout: float = 20) -> list[tuple[str, int]]:
+        """
+        停止IM服务并交出尚未回复的会话，用于会话切换。
+        
+        停止接收和排队新任务，尚在等待的会话直接交出，正在生成回复的会话等待完成，
+        超时未完成的也交出；关闭页面后收到的消息一并交出。
+        
+        参数:
+            timeout: 等待正在生成的回复完成的时间（秒）
+            
+        返回:
+            list[tuple[str, int]]: 尚未回复的(会话ID, 发送者ID)列表
+        """
+        logger.info("Handing over GoofishIM session", inflight=len(self._inflight))
+        self._on_received_task.cancel()
+        self._check_login_state_task.cancel()
+        self._task_executor_task.cancel()
+
+        pending: set[tuple[str, int]] = set()
+        while not self._task_queue.empty():
+            if (task := self._task_queue.get_nowait()) is not None:
+                pending.add(self._task_key(task))
+
+        replying = []
+        for task, key in list(self._inflight.items()):
+            if task.get_name().startswith("sleep:"):
+                task.cancel()
+                pending.add(key)
+            else:
+                replying.append(task)
+
+        if replying:
+            _, timed_out = await asyncio.wait(replying, timeout=timeout)
+            for task in timed_out:
+                pending.add(self._inflight[task])
+                task.cancel()
+            if timed_out:
+                logger.warning("Replies not finished before handover", count=len(timed_out))
+
+        await self.close()
+        pending.update(self._received)
+        self._received.clear()
+        return sorted(pending)
+
+    async def metrics(self) -> dict[str, int]:
+        """
+        通过CDP读取IM页面的性能指标。
+        
+        返回:
+            dict[str, int]: JS堆使用量（字节）、DOM节点数和事件监听器数
+        """
+        session = await self._context.new_cdp_session(self._page)
+        try:
+            await session.send("Performance.enable")
+            result = await session.send("Performance.getMetrics")
+        finally:
+            await session.detach()
+
+        metrics = {metric["name"]: metric["value"] for metric in result["metrics"]}
+        return {
+            "heap": int(metrics.get("JSHeapUsedSize", 0)),
+            "nodes": int(metrics.get("Nodes", 0)),
+            "listeners": int(metrics.get("JSEventListeners", 0)),
+        }
+
     async def send_message(self, userId: str, message: str):
         """
         向特定用户发送文本消息。
@@ -132,18 +217,12 @@ class GoofishIM(LoginHelper):
         """
         从数据库构建配置对象。
         
-        根据当前token从数据库获取配置项。
+        根据当前token从数据库获取配置项，配置缓存在进程内，修改配置时清除。
         
         返回:
             dict: 包含配置项的字典
         """
-        config = self._db.configs.find({"token": self._token})
-        built_config = {}
-
-        async for item in config:
-            built_config[item["name"]] = item["value"]
-
-        return built_config
+        return await ConfigCache.get(self._db, self._token)
 
     async def _on_received(self):
         """
@@ -225,9 +304,18 @@ class GoofishIM(LoginHelper):
             logger.info(
                 "Found target item", item_id=item_id, item_found=item is not None
             )
+            # 短链接带有用户的推广参数，按token获取，旧数据回退到商品中保存的短链接
+            short_urls = (
+                await ShortUrlStore(self._db, self._token).get(
+                    [s["productId"] for s in item["shortUrls"] if s.get("productId")]
+                )
+                if self._token
+                else {}
+            )
             format_set["information"] = "\n".join(
                 [
-                    f"{short_url['description']}\n{short_url['shortUrl']}"
+                    f"{short_url['description']}\n"
+                    f"{short_urls.get(short_url.get('productId'), short_url.get('shortUrl', ''))}"
                     for short_url in item["shortUrls"]
                 ]
             )
@@ -273,7 +361,13 @@ class GoofishIM(LoginHelper):
                         task_type=task.type_,
                         context=task.context,
                     )
-                    asyncio.create_task(self._sleep_task(context=task.context))
+                    self._track(
+                        asyncio.create_task(
+                            self._sleep_task(context=task.context),
+                            name=f"sleep:{task.context.sender}",
+                        ),
+                        task,
+                    )
                 case IMTaskType.SENDMSG:
                     logger.info(
                         "Executing send message task",
@@ -292,7 +386,30 @@ class GoofishIM(LoginHelper):
                         task_type=task.type_,
                         context=task.context,
                     )
-                    asyncio.create_task(self._ai_model_task(context=task.context))
+                    self._track(
+                        asyncio.create_task(
+                            self._ai_model_task(context=task.context),
+                            name=f"reply:{task.context.sender}",
+                        ),
+                        task,
+                    )
+
+    def _track(self, running: asyncio.Task, task: IMTask):
+        """
+        记录尚未完成的休眠和回复任务，会话切换时交出
+        """
+        self._inflight[running] = self._task_key(task)
+        running.add_done_callback(lambda done: self._inflight.pop(done, None))
+
+    @staticmethod
+    def _task_key(task: IMTask) -> tuple[str, int]:
+        """
+        任务对应的(会话ID, 发送者ID)
+        """
+        context = task.context
+        if task.type_ == IMTaskType.SLEEP and context.next_task is not None:
+            context = context.next_task.context
+        return (context.session_id, context.sender)
 
     async def _chat_history(self, session_id: str):
         """
@@ -408,19 +525,24 @@ class GoofishIM(LoginHelper):
             #     is_my_message=chat["isMyMsg"],
             # )
 
-            existing_message = await self._db.chats.find_one(
-                {
-                    "sessionId": chat["sessionId"],
-                    "senderId": chat["senderId"],
-                    "messageId": chat["messageId"],
-                }
-            )
+            # 原子地保存消息，会话切换或进程交接期间两个页面同时收到同一条消息时只有一个回复
+            try:
+                result = await self._db.chats.update_one(
+                    {"sessionId": chat["sessionId"], "messageId": chat["messageId"]},
+                    {"$setOnInsert": chat},
+                    upsert=True,
+                )
+            except DuplicateKeyError:
+                # 另一个页面同时插入了这条消息，由它回复
+                return
 
-            if existing_message:
+            if result.upserted_id is None:
                 # logger.debug("Message already exists in database, skipping", message_id=chat["messageId"])
                 return
 
-            if self._initialized_users and not chat["isMyMsg"]:
+            # 加载历史消息期间不回复，会话切换开始后收到的消息除外
+            switching = self._since is not None and chat["timeStamp"] >= self._since
+            if (self._initialized_users or switching) and not chat["isMyMsg"]:
                 self._received.add((chat["sessionId"], chat["senderId"]))
                 logger.info(
                     "Added message to received queue",
@@ -428,11 +550,6 @@ class GoofishIM(LoginHelper):
                     sender_id=chat["senderId"],
                 )
 
-            await self._db.chats.update_one(
-                {"sessionId": chat["sessionId"], "messageId": chat["messageId"]},
-                {"$set": chat},
-                upsert=True,
-            )
             # logger.info("Saved new message to database",
             #            session_id=chat["sessionId"],
             #            sender_id=chat["senderId"],
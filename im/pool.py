@@ -0,0 +1,198 @@
+import asyncio
+import os
+
+import structlog
+from playwright.async_api import Browser, Playwright
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class BrowserPoolError(Exception):
+    """浏览器池中所有浏览器进程的上下文都已用完"""
+
+
+class BrowserPool:
+    """
+    共享的Chromium进程池。
+
+    多个IM账号在同一个浏览器进程中各自使用独立的上下文（cookie和存储互相隔离），
+    每个进程最多承载contexts_per_browser个上下文。新账号分配到上下文最少的进程，
+    进程在首次使用时启动，最后一个上下文释放后关闭，崩溃的进程在下次分配时重新启动。
+    """
+
+    def __init__(
+        self,
+        playwright: Playwright,
+        *,
+        browsers: int | None = None,
+        contexts_per_browser: int | None = None,
+        headless: bool | None = None,
+    ) -> None:
+        """
+        初始化浏览器池
+
+        参数:
+            playwright: Playwright实例
+            browsers: 浏览器进程数，默认为CPU核数乘以IM_BROWSERS_PER_CORE
+            contexts_per_browser: 每个浏览器进程的上下文数，默认读取IM_CONTEXTS_PER_BROWSER
+            headless: 是否使用无头模式，默认读取IM_HEADLESS
+        """
+        if browsers is None:
+            per_core = float(os.getenv("IM_BROWSERS_PER_CORE", 1))
+            browsers = int(per_core * (os.cpu_count() or 1))
+        if contexts_per_browser is None:
+            contexts_per_browser = int(os.getenv("IM_CONTEXTS_PER_BROWSER", 20))
+        if headless is None:
+            headless = os.getenv("IM_HEADLESS", "false").lower() == "true"
+
+        self._playwright = playwright
+        self._contexts_per_browser = max(1, contexts_per_browser)
+        self._headless = headless
+        self._browsers: list[Browser | None] = [None] * max(1, browsers)
+        self._tokens: list[set[str]] = [set() for _ in self._browsers]
+        self._lock = asyncio.Lock()
+
+    @property
+    def playwright(self) -> Playwright:
+        """浏览器池使用的Playwright实例"""
+        return self._playwright
+
+    @property
+    def capacity(self) -> int:
+        """浏览器池最多承载的上下文数"""
+        return len(self._browsers) * self._contexts_per_browser
+
+    async def acquire(self, token: str) -> Browser:
+        """
+        为账号分配浏览器进程
+
+        参数:
+            token: 用户token
+
+        返回:
+            Browser: 分配的浏览器进程，账号已分配时返回同一个进程
+
+        异常:
+            BrowserPoolError: 所有浏览器进程的上下文都已用完
+        """
+        async with self._lock:
+            index = self.shard_of(token)
+            if index is None:
+                index = min(range(len(self._tokens)), key=lambda i: len(self._tokens[i]))
+                if len(self._tokens[index]) >= self._contexts_per_browser:
+                    raise BrowserPoolError(f"all {self.capacity} contexts in use")
+
+            browser = self._browsers[index]
+            if browser is None or not browser.is_connected():
+                browser = await self._playwright.chromium.launch(headless=self._headless)
+                self._browsers[index] = browser
+                logger.info("Browser launched", shard=index, contexts=len(self._tokens[index]))
+
+            self._tokens[index].add(token)
+            return browser
+
+    async def release(self, token: str):
+        """
+        释放账号的上下文，浏览器进程不再承载任何上下文时关闭
+
+        参数:
+            token: 用户token
+        """
+        async with self._lock:
+            index = self.shard_of(token)
+            if index is None:
+                return
+
+            self._tokens[index].discard(token)
+            browser = self._browsers[index]
+            if not self._tokens[index] and browser is not None:
+                self._browsers[index] = None
+                await browser.close()
+                logger.info("Idle browser closed", shard=index)
+
+    def shard_of(self, token: str) -> int | None:
+        """
+        查询账号所在的浏览器进程
+
+        参数:
+            token: 用户token
+
+        返回:
+            int | None: 浏览器进程序号，未分配时返回None
+        """
+        for index, tokens in enumerate(self._tokens):
+            if token in tokens:
+                return index
+        return None
+
+    def stats(self) -> list[dict]:
+        """
+        各浏览器进程的上下文数
+
+        返回:
+            list[dict]: 每个浏览器进程的序号、上下文数和是否在运行
+        """
+        return [
+            {
+                "shard": index,
+                "contexts": len(tokens),
+                "running": browser is not None and browser.is_connected(),
+            }
+            for index, (browser, tokens) in enumerate(zip(self._browsers, self._tokens))
+        ]
+
+    async def rss(self) -> dict[int, int]:
+        """
+        各浏览器进程的常驻内存
+
+        通过CDP获取浏览器及其渲染、GPU等子进程的PID，从/proc读取常驻内存后按浏览器汇总。
+
+        返回:
+            dict[int, int]: 浏览器进程序号到常驻内存（字节）的映射，无法读取时不包含该进程
+        """
+        result = {}
+        for index, browser in enumerate(self._browsers):
+            if browser is None or not browser.is_connected():
+                continue
+
+            session = await browser.new_browser_cdp_session()
+            try:
+                info = await session.send("SystemInfo.getProcessInfo")
+            finally:
+                await session.detach()
+
+            sizes = [_rss(process["id"]) for process in info["processInfo"]]
+            if any(size is not None for size in sizes):
+                result[index] = sum(size for size in sizes if size is not None)
+        return result
+
+    async def close(self):
+        """
+        关闭所有浏览器进程
+        """
+        async with self._lock:
+            for index, browser in enumerate(self._browsers):
+                if browser is not None:
+                    await browser.close()
+                self._browsers[index] = None
+                self._tokens[index].clear()
+
+
+def _rss(pid: int) -> int | None:
+    """
+    读取进程的常驻内存
+
+    参数:
+        pid: 进程ID
+
+    返回:
+        int | None: 常驻内存（字节），进程已退出或系统不支持/proc时返回None
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        return None
+    return None
@@ -0,0 +1,446 @@
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+import structlog
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from playwright.async_api import async_playwright
+from pymongo.errors import OperationFailure, PyMongoError
+
+from jobs import OWNER, Lease
+
+from . import GoofishIM
+from .pool import BrowserPool
+from .watchdog import ImWatchdog
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class ImSupervisor:
+    """
+    IM会话监督器。
+
+    监听users集合的变更事件，用户登录后立即启动IM会话，过期或删除后立即停止，只读取token和
+    expired字段，启动会话时才读取cookie。定期的对账作为变更事件丢失时的兜底；数据库不支持
+    变更流（非副本集）时以较短的间隔对账。
+
+    会话通过im:<token>租约分配给各进程，每个进程最多持有在线进程间平均分配的份额，超出份额时
+    每次心跳释放一个会话；持有会话的进程崩溃后租约过期，其它进程在心跳时接管。
+
+    进程内的会话共用一个Playwright实例和浏览器池，每个会话是共享浏览器进程中的一个上下文。
+    看门狗定期采样内存，会话超过阈值或最大存活时长时原地回收：交出尚未回复的会话、关闭上下文后
+    用最新的cookie重新打开并注入。会话停止时（租约丢失、重新分配）交出的状态保存在im_state集合中，
+    由下一个启动该会话的进程接续。
+    """
+
+    # 进程在线租约有效期
+    WORKER_LEASE = timedelta(seconds=30)
+
+    # 会话租约有效期
+    SESSION_LEASE = timedelta(minutes=3)
+
+    # 心跳间隔（秒），续期租约、重新分配会话
+    HEARTBEAT = 10
+
+    # 不支持变更流时的对账间隔（秒）
+    POLL_INTERVAL = 5
+
+    # 会话异常退出后重新启动的等待时间（秒）
+    RESTART_BACKOFF = 60
+
+    # 看门狗采样的间隔（秒）
+    WATCHDOG_INTERVAL = 60
+
+    # 交接状态的有效期，过期的状态不再接续
+    HANDOVER_MAX_AGE = timedelta(minutes=10)
+
+    def __init__(
+        self,
+        db: AsyncIOMotorDatabase,
+        *,
+        sweep_interval: int | None = None,
+        max_sessions: int | None = None,
+    ) -> None:
+        """
+        初始化IM会话监督器
+
+        参数:
+            db: MongoDB异步数据库实例
+            sweep_interval: 对账间隔（秒），默认读取IM_SWEEP_INTERVAL
+            max_sessions: 本进程最多持有的会话数，0为不限制，默认读取IM_MAX_SESSIONS
+        """
+        self._db = db
+        self._sweep_interval = sweep_interval or int(os.getenv("IM_SWEEP_INTERVAL", 300))
+        self._max_sessions = (
+            int(os.getenv("IM_MAX_SESSIONS", 0)) if max_sessions is None else max_sessions
+        )
+        self._worker = Lease(db, f"worker:{OWNER}", ttl=self.WORKER_LEASE)
+        self._workers = 1
+
+        # 未过期用户的token，以及用户文档_id到token的映射，删除事件只包含_id
+        self._active: set[str] = set()
+        self._ids: dict = {}
+
+        self._pool: BrowserPool | None = None
+        self._watchdog: ImWatchdog | None = None
+        self._handover_timeout = float(os.getenv("IM_HANDOVER_TIMEOUT", 20))
+        self._sessions: dict[str, asyncio.Task] = {}
+        self._clients: dict[str, tuple[GoofishIM, float]] = {}
+        self._recycle: dict[str, asyncio.Event] = {}
+        self._leases: dict[str, Lease] = {}
+        self._backoff: dict[str, float] = {}
+        self._lock = asyncio.Lock()
+
+    @property
+    def share(self) -> int:
+        """本进程应持有的会话数"""
+        share = -(-len(self._active) // max(1, self._workers))
+        if self._max_sessions > 0:
+            share = min(share, self._max_sessions)
+        if self._pool is not None:
+            share = min(share, self._pool.capacity)
+        return share
+
+    async def run(self):
+        """
+        运行监督器，直到被取消；取消时停止本进程持有的会话并释放租约
+        """
+        logger.info("Starting IM supervisor", owner=OWNER)
+        await self._worker.acquire()
+        await self._count_workers()
+
+        async with async_playwright() as p:
+            self._pool = BrowserPool(p)
+            self._watchdog = ImWatchdog(self._pool)
+            logger.info("Browser pool created", capacity=self._pool.capacity)
+
+            loops = [
+                asyncio.create_task(self._watch()),
+                asyncio.create_task(self._heartbeat()),
+            ]
+            try:
+                await asyncio.gather(*loops)
+            finally:
+                for loop in loops:
+                    loop.cancel()
+                await asyncio.gather(*loops, return_exceptions=True)
+
+                sessions = list(self._sessions.values())
+                for session in sessions:
+                    session.cancel()
+                await asyncio.gather(*sessions, return_exceptions=True)
+                await self._pool.close()
+                await self._worker.release()
+
+    async def _watch(self):
+        """
+        监听users集合的变更事件，连接中断时从上次的位置继续
+        """
+        pipeline = [
+            {"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}},
+            {
+                "$project": {
+                    "operationType": 1,
+                    "documentKey": 1,
+                    "fullDocument.token": 1,
+                    "fullDocument.expired": 1,
+                }
+            },
+        ]
+        resume_token = None
+
+        while True:
+            try:
+                # 变更流建立之前的变化由对账补齐
+                await self._sweep()
+                async with self._db.users.watch(
+                    pipeline, full_document="updateLookup", resume_after=resume_token
+                ) as stream:
+                    logger.info("Watching user changes")
+                    sweep_at = time.monotonic() + self._sweep_interval
+                    while True:
+                        change = await stream.try_next()
+                        if change is not None:
+                            resume_token = stream.resume_token
+                            await self._on_change(change)
+                        elif time.monotonic() >= sweep_at:
+                            await self._sweep()
+                            sweep_at = time.monotonic() + self._sweep_interval
+            except OperationFailure as e:
+                if e.code == 40573:
+                    logger.warning(
+                        "Change streams unavailable, falling back to polling",
+                        interval=self.POLL_INTERVAL,
+                    )
+                    await self._poll()
+                    return
+
+                # 恢复位置已不在oplog中，重新对账后从当前位置监听
+                logger.warning("User change stream failed", error=str(e))
+                resume_token = None
+            except PyMongoError as e:
+                logger.warning("User change stream interrupted", error=str(e))
+            except Exception as e:
+                logger.exception("Error watching user changes", error=str(e))
+
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    async def _poll(self):
+        """
+        不支持变更流时定期对账
+        """
+        while True:
+            await asyncio.sleep(self.POLL_INTERVAL)
+            try:
+                await self._sweep()
+            except Exception as e:
+                logger.exception("Error checking IM sessions", error=str(e))
+
+    async def _on_change(self, change: dict):
+        """
+        处理用户的变更事件
+        """
+        user_id = change["documentKey"]["_id"]
+        user = change.get("fullDocument")
+
+        if change["operationType"] == "delete" or user is None:
+            token = self._ids.pop(user_id, None)
+            if token is not None:
+                self._active.discard(token)
+                await self._stop(token, "user deleted")
+            return
+
+        token = user.get("token")
+        if not token:
+            return
+
+        self._ids[user_id] = token
+        if user.get("expired", False):
+            self._active.discard(token)
+            await self._stop(token, "user expired")
+        else:
+            self._active.add(token)
+            self._backoff.pop(token, None)
+            await self._start(token)
+
+    async def _sweep(self):
+        """
+        与users集合对账：停止已失效用户的会话，在份额内启动未被任何进程持有的会话
+        """
+        users = await self._db.users.find({"expired": False}, {"token": 1}).to_list()
+        self._ids = {user["_id"]: user["token"] for user in users if user.get("token")}
+        self._active = set(self._ids.values())
+
+        for token in list(self._sessions):
+            if token not in self._active:
+                await self._stop(token, "user no longer active")
+
+        await self._claim_orphans()
+
+    async def _heartbeat(self):
+        """
+        定期续期租约，停止租约丢失的会话，按在线进程数重新分配会话，并由看门狗检查是否需要回收
+        """
+        check_at = time.monotonic() + self.WATCHDOG_INTERVAL
+        while True:
+            await asyncio.sleep(self.HEARTBEAT)
+            try:
+                if time.monotonic() >= check_at:
+                    check_at = time.monotonic() + self.WATCHDOG_INTERVAL
+                    await self._check_sessions()
+
+                await self._worker.acquire()
+                await self._count_workers()
+
+                for token, lease in list(self._leases.items()):
+                    if not await lease.renew():
+                        await self._stop(token, "session lease lost")
+
+                if len(self._sessions) > self.share:
+                    token = random.choice(list(self._sessions))
+                    await self._stop(token, "rebalancing")
+                elif len(self._sessions) < self.share:
+                    await self._claim_orphans()
+            except Exception as e:
+                logger.exception("Error in IM supervisor heartbeat", error=str(e))
+
+    async def _check_sessions(self):
+        """
+        由看门狗采样内存，通知需要回收的会话
+        """
+        due = await self._watchdog.check(dict(self._clients))
+        for token, reason in due.items():
+            if (recycle := self._recycle.get(token)) is not None:
+                logger.info("Recycling IM session", token=token, reason=reason)
+                recycle.set()
+
+    async def _count_workers(self):
+        self._workers = max(1, len(await Lease.holders(self._db, "worker:")))
+
+    async def _claim_orphans(self):
+        """
+        在份额内启动未被任何进程持有的会话
+        """
+        if len(self._sessions) >= self.share:
+            return
+
+        held = await Lease.holders(self._db, "im:")
+        orphans = [token for token in self._active if f"im:{token}" not in held]
+        random.shuffle(orphans)
+        for token in orphans:
+            if len(self._sessions) >= self.share:
+                break
+            await self._start(token)
+
+    async def _start(self, token: str):
+        """
+        在份额内取得会话租约并启动会话
+        """
+        async with self._lock:
+            if token in self._sessions or len(self._sessions) >= self.share:
+                return
+            if self._backoff.get(token, 0) > time.monotonic():
+                return
+
+            lease = Lease(self._db, f"im:{token}", ttl=self.SESSION_LEASE)
+            if not await lease.acquire():
+                return
+
+            user = await self._db.users.find_one(
+                {"token": token, "expired": False}, {"goofish.cookies": 1}
+            )
+            if not user:
+                await lease.release()
+                return
+
+            logger.info("Creating new IM task for user", token=token)
+            self._leases[token] = lease
+            self._sessions[token] = asyncio.create_task(
+                self._run_session(token, user["goofish"]["cookies"])
+            )
+
+    async def _stop(self, token: str, reason: str):
+        """
+        停止本进程持有的会话
+        """
+        session = self._sessions.get(token)
+        if session is None:
+            return
+
+        logger.info("Stopping IM task", token=token, reason=reason)
+        session.cancel()
+        await asyncio.gather(session, return_exceptions=True)
+
+    async def _run_session(self, token: str, cookies: list):
+        """
+        运行用户的IM会话，直到被取消；收到回收通知时交出尚未回复的会话并重新打开
+        """
+        logger.info("Starting IM task for user", token=token)
+        pending, since = await self._take_handover(token)
+        browser = im_client = None
+        disconnected = asyncio.Event()
+        on_disconnected = lambda _: disconnected.set()
+        recycle = self._recycle[token] = asyncio.Event()
+        try:
+            while True:
+                browser = await self._pool.acquire(token)
+                disconnected = asyncio.Event()
+                on_disconnected = lambda _, event=disconnected: event.set()
+                browser.on("disconnected", on_disconnected)
+
+                im_client = GoofishIM(
+                    db=self._db, playwright=self._pool.playwright, cookies=cookies, token=token
+                )
+                await im_client.init(cookies=cookies, browser=browser)
+                await asyncio.sleep(5)
+                await im_client.start(pending=pending, since=since)
+                self._clients[token] = (im_client, time.monotonic())
+                pending, since = [], None
+
+                await self._wait_any(disconnected, recycle)
+                if disconnected.is_set():
+                    raise RuntimeError("Browser disconnected")
+
+                # 交出尚未回复的会话，用页面中最新的cookie重新打开，释放上下文后可能分配到其它浏览器进程
+                recycle.clear()
+                self._clients.pop(token, None)
+                browser.remove_listener("disconnected", on_disconnected)
+                since = int(time.time() * 1000)
+                cookies = await im_client.get_cookies()
+                pending = await im_client.handover(self._handover_timeout)
+                im_client = browser = None
+                await self._pool.release(token)
+                logger.info("IM session recycled", token=token, pending=len(pending))
+        except asyncio.CancelledError:
+            logger.info("IM task stopped", token=token)
+        except Exception as e:
+            logger.exception("Error in IM task", token=token, error=str(e))
+            self._backoff[token] = time.monotonic() + self.RESTART_BACKOFF
+        finally:
+            started = self._clients.pop(token, None) is not None
+            self._recycle.pop(token, None)
+            if browser is not None:
+                browser.remove_listener("disconnected", on_disconnected)
+
+            # 共享的浏览器进程仍在运行时交出会话并关闭本会话的上下文
+            if im_client is not None and not disconnected.is_set():
+                try:
+                    if started:
+                        since = int(time.time() * 1000)
+                        pending = await im_client.handover(self._handover_timeout)
+                    else:
+                        await im_client.close()
+                except Exception as e:
+                    logger.warning("Failed to close IM context", token=token, error=str(e))
+
+            if pending:
+                await self._save_handover(token, pending, since)
+
+            await self._pool.release(token)
+            self._sessions.pop(token, None)
+            lease = self._leases.pop(token, None)
+            if lease is not None:
+                await lease.release()
+
+    @staticmethod
+    async def _wait_any(*events: asyncio.Event):
+        """
+        等待任意一个事件
+        """
+        waiters = [asyncio.create_task(event.wait()) for event in events]
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    async def _save_handover(self, token: str, pending: list, since: int | None):
+        """
+        保存会话停止时尚未回复的会话，由下一个启动该会话的进程接续
+        """
+        await self._db.im_state.update_one(
+            {"_id": token},
+            {
+                "$set": {
+                    "pending": [list(key) for key in pending],
+                    "since": since,
+                    "updatedAt": datetime.now(),
+                }
+            },
+            upsert=True,
+        )
+        logger.info("IM session state saved for handover", token=token, pending=len(pending))
+
+    async def _take_handover(self, token: str) -> tuple[list, int | None]:
+        """
+        读取并删除上一个进程交出的会话状态
+
+        返回:
+            tuple[list, int | None]: 尚未回复的会话和切换开始的时间戳，没有有效状态时为空
+        """
+        state = await self._db.im_state.find_one_and_delete({"_id": token})
+        if not state or state["updatedAt"] < datetime.now() - self.HANDOVER_MAX_AGE:
+            return [], None
+        return [tuple(key) for key in state["pending"]], state.get("since")
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import time
+
+import structlog
+
+from . import GoofishIM
+from .pool import BrowserPool
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+MB = 1024 * 1024
+
+
+class ImWatchdog:
+    """
+    IM会话看门狗。
+
+    采样各IM页面的JS堆、DOM节点数和各浏览器进程的常驻内存，找出需要回收的会话：
+    存活超过最大时长、页面JS堆超过上限，或所在浏览器进程的常驻内存超过上限（回收该进程中
+    JS堆最大的会话）。最大存活时长按token错开，避免同时启动的会话同时回收；每次检查最多
+    回收max_recycles个会话。
+    """
+
+    def __init__(
+        self,
+        pool: BrowserPool,
+        *,
+        max_age: float | None = None,
+        heap_limit: int | None = None,
+        rss_limit: int | None = None,
+        max_recycles: int | None = None,
+    ) -> None:
+        """
+        初始化看门狗
+
+        参数:
+            pool: 浏览器池
+            max_age: 会话最大存活时长（秒），默认读取IM_MAX_AGE（小时）
+            heap_limit: 页面JS堆上限（字节），默认读取IM_HEAP_LIMIT_MB
+            rss_limit: 浏览器进程常驻内存上限（字节），默认读取IM_BROWSER_RSS_LIMIT_MB，0为不限制
+            max_recycles: 每次检查最多回收的会话数，默认读取IM_RECYCLE_BATCH
+        """
+        if max_age is None:
+            max_age = float(os.getenv("IM_MAX_AGE", 24)) * 3600
+        if heap_limit is None:
+            heap_limit = int(os.getenv("IM_HEAP_LIMIT_MB", 512)) * MB
+        if rss_limit is None:
+            rss_limit = int(os.getenv("IM_BROWSER_RSS_LIMIT_MB", 0)) * MB
+        if max_recycles is None:
+            max_recycles = int(os.getenv("IM_RECYCLE_BATCH", 2))
+
+        self._pool = pool
+        self._max_age = max_age
+        self._heap_limit = heap_limit
+        self._rss_limit = rss_limit
+        self._max_recycles = max(1, max_recycles)
+
+    def _age_limit(self, token: str) -> float:
+        """
+        按token在最大存活时长的90%到100%之间错开
+        """
+        spread = int(hashlib.md5(token.encode()).hexdigest(), 16) % 1000 / 10000
+        return self._max_age * (0.9 + spread)
+
+    async def check(self, sessions: dict[str, tuple[GoofishIM, float]]) -> dict[str, str]:
+        """
+        采样并找出需要回收的会话
+
+        参数:
+            sessions: token到(IM客户端, 启动时间)的映射，启动时间为time.monotonic()
+
+        返回:
+            dict[str, str]: 需要回收的会话token到原因的映射
+        """
+        now = time.monotonic()
+        metrics: dict[str, dict[str, int]] = {}
+        for token, (client, _) in sessions.items():
+            try:
+                metrics[token] = await client.metrics()
+            except Exception as e:
+                logger.debug("Failed to sample IM page", token=token, error=str(e))
+
+        try:
+            rss = await self._pool.rss()
+        except Exception as e:
+            logger.debug("Failed to sample browser memory", error=str(e))
+            rss = {}
+
+        for shard in self._pool.stats():
+            if not shard["contexts"]:
+                continue
+            tokens = [
+                token for token in metrics if self._pool.shard_of(token) == shard["shard"]
+            ]
+            logger.info(
+                "IM browser memory",
+                **shard,
+                rss_mb=round(rss[shard["shard"]] / MB, 1) if shard["shard"] in rss else None,
+                heap_mb=round(sum(metrics[token]["heap"] for token in tokens) / MB, 1),
+                nodes=sum(metrics[token]["nodes"] for token in tokens),
+            )
+
+        due: dict[str, str] = {}
+
+        # 浏览器进程的常驻内存接近OOM，优先回收
+        if self._rss_limit:
+            for index, size in rss.items():
+                if size <= self._rss_limit:
+                    continue
+                tokens = [token for token in metrics if self._pool.shard_of(token) == index]
+                if tokens:
+                    heaviest = max(tokens, key=lambda token: metrics[token]["heap"])
+                    due[heaviest] = f"browser rss {size // MB}MB"
+
+        # 存活时间最长的会话优先
+        for token, (_, started) in sorted(sessions.items(), key=lambda item: item[1][1]):
+            if token in due:
+                continue
+            if now - started > self._age_limit(token):
+                due[token] = "max age"
+            elif token in metrics and metrics[token]["heap"] > self._heap_limit:
+                due[token] = f"heap {metrics[token]['heap'] // MB}MB"
+
+        return dict(list(due.items())[: self._max_recycles])
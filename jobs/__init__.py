@@ -0,0 +1,342 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable
+
+import structlog
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from .lease import OWNER, Lease
+from .runs import RunTracker
+from .schedule import TokenScheduler
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+# 任务处理函数，参数为任务文档，返回值保存为任务结果
+Handler = Callable[[dict], Awaitable[Any]]
+
+
+class JobAbort(Exception):
+    """任务无法完成且重试无效（如用户已删除或登录失效），任务直接标记为失败"""
+
+
+class JobQueue:
+    """
+    基于MongoDB的持久化任务队列。
+
+    任务保存在jobs集合中，状态依次为queued、running、done或failed。工作协程通过租约领取任务，
+    租约过期（工作进程崩溃）的任务会被重新领取；失败的任务按指数退避重试，超过次数后标记为failed。
+    指定key的任务在排队期间去重，同一key最多只有一个排队中的任务。
+    """
+
+    # 租约有效期，执行期间定期续期
+    LEASE = timedelta(minutes=2)
+
+    # 默认最多尝试次数
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, db: AsyncIOMotorDatabase) -> None:
+        """
+        初始化任务队列
+
+        参数:
+            db: MongoDB异步数据库实例
+        """
+        self._db = db
+
+    async def enqueue(
+        self,
+        type_: str,
+        *,
+        token: str | None = None,
+        payload: dict | None = None,
+        key: str | None = None,
+        delay: timedelta | None = None,
+        max_attempts: int | None = None,
+    ) -> bool:
+        """
+        加入任务
+
+        参数:
+            type_: 任务类型
+            token: 任务所属用户的token
+            payload: 任务参数
+            key: 去重键，已有相同key的排队中任务时不再加入
+            delay: 延迟执行的时间
+            max_attempts: 最多尝试次数
+
+        返回:
+            bool: 加入了新任务返回True，被去重返回False
+        """
+        now = datetime.now()
+        job = {
+            "type": type_,
+            "token": token,
+            "payload": payload or {},
+            "status": "queued",
+            "attempts": 0,
+            "maxAttempts": max_attempts or self.MAX_ATTEMPTS,
+            "runAt": now + (delay or timedelta()),
+            "createdAt": now,
+        }
+
+        if key is None:
+            await self._db.jobs.insert_one(job)
+            return True
+
+        try:
+            result = await self._db.jobs.update_one(
+                {"pendingKey": key},
+                {"$setOnInsert": {**job, "key": key}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+
+        if result.upserted_id is None:
+            logger.debug("Job already queued", type=type_, key=key)
+            return False
+        return True
+
+    async def claim(self, types: list[str], owner: str) -> dict | None:
+        """
+        领取一个到期的任务，或租约已过期的执行中任务
+
+        参数:
+            types: 可领取的任务类型
+            owner: 领取者标识
+
+        返回:
+            dict | None: 任务文档，没有可领取的任务时返回None
+        """
+        now = datetime.now()
+        return await self._db.jobs.find_one_and_update(
+            {
+                "type": {"$in": types},
+                "$or": [
+                    {"status": "queued", "runAt": {"$lte": now}},
+                    {"status": "running", "leaseUntil": {"$lt": now}},
+                ],
+            },
+            {
+                "$set": {
+                    "status": "running",
+                    "owner": owner,
+                    "leaseUntil": now + self.LEASE,
+                    "startedAt": now,
+                },
+                "$unset": {"pendingKey": ""},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("runAt", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def renew(self, job: dict, owner: str) -> bool:
+        """
+        续期任务租约
+
+        返回:
+            bool: 仍持有租约返回True
+        """
+        result = await self._db.jobs.update_one(
+            {"_id": job["_id"], "owner": owner, "status": "running"},
+            {"$set": {"leaseUntil": datetime.now() + self.LEASE}},
+        )
+        return result.matched_count > 0
+
+    async def complete(self, job: dict, owner: str, result: Any = None):
+        """
+        标记任务完成
+
+        参数:
+            job: 任务文档
+            owner: 领取者标识
+            result: 任务结果
+        """
+        await self._db.jobs.update_one(
+            {"_id": job["_id"], "owner": owner},
+            {
+                "$set": {
+                    "status": "done",
+                    "result": result,
+                    "finishedAt": datetime.now(),
+                },
+                "$unset": {"leaseUntil": ""},
+            },
+        )
+
+    async def fail(self, job: dict, owner: str, error: str, *, retry: bool = True):
+        """
+        记录任务失败，未超过最多尝试次数时按指数退避重新排队；已有相同key的排队中任务时不再重试
+
+        参数:
+            job: 任务文档
+            owner: 领取者标识
+            error: 失败原因
+            retry: 是否允许重试，为False时直接标记为失败
+        """
+        now = datetime.now()
+        failed = {"status": "failed", "finishedAt": now}
+        if retry and job["attempts"] < job["maxAttempts"]:
+            update = {
+                "status": "queued",
+                "runAt": now + timedelta(seconds=30 * 2 ** (job["attempts"] - 1)),
+            }
+            # 重新排队期间恢复去重键，同一key不会再加入新的任务
+            if job.get("key") is not None:
+                update["pendingKey"] = job["key"]
+        else:
+            update = failed
+
+        try:
+            await self._db.jobs.update_one(
+                {"_id": job["_id"], "owner": owner},
+                {"$set": {**update, "error": error}, "$unset": {"leaseUntil": ""}},
+            )
+        except DuplicateKeyError:
+            # 已有相同key的排队中任务，由它代替本次重试
+            logger.info("Job already queued, not retrying", type=job["type"], key=job["key"])
+            await self._db.jobs.update_one(
+                {"_id": job["_id"], "owner": owner},
+                {"$set": {**failed, "error": error}, "$unset": {"leaseUntil": ""}},
+            )
+
+    async def get(self, job_id: str) -> dict | None:
+        """
+        获取任务
+
+        参数:
+            job_id: 任务ID
+
+        返回:
+            dict | None: 任务文档
+        """
+        return await self._db.jobs.find_one({"_id": ObjectId(job_id)})
+
+
+class JobRunner:
+    """
+    任务执行器。
+
+    每种任务类型有独立的工作协程池，并发数即该阶段的并发上限，不同用户、不同阶段的任务
+    互不阻塞。处理函数正常返回时任务完成，抛出异常时任务失败并按退避策略重试。
+    """
+
+    # 没有可领取的任务时的轮询间隔（秒）
+    POLL_INTERVAL = 2
+
+    def __init__(self, db: AsyncIOMotorDatabase) -> None:
+        """
+        初始化任务执行器
+
+        参数:
+            db: MongoDB异步数据库实例
+        """
+        self.queue = JobQueue(db)
+        self._handlers: dict[str, tuple[Handler, int]] = {}
+        self._workers: list[asyncio.Task] = []
+        self._owner = OWNER
+
+    def register(self, type_: str, handler: Handler, *, concurrency: int = 1):
+        """
+        注册任务处理函数
+
+        参数:
+            type_: 任务类型
+            handler: 处理函数
+            concurrency: 该类型任务的并发数
+        """
+        self._handlers[type_] = (handler, max(1, concurrency))
+
+    def start(self):
+        """
+        为每种任务类型启动工作协程
+        """
+        for type_, (handler, concurrency) in self._handlers.items():
+            for _ in range(concurrency):
+                self._workers.append(asyncio.create_task(self._work(type_, handler)))
+
+        logger.info(
+            "Job runner started",
+            stages={type_: concurrency for type_, (_, concurrency) in self._handlers.items()},
+        )
+
+    async def stop(self):
+        """
+        停止所有工作协程，执行中的任务在租约过期后被重新领取
+        """
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    async def _work(self, type_: str, handler: Handler):
+        """
+        工作协程，循环领取并执行指定类型的任务
+        """
+        while True:
+            try:
+                job = await self.queue.claim([type_], self._owner)
+            except Exception as e:
+                logger.error("Failed to claim job", type=type_, error=str(e))
+                job = None
+
+            if job is None:
+                await asyncio.sleep(self.POLL_INTERVAL)
+                continue
+
+            try:
+                await self._execute(job, handler)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 记录结果失败时任务在租约过期后被重新领取，工作协程继续运行
+                logger.exception("Failed to record job result", type=type_, error=str(e))
+
+    async def _execute(self, job: dict, handler: Handler):
+        """
+        执行任务，执行期间续期租约；租约丢失（已被其它工作协程重新领取）时取消执行
+        """
+        log = logger.bind(job=str(job["_id"]), type=job["type"], token=job.get("token"))
+        log.info("Job started", attempt=job["attempts"])
+
+        handling = asyncio.create_task(handler(job))
+        lost = False
+
+        async def heartbeat():
+            nonlocal lost
+            while True:
+                await asyncio.sleep(JobQueue.LEASE.total_seconds() / 3)
+                try:
+                    renewed = await self.queue.renew(job, self._owner)
+                except Exception as e:
+                    # 续期间隔为租约的三分之一，下次续期前租约不会过期
+                    log.warning("Failed to renew job lease, retrying", error=str(e))
+                    continue
+                if not renewed:
+                    log.warning("Job lease lost, cancelling")
+                    lost = True
+                    handling.cancel()
+                    return
+
+        renewing = asyncio.create_task(heartbeat())
+        try:
+            result = await handling
+        except asyncio.CancelledError:
+            if not lost:
+                raise
+            # 任务已由其它工作协程接管，不再记录结果
+        except JobAbort as e:
+            log.warning("Job aborted", error=str(e))
+            await self.queue.fail(job, self._owner, str(e), retry=False)
+        except Exception as e:
+            log.exception("Job failed", error=str(e))
+            await self.queue.fail(job, self._owner, str(e))
+        else:
+            log.info("Job finished")
+            await self.queue.complete(job, self._owner, result)
+        finally:
+            renewing.cancel()
@@ -0,0 +1,102 @@
+import os
+import re
+import socket
+from datetime import datetime, timedelta
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import DuplicateKeyError
+
+# 当前进程的标识，同一进程内的租约共用
+OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Lease:
+    """
+    基于MongoDB的命名租约。
+
+    租约保存在leases集合中，同一名称同一时间只有一个持有者。持有者需要在有效期内续期，
+    进程崩溃后租约过期，其它进程可以重新取得。用于选举调度主节点和分配IM会话等。
+    """
+
+    def __init__(
+        self,
+        db: AsyncIOMotorDatabase,
+        name: str,
+        *,
+        ttl: timedelta,
+        owner: str = OWNER,
+    ) -> None:
+        """
+        初始化租约
+
+        参数:
+            db: MongoDB异步数据库实例
+            name: 租约名称
+            ttl: 租约有效期
+            owner: 持有者标识，默认为当前进程
+        """
+        self._db = db
+        self.name = name
+        self.ttl = ttl
+        self.owner = owner
+
+    async def acquire(self) -> bool:
+        """
+        取得或续期租约
+
+        返回:
+            bool: 取得租约或已持有租约返回True，被其它持有者持有返回False
+        """
+        now = datetime.now()
+        try:
+            await self._db.leases.update_one(
+                {
+                    "_id": self.name,
+                    "$or": [
+                        {"owner": self.owner},
+                        {"leaseUntil": {"$lt": now}},
+                        {"leaseUntil": None},
+                    ],
+                },
+                {"$set": {"owner": self.owner, "leaseUntil": now + self.ttl}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def renew(self) -> bool:
+        """
+        续期已持有的租约
+
+        返回:
+            bool: 仍持有租约返回True，租约已过期并被其它持有者取得时返回False
+        """
+        result = await self._db.leases.update_one(
+            {"_id": self.name, "owner": self.owner},
+            {"$set": {"leaseUntil": datetime.now() + self.ttl}},
+        )
+        return result.matched_count > 0
+
+    async def release(self):
+        """
+        释放租约
+        """
+        await self._db.leases.delete_one({"_id": self.name, "owner": self.owner})
+
+    @staticmethod
+    async def holders(db: AsyncIOMotorDatabase, prefix: str) -> dict[str, str]:
+        """
+        查询指定前缀下的有效租约
+
+        参数:
+            db: MongoDB异步数据库实例
+            prefix: 租约名称前缀
+
+        返回:
+            dict[str, str]: 租约名称到持有者的映射
+        """
+        leases = await db.leases.find(
+            {"_id": {"$regex": f"^{re.escape(prefix)}"}, "leaseUntil": {"$gte": datetime.now()}}
+        ).to_list()
+        return {lease["_id"]: lease["owner"] for lease in leases}
@@ -0,0 +1,225 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import AsyncIterator
+
+import structlog
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+from .lease import OWNER
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class RunTracker:
+    """
+    用户任务的运行状态。
+
+    每个用户同一时间最多只有一轮任务在执行，运行状态保存在run_state集合中并通过租约互斥，
+    执行进程崩溃后租约过期，下一轮任务可以重新开始。执行期间到来的触发按overlap策略处理：
+    skip直接跳过，queue合并为当前轮结束后的一次补跑。每轮任务的记录保存在runs集合中。
+    """
+
+    # 租约有效期，执行期间定期续期
+    LEASE = timedelta(minutes=5)
+
+    def __init__(self, db: AsyncIOMotorDatabase, *, overlap: str | None = None) -> None:
+        """
+        初始化运行状态
+
+        参数:
+            db: MongoDB异步数据库实例
+            overlap: 上一轮仍在执行时的处理策略，skip或queue，默认读取RUN_OVERLAP
+        """
+        self._db = db
+        self._overlap = overlap or os.getenv("RUN_OVERLAP", "queue")
+        self._owner = OWNER
+
+    async def begin(self, token: str, *, trigger: str) -> dict | None:
+        """
+        开始一轮任务
+
+        参数:
+            token: 用户token
+            trigger: 触发来源
+
+        返回:
+            dict | None: 运行记录，上一轮仍在执行时返回None
+        """
+        now = datetime.now()
+        run_id = ObjectId()
+        try:
+            previous = await self._db.run_state.find_one_and_update(
+                {
+                    "_id": token,
+                    "$or": [{"leaseUntil": {"$lt": now}}, {"leaseUntil": None}],
+                },
+                {
+                    "$set": {
+                        "runId": run_id,
+                        "owner": self._owner,
+                        "leaseUntil": now + self.LEASE,
+                        "pending": False,
+                    }
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            await self._overlapped(token, trigger)
+            return None
+
+        # 上一轮的执行进程崩溃，租约过期后由本轮接管
+        if previous and previous.get("runId"):
+            await self._db.runs.update_one(
+                {"_id": previous["runId"], "status": "running"},
+                {"$set": {"status": "abandoned", "finishedAt": now}},
+            )
+
+        run = {
+            "_id": run_id,
+            "token": token,
+            "trigger": trigger,
+            "status": "running",
+            "owner": self._owner,
+            "startedAt": now,
+            "coalesced": 0,
+        }
+        await self._db.runs.insert_one(run)
+        return run
+
+    async def _overlapped(self, token: str, trigger: str):
+        """
+        记录执行期间到来的触发，queue策略下标记当前轮结束后补跑
+        """
+        fields = {"lastOverlapAt": datetime.now()}
+        if self._overlap == "queue":
+            fields["pending"] = True
+        state = await self._db.run_state.find_one_and_update(
+            {"_id": token}, {"$set": fields}
+        )
+        if state and state.get("runId"):
+            await self._db.runs.update_one(
+                {"_id": state["runId"]}, {"$inc": {"coalesced": 1}}
+            )
+
+        logger.info(
+            "Run in flight, trigger deferred"
+            if self._overlap == "queue"
+            else "Run in flight, trigger skipped",
+            token=token,
+            trigger=trigger,
+        )
+
+    async def renew(self, run: dict) -> bool:
+        """
+        续期运行租约
+
+        返回:
+            bool: 仍持有租约返回True
+        """
+        result = await self._db.run_state.update_one(
+            {"_id": run["token"], "runId": run["_id"]},
+            {"$set": {"leaseUntil": datetime.now() + self.LEASE}},
+        )
+        return result.matched_count > 0
+
+    async def finish(self, run: dict, *, error: str | None = None) -> bool:
+        """
+        结束一轮任务并释放运行状态
+
+        参数:
+            run: 运行记录
+            error: 失败原因
+
+        返回:
+            bool: 执行期间有被合并的触发，需要补跑一轮时返回True
+        """
+        now = datetime.now()
+        await self._db.runs.update_one(
+            {"_id": run["_id"]},
+            {
+                "$set": {
+                    "status": "failed" if error else "done",
+                    "error": error,
+                    "finishedAt": now,
+                    "elapsed": (now - run["startedAt"]).total_seconds(),
+                }
+            },
+        )
+
+        state = await self._db.run_state.find_one_and_update(
+            {"_id": run["token"], "runId": run["_id"]},
+            {
+                "$set": {"pending": False, "lastRunId": run["_id"], "lastFinishedAt": now},
+                "$unset": {"runId": "", "owner": "", "leaseUntil": ""},
+            },
+        )
+        return bool(state and state.get("pending"))
+
+    @asynccontextmanager
+    async def hold(self, token: str, *, trigger: str) -> AsyncIterator[dict | None]:
+        """
+        在运行状态的保护下执行一轮任务，执行期间续期租约
+
+        参数:
+            token: 用户token
+            trigger: 触发来源
+
+        返回:
+            dict | None: 运行记录，上一轮仍在执行时为None，调用方应直接返回；
+                结束后run["rerun"]表示是否需要补跑一轮
+        """
+        run = await self.begin(token, trigger=trigger)
+        if run is None:
+            yield None
+            return
+
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(self.LEASE.total_seconds() / 3)
+                await self.renew(run)
+
+        renewing = asyncio.create_task(heartbeat())
+        try:
+            yield run
+        except BaseException as e:
+            renewing.cancel()
+            run["rerun"] = await self.finish(run, error=str(e) or type(e).__name__)
+            raise
+        else:
+            renewing.cancel()
+            run["rerun"] = await self.finish(run)
+
+    async def history(self, token: str, *, limit: int = 20) -> list[dict]:
+        """
+        查询用户最近的运行记录
+
+        参数:
+            token: 用户token
+            limit: 最多返回的记录数
+
+        返回:
+            list[dict]: 按开始时间倒序的运行记录
+        """
+        return (
+            await self._db.runs.find({"token": token})
+            .sort("startedAt", DESCENDING)
+            .limit(limit)
+            .to_list()
+        )
+
+    async def state(self, token: str) -> dict | None:
+        """
+        查询用户的运行状态
+
+        参数:
+            token: 用户token
+
+        返回:
+            dict | None: 运行状态，从未执行过时返回None
+        """
+        return await self._db.run_state.find_one({"_id": token})
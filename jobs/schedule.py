@@ -0,0 +1,177 @@
+import asyncio
+import hashlib
+import os
+import random
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+
+import structlog
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+
+from .lease import Lease
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class TokenScheduler:
+    """
+    基于MongoDB的用户定时任务调度器。
+
+    每个用户的触发间隔和下次触发时间保存在schedules集合中，所有进程共用。只有取得scheduler
+    租约的主节点轮询到期的触发，主节点崩溃后租约过期，由其它进程接管。每次触发通过原子更新
+    领取并推进下次触发时间，因此即使短时间内出现两个主节点也不会重复触发。
+    错过的多次触发合并为一次；各用户的首次触发按token分散在一个间隔内，每次触发再加上
+    随机抖动，避免所有用户同时触发。
+    """
+
+    # 主节点租约有效期
+    LEASE = timedelta(seconds=30)
+
+    # 轮询到期触发的间隔（秒）
+    POLL_INTERVAL = 5
+
+    def __init__(
+        self,
+        db: AsyncIOMotorDatabase,
+        on_due: Callable[[str], Awaitable[None]],
+        *,
+        jitter: int | None = None,
+    ) -> None:
+        """
+        初始化调度器
+
+        参数:
+            db: MongoDB异步数据库实例
+            on_due: 触发时调用的函数，参数为用户token
+            jitter: 每次触发的最大随机抖动（秒），默认读取SCHEDULE_JITTER
+        """
+        self._db = db
+        self._on_due = on_due
+        self._jitter = int(os.getenv("SCHEDULE_JITTER", 30)) if jitter is None else jitter
+        self._lease = Lease(db, "scheduler", ttl=self.LEASE)
+        self._task: asyncio.Task | None = None
+
+    async def put(self, token: str, interval: int):
+        """
+        设置用户的触发间隔，已存在时保留下次触发时间，间隔缩短时提前到新的间隔内
+
+        参数:
+            token: 用户token
+            interval: 触发间隔（秒）
+        """
+        interval = max(1, interval)
+        now = datetime.now()
+
+        # 同一token的偏移固定，多个进程重复设置时不会改变触发相位
+        offset = int(hashlib.md5(token.encode()).hexdigest(), 16) % interval
+        await self._db.schedules.update_one(
+            {"_id": token},
+            [
+                {
+                    "$set": {
+                        "interval": interval,
+                        "nextRunAt": {
+                            "$min": [
+                                {
+                                    "$ifNull": [
+                                        "$nextRunAt",
+                                        now + timedelta(seconds=offset),
+                                    ]
+                                },
+                                now + timedelta(seconds=interval),
+                            ]
+                        },
+                        "updatedAt": now,
+                    }
+                }
+            ],
+            upsert=True,
+        )
+
+    async def remove(self, token: str):
+        """
+        删除用户的定时任务
+
+        参数:
+            token: 用户token
+        """
+        await self._db.schedules.delete_one({"_id": token})
+
+    def start(self):
+        """
+        启动调度循环
+        """
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """
+        停止调度循环并释放主节点租约
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self._lease.release()
+
+    async def _loop(self):
+        leader = False
+        while True:
+            try:
+                acquired = await self._lease.acquire()
+                if acquired != leader:
+                    leader = acquired
+                    logger.info(
+                        "Scheduler leadership changed", leader=leader, owner=self._lease.owner
+                    )
+
+                if leader:
+                    while (token := await self._claim()) is not None:
+                        try:
+                            await self._on_due(token)
+                        except Exception as e:
+                            logger.exception("Scheduled task failed", token=token, error=str(e))
+            except Exception as e:
+                logger.exception("Error polling schedules", error=str(e))
+
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    async def _claim(self) -> str | None:
+        """
+        领取一个到期的触发，并将下次触发时间推进一个间隔加上随机抖动
+
+        返回:
+            str | None: 到期用户的token，没有到期触发时返回None
+        """
+        now = datetime.now()
+        jitter = random.uniform(0, self._jitter) if self._jitter else 0
+        schedule = await self._db.schedules.find_one_and_update(
+            {"nextRunAt": {"$lte": now}},
+            [
+                {
+                    "$set": {
+                        "nextRunAt": {
+                            "$add": [
+                                now,
+                                {
+                                    "$multiply": [
+                                        {
+                                            "$add": [
+                                                "$interval",
+                                                {"$min": [jitter, {"$divide": ["$interval", 10]}]},
+                                            ]
+                                        },
+                                        1000,
+                                    ]
+                                },
+                            ]
+                        },
+                        "lastRunAt": now,
+                    }
+                }
+            ],
+            return_document=ReturnDocument.AFTER,
+        )
+        return schedule["_id"] if schedule else None
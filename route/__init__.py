@@ -2,6 +2,7 @@ from .auth import router as AuthRouter
 from .config import router as ConfigRouter
 from .item import router as ItemRouter
 from .log import router as LogRouter
+from .run import router as RunRouter
 from .upload import router as UploadRouter
 from .types import Config, ConfigT, Item, MyResponse, Price, ShortUrl, Upload
 from .utils import build_config
@@ -18,5 +19,6 @@ __all__ = [
     "ConfigRouter",
     "AuthRouter",
     "ItemRouter",
+    "RunRouter",
     "build_config"
 ]
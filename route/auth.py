@@ -9,6 +9,7 @@ from motor.motor_asyncio import AsyncIOMotorDatabase
 from route.types import ErrorResponse, MyResponse
 
 from .depends import get_db
+from .task import tasks
 from .utils import check_login
 
 router = APIRouter(tags=["auth"])
@@ -64,5 +65,7 @@ async def p_login(
         {"$set": {"goofish": goofish_json, "ctrip": ctrip_json, "expired": False}},
         upsert=True,
     )
+    # 登录失效时定时任务已被删除，下次请求时重新调度
+    tasks.pop(token, None)
 
     return MyResponse(code=0, message="Login successful", data={"token": token})
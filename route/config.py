@@ -3,6 +3,9 @@ from typing import Any
 from fastapi import APIRouter, Depends, HTTPException
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
+from db.configs import ConfigCache
+from templates import DEFAULT_PROMPT
+
 from .depends import get_db, get_token
 from .types import Config, ConfigT, MyResponse
 
@@ -51,6 +54,8 @@ async def g_config(
                         "value": {
                             "keywords_filter_enabled": False,
                             "keywords_filter": [],
+                            "keywords_include": [],
+                            "fields": ["subName", "copywriterInfo", "title"],
                         },
                     }
                 )
@@ -64,6 +69,8 @@ async def g_config(
                             "item_limits": "3000",
                             "price": {"mode": "fixed", "value": "1"},
                             "item_type": "家居/服务/跑腿代办/酒店代订",
+                            "upload_workers": "4",
+                            "upload_qps": "2",
                         },
                     }
                 )
@@ -72,9 +79,7 @@ async def g_config(
                     {
                         "token": token,
                         "name": "template",
-                        "value": {
-                            "template": "根据要求和信息，写一句话。\n# 使用短句。\n# 直接回答，不要出现其他话。\n# 先突出价格，向下取整。有多天的价格就把价格算成一天的。\n# 再突出地点。\n# 然后有品牌突出品牌。\n少于20个字\n####信息####\n{title}\n{description}\n{price}元\n##例子##\n600悦榕庄！九寨沟悦榕庄！送餐饮!行政酒廊！\n400五星级套房！成都上层名人酒店!"
-                        },
+                        "value": {"template": DEFAULT_PROMPT},
                     }
                 )
             case "description":
@@ -102,6 +107,7 @@ async def g_config(
                     }
                 )
 
+        ConfigCache.invalidate(token)
         config = await db.configs.find_one(
             {
                 "name": name,
@@ -136,6 +142,7 @@ async def p_config(
         update={"$set": {"value": config.value, "token": token}},
         upsert=True,
     )
+    ConfigCache.invalidate(token)
 
     return {"code": 0, "message": "Updated"}
 
@@ -164,6 +171,7 @@ async def p_configt(
         {"$set": {"value": config.model_dump(), "token": token}},
         upsert=True,
     )
+    ConfigCache.invalidate(token)
 
     return {"code": 0, "message": "ok"}
 
@@ -196,6 +204,8 @@ async def g_configt(
             },
             upsert=True,
         )
+        # 该更新不以token筛选，可能修改其它用户的配置，清除全部缓存
+        ConfigCache.invalidate()
         config = await db.configs.find_one(
             {
                 "name": "configt",
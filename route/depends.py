@@ -9,8 +9,8 @@ from motor.motor_asyncio import AsyncIOMotorDatabase
 
 from db import MongoDB
 from .utils import build_config
-from .task import tasks, create_task_for_token
-from .sche import scheduler
+from .task import tasks
+from .sche import schedule_token_task, unschedule_token_task
 
 logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
 
@@ -42,6 +42,7 @@ async def get_token(request: Request) -> str:
 
     if user.get("expired", False):
         await db.users.delete_one({"token": token})
+        await unschedule_token_task(token)
         raise HTTPException(status_code=401, detail="Token expired")
 
     config = await build_config(token, db)
@@ -64,41 +65,18 @@ async def get_token(request: Request) -> str:
 
     if token not in tasks.keys():
         time_delta = int(config["configt"]["time_delta"])
-        # Create a task function for this token
-        task_function = create_task_for_token(token)
-        tasks[token] = task_function
 
         # Create a scheduled task using the time_delta from config
-        task_id = f"task_{token}"
-
-        # If a task with this ID already exists, remove it first
-        if scheduler.get_job(task_id):
-            scheduler.remove_job(task_id)
-            logger.info(
-                "Removing existing task before creating new one",
-                token=token,
-                task_id=task_id,
-            )
-
-        # Schedule a new task with the current time_delta
-        scheduler.add_job(
-            task_function,
-            "interval",
-            seconds=time_delta,
-            id=task_id,
-            replace_existing=True,
-        )
+        await schedule_token_task(token, time_delta)
 
         logger.info(
             "Created new scheduled task",
             token=token,
-            task_id=task_id,
             time_delta=time_delta,
         )
 
-        # Store the current time_delta and config hash with the task for later comparison
-        tasks[token].time_delta = time_delta
-        tasks[token].config_hash = config_hash
+        # Store the current time_delta and config hash for later comparison
+        tasks[token] = {"time_delta": time_delta, "config_hash": config_hash}
 
     else:
         # Check if config changed and update the scheduled task if needed
@@ -106,23 +84,19 @@ async def get_token(request: Request) -> str:
         change_reasons = []
 
         # Check if time_delta changed
-        if "configt" in config and hasattr(tasks[token], "time_delta"):
-            new_time_delta = int(config["configt"]["time_delta"])
-            if new_time_delta != tasks[token].time_delta:
-                config_changed = True
-                change_reasons.append(
-                    f"time_delta changed from {tasks[token].time_delta} to {new_time_delta}"
-                )
+        new_time_delta = int(config["configt"]["time_delta"])
+        if new_time_delta != tasks[token]["time_delta"]:
+            config_changed = True
+            change_reasons.append(
+                f"time_delta changed from {tasks[token]['time_delta']} to {new_time_delta}"
+            )
 
         # Check if overall config changed by comparing hashes
-        if (
-            hasattr(tasks[token], "config_hash")
-            and tasks[token].config_hash != config_hash
-        ):
+        if tasks[token]["config_hash"] != config_hash:
             config_changed = True
             change_reasons.append(f"configuration hash changed")
 
-        # If config changed, recreate the task
+        # If config changed, update the scheduled task
         if config_changed:
             logger.info(
                 "Configuration changed, updating task",
@@ -130,35 +104,17 @@ async def get_token(request: Request) -> str:
                 reasons=change_reasons,
             )
 
-            # Create a new task function with updated config
-            task_function = create_task_for_token(token)
-            tasks[token] = task_function
-
-            task_id = f"task_{token}"
-            time_delta = int(config["configt"]["time_delta"])
-
-            # Reschedule with new function and time_delta
-            if scheduler.get_job(task_id):
-                scheduler.remove_job(task_id)
-
-            scheduler.add_job(
-                task_function,
-                "interval",
-                seconds=time_delta,
-                id=task_id,
-                replace_existing=True,
-            )
+            # Reschedule with the new time_delta
+            await schedule_token_task(token, new_time_delta)
 
             logger.info(
                 "Task updated with new configuration",
                 token=token,
-                task_id=task_id,
-                time_delta=time_delta,
+                time_delta=new_time_delta,
             )
 
             # Update stored values
-            tasks[token].time_delta = time_delta
-            tasks[token].config_hash = config_hash
+            tasks[token] = {"time_delta": new_time_delta, "config_hash": config_hash}
         else:
             logger.debug("No configuration changes detected", token=token)
 
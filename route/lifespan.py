@@ -5,9 +5,10 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 
 from db import MongoDB
+from db.indexes import ensure_indexes
 
 from .sche import init_scheduler
-from .task import start_im_task_scheduler
+from .task import create_job_runner, start_im_task_scheduler
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -24,8 +25,8 @@ async def lifespan(app: FastAPI):
         None: 控制权交给应用程序运行
         
     Notes:
-        - 在应用程序启动时初始化MongoDB连接
-        - 启动任务调度器
+        - 在应用程序启动时初始化MongoDB连接并创建索引
+        - 启动任务调度器和爬取、合并、发布任务执行器
         - 启动IM任务调度器
         - 应用程序关闭时取消并清理IM调度器任务
     """
@@ -34,7 +35,12 @@ async def lifespan(app: FastAPI):
     assert MONGO_URI is not None and MONGO_DB is not None
 
     MongoDB(MONGO_URI, MONGO_DB)
-    init_scheduler()
+    await ensure_indexes(MongoDB.get_db())
+    scheduler = init_scheduler(MongoDB.get_db())
+
+    # Start the crawl, merge and publish job workers
+    job_runner = create_job_runner(MongoDB.get_db())
+    job_runner.start()
     
     # Start the IM task scheduler
     im_scheduler_task = asyncio.create_task(start_im_task_scheduler())
@@ -48,3 +54,6 @@ async def lifespan(app: FastAPI):
             await im_scheduler_task
         except asyncio.CancelledError:
             pass
+
+    await scheduler.stop()
+    await job_runner.stop()
@@ -0,0 +1,328 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict
+
+import structlog
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+from api.agiso import AgisoApi
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+# 每个token正在运行的发布流水线
+pipelines: Dict[str, "PublishPipeline"] = {}
+
+
+class PublishPipeline:
+    """
+    商品发布流水线
+
+    使用固定数量的工作协程并发发布商品，发布数量受item_limits限制，
+    每个商品的发布结果记录到uploads集合。新一轮任务开始时流水线会被取消，运行超过timeout后停止发布。
+    """
+
+    def __init__(
+        self,
+        token: str,
+        agiso_api: AgisoApi,
+        db: AsyncIOMotorDatabase,
+        *,
+        workers: int,
+        limit: int,
+        uploaded_count: int,
+        upload_options: Dict[str, Any],
+        timeout: float | None = None,
+    ) -> None:
+        """
+        初始化发布流水线
+
+        Args:
+            token (str): 用户认证令牌
+            agiso_api (AgisoApi): Agiso API客户端
+            db (AsyncIOMotorDatabase): 数据库连接
+            workers (int): 并发发布的工作协程数
+            limit (int): 账号商品数量上限
+            uploaded_count (int): 账号中已有的商品数量
+            upload_options (Dict[str, Any]): 传递给upload_item的参数
+            timeout (float, optional): 从流水线开始运行起的发布时长（秒），超过后停止发布
+        """
+        self._token = token
+        self._agiso_api = agiso_api
+        self._db = db
+        self._workers = max(1, workers)
+        self._limit = limit
+        self._uploaded = uploaded_count
+        self._in_flight = 0
+        self._slots = asyncio.Condition()
+        self._upload_options = upload_options
+        self._timeout = timeout
+        self._deadline: float | None = None
+        self._stopped = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        self._cycle = datetime.now()
+        self.stats = {"published": 0, "failed": 0, "skipped": 0}
+        # 从发布响应中获得的outerId到goodsId的绑定
+        self.bindings: Dict[str, str] = {}
+
+    @property
+    def uploaded_count(self) -> int:
+        """账号中当前的商品数量"""
+        return self._uploaded
+
+    @property
+    def workers(self) -> int:
+        """工作协程数"""
+        return self._workers
+
+    @property
+    def remaining(self) -> int:
+        """距离数量上限还可以发布的商品数量，正在发布的商品已预占名额"""
+        return max(0, self._limit - self._uploaded - self._in_flight)
+
+    @property
+    def stopped(self) -> bool:
+        """流水线是否已停止"""
+        return self._stopped.is_set()
+
+    async def run(self, items: AsyncIterator[dict]):
+        """
+        运行流水线，直到商品发布完毕、达到数量上限、超时或被取消
+
+        Args:
+            items (AsyncIterator[dict]): 待发布的商品
+
+        Returns:
+            dict: 各类结果的统计数量
+        """
+        if previous := pipelines.get(self._token):
+            logger.info("Cancelling previous publish pipeline", token=self._token)
+            previous.cancel()
+        pipelines[self._token] = self
+        if self._timeout is not None:
+            self._deadline = time.monotonic() + self._timeout
+
+        queue: asyncio.Queue[dict | None] = asyncio.Queue(maxsize=self._workers * 2)
+        self._tasks = [
+            asyncio.create_task(self._worker(queue)) for _ in range(self._workers)
+        ]
+        producer = asyncio.create_task(self._produce(items, queue))
+        self._tasks.append(producer)
+        watcher = (
+            asyncio.create_task(self._watch_deadline(producer))
+            if self._deadline is not None
+            else None
+        )
+
+        try:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            self.cancel()
+            if pipelines.get(self._token) is self:
+                del pipelines[self._token]
+
+        logger.info("Publish pipeline finished", token=self._token, **self.stats)
+        return self.stats
+
+    async def _produce(
+        self, items: AsyncIterator[dict], queue: "asyncio.Queue[dict | None]"
+    ):
+        """
+        将待发布商品放入队列，结束、出错或被取消后向每个工作协程发送结束信号
+
+        Args:
+            items (AsyncIterator[dict]): 待发布的商品
+            queue (asyncio.Queue): 待发布商品队列
+        """
+        try:
+            async for item in items:
+                if self._stopped.is_set() or self._expired():
+                    break
+                await queue.put(item)
+        except Exception as e:
+            logger.error("Failed to list items to publish", token=self._token, error=str(e))
+        finally:
+            for _ in range(self._workers):
+                await queue.put(None)
+
+    async def _watch_deadline(self, producer: asyncio.Task):
+        """
+        到达截止时间后停止流水线，工作协程空闲等待商品时同样生效，正在发布的商品不会被中断
+
+        Args:
+            producer (asyncio.Task): 生产者任务，到达截止时间后取消并发送结束信号
+        """
+        assert self._deadline is not None
+        await asyncio.sleep(max(0.0, self._deadline - time.monotonic()))
+        if not self._stopped.is_set():
+            logger.info("Publish deadline reached, stopping", token=self._token)
+            self._stopped.set()
+        producer.cancel()
+
+    def cancel(self):
+        """
+        取消流水线，正在发布的商品会被中断
+        """
+        self._stopped.set()
+        for task in self._tasks:
+            if not task.done():
+                task.cancel()
+
+    def _expired(self) -> bool:
+        """
+        检查是否已超过截止时间
+
+        Returns:
+            bool: 超过截止时间返回True
+        """
+        return self._deadline is not None and time.monotonic() >= self._deadline
+
+    async def _reserve(self) -> bool:
+        """
+        预占一个发布名额，名额已满时等待正在发布的商品完成
+
+        Returns:
+            bool: 预占成功返回True，达到上限返回False
+        """
+        async with self._slots:
+            while self._uploaded + self._in_flight >= self._limit:
+                if self._in_flight == 0:
+                    return False
+                await self._slots.wait()
+
+            self._in_flight += 1
+            return True
+
+    async def _release(self, published: bool):
+        """
+        释放预占的发布名额
+
+        Args:
+            published (bool): 商品是否发布成功，成功则计入已发布数量
+        """
+        async with self._slots:
+            self._in_flight -= 1
+            if published:
+                self._uploaded += 1
+            self._slots.notify_all()
+
+    async def _worker(self, queue: "asyncio.Queue[dict | None]"):
+        """
+        工作协程，从队列中取出商品并发布
+
+        Args:
+            queue (asyncio.Queue): 待发布商品队列，None为结束信号
+        """
+        while (item := await queue.get()) is not None:
+            if self._stopped.is_set():
+                continue
+
+            if self._expired():
+                logger.info("Publish deadline reached, stopping", token=self._token)
+                self._stopped.set()
+                continue
+
+            if not await self._reserve():
+                logger.info(f"Reached the limits, stopping", limits=self._limit)
+                self._stopped.set()
+                continue
+
+            published = False
+            try:
+                result = await self._agiso_api.upload_item(item, **self._upload_options)
+                published = result.published
+                if result.goods_id:
+                    self.bindings[item["productId"]] = result.goods_id
+                failed_images = [i.image for i in result.images if i.error]
+                await self._record(
+                    item,
+                    "published" if published else "skipped",
+                    failed_images=failed_images,
+                    skipped_images=[i.image for i in result.images if i.skipped],
+                )
+                if published:
+                    logger.info(
+                        f"Uploaded item",
+                        productId=item["productId"],
+                        failed_images=failed_images,
+                    )
+            except asyncio.CancelledError:
+                await self._record(item, "cancelled")
+                raise
+            except Exception as e:
+                logger.warn(
+                    f"Failed to upload production",
+                    productId=item["productId"],
+                    error=str(e),
+                )
+                await self._record(item, "failed", error=str(e))
+            finally:
+                await self._release(published)
+
+    async def _record(self, item: dict, status: str, **fields):
+        """
+        记录单个商品的发布结果
+
+        Args:
+            item (dict): 商品信息
+            status (str): 发布结果，published/skipped/failed/cancelled
+            **fields: 其它需要记录的字段
+        """
+        if status in self.stats:
+            self.stats[status] += 1
+
+        try:
+            await self._db.uploads.insert_one(
+                {
+                    "token": self._token,
+                    "cycle": self._cycle,
+                    "productId": item["productId"],
+                    "status": status,
+                    "at": datetime.now(),
+                    **fields,
+                }
+            )
+        except Exception as e:
+            logger.error("Failed to record upload result", error=str(e))
+
+
+async def bind_goods(
+    db: AsyncIOMotorDatabase, bindings: Dict[str, str], goods: list[dict]
+) -> int:
+    """
+    建立商品outerId与Agiso goodsId的绑定
+
+    以Agiso商品列表为准合并发布响应中获得的绑定，并通过一次bulk_write写入items集合。
+
+    Args:
+        db (AsyncIOMotorDatabase): 数据库连接
+        bindings (Dict[str, str]): 从发布响应中获得的outerId到goodsId的绑定
+        goods (list[dict]): Agiso商品列表
+
+    Returns:
+        int: 更新的商品数量
+    """
+    bindings = dict(bindings)
+    for good in goods:
+        if (outer_id := good.get("outerGoodsId")) and (goods_id := good.get("goodsId")):
+            bindings[outer_id] = str(goods_id)
+
+    if not bindings:
+        return 0
+
+    result = await db.items.bulk_write(
+        [
+            UpdateOne({"productId": outer_id}, {"$set": {"itemId": goods_id}})
+            for outer_id, goods_id in bindings.items()
+        ],
+        ordered=False,
+    )
+    logger.info(
+        "Bound goods to items",
+        bindings=len(bindings),
+        modified=result.modified_count,
+    )
+    return result.modified_count
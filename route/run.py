@@ -0,0 +1,41 @@
+from fastapi import APIRouter, Depends, Query
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from jobs import RunTracker
+
+from .depends import get_db, get_token
+from .types import MyResponse, Run, RunState
+
+router = APIRouter(tags=["run"])
+
+
+@router.get("/runs", response_model=MyResponse[RunState])
+async def g_runs(
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncIOMotorDatabase = Depends(get_db),
+    token: str = Depends(get_token),
+):
+    """
+    获取用户任务的运行状态和最近的运行记录
+    
+    Args:
+        limit (int): 最多返回的运行记录数，默认为20
+        db (AsyncIOMotorDatabase): 数据库连接，通过依赖注入获取
+        token (str): 用户认证token，通过依赖注入获取
+        
+    Returns:
+        MyResponse[RunState]: 包含运行状态和运行记录的响应对象
+    """
+    tracker = RunTracker(db)
+    state = await tracker.state(token) or {}
+    runs = await tracker.history(token, limit=limit)
+
+    return MyResponse(
+        data=RunState(
+            running=state.get("runId") is not None,
+            pending=state.get("pending", False),
+            leaseUntil=state.get("leaseUntil"),
+            lastFinishedAt=state.get("lastFinishedAt"),
+            runs=[Run.model_validate({**run, "id": str(run["_id"])}) for run in runs],
+        )
+    )
@@ -1,18 +1,64 @@
 import structlog
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from jobs import TokenScheduler
+
+from .task import enqueue_cycle, tasks
 
 logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
 
-scheduler = AsyncIOScheduler()
+scheduler: TokenScheduler | None = None
 
-def init_scheduler():
+def init_scheduler(db: AsyncIOMotorDatabase) -> TokenScheduler:
     """
     初始化并启动任务调度器
     
-    初始化AsyncIOScheduler实例并启动，用于管理应用中的定时任务。
+    定时任务保存在MongoDB中，所有进程共用，由取得租约的主节点负责触发，
+    触发时将用户的一轮任务加入任务队列。
     
+    Args:
+        db (AsyncIOMotorDatabase): 数据库连接
+        
     Returns:
-        None: 此函数通过副作用工作，不返回值
+        TokenScheduler: 已启动的调度器
     """
+    global scheduler
+
+    async def on_due(token: str):
+        # 用户已删除或登录失效时不再触发，重新登录后由get_token重新调度
+        user = await db.users.find_one({"token": token}, {"expired": 1})
+        if not user or user.get("expired", False):
+            logger.info("User gone or expired, schedule dropped", token=token)
+            await scheduler.remove(token)
+            return
+
+        await enqueue_cycle(token, db)
+
+    scheduler = TokenScheduler(db, on_due)
     scheduler.start()
     logger.info("Scheduler started.")
+    return scheduler
+
+
+async def schedule_token_task(token: str, time_delta: int):
+    """
+    按固定间隔调度用户任务
+    
+    Args:
+        token (str): 用户认证令牌
+        time_delta (int): 触发间隔（秒）
+    """
+    assert scheduler is not None, "Scheduler not initialized"
+    await scheduler.put(token, time_delta)
+
+
+async def unschedule_token_task(token: str):
+    """
+    删除用户的定时任务，用户删除或登录失效时调用
+
+    Args:
+        token (str): 用户认证令牌
+    """
+    tasks.pop(token, None)
+    if scheduler is not None:
+        await scheduler.remove(token)
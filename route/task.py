@@ -1,4 +1,5 @@
-import asyncio
+import os
+from datetime import timedelta
 from typing import Any, Dict
 
 import structlog
@@ -8,80 +9,115 @@ from playwright.async_api import async_playwright
 
 from ai import GoodsManager
 from api.agiso import AgisoApi
+from api.crawl import CrawlCoordinator
 from api.ctrip import CtripApi
+from api.media import AgisoMediaCache
+from api.mirror import AgisoGoodsMirror
+from api.short_urls import ShortUrlStore
 from db import MongoDB
+from filters import compile_filter
 from helpers.agiso import AgisoLoginHelper
 from helpers.base import LoginState
 from helpers.ctrip import CtripLoginHelper
-from im import GoofishIM
+from im.supervisor import ImSupervisor
+from jobs import JobAbort, JobQueue, JobRunner, RunTracker
+from templates import DEFAULT_PROMPT, Template
+from throttle import get_bucket
 
+from .publish import PublishPipeline, bind_goods
 from .utils import build_config, check_login
 
 logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
 
-# Dictionary to store token-specific task functions
-tasks = {}
+# Scheduled interval and config hash of each token, used to detect config changes
+tasks: Dict[str, Dict[str, Any]] = {}
 
-# Dictionary to store im_tasks
-im_tasks: Dict[str, Dict[str, Any]] = {}
 
+class UserAuthError(ValueError):
+    """用户不存在或平台登录失效，重试无法恢复"""
 
-# Function to create a task for a specific token
-def create_task_for_token(token: str):
+
+async def enqueue_cycle(token: str, db: AsyncIOMotorDatabase):
     """
-    为特定token创建任务函数
-    
-    根据给定的token创建一个封装了任务逻辑的异步函数，该函数负责执行与token关联的全部操作。
-    
+    将用户的一轮任务加入任务队列
+
+    爬取为所有用户共享，排队中的爬取任务只保留一个，执行时选择一个登录有效的携程账号；
+    发布任务不等待爬取，直接发布已合并的商品，爬取完成后合并，合并完成后再次触发所有用户的发布。
+
     Args:
         token (str): 用户认证令牌
-        
-    Returns:
-        callable: 返回一个异步函数，该函数执行与token关联的任务
+        db (AsyncIOMotorDatabase): 数据库连接
     """
-    async def task_function():
-        # Get database and minio client
-        db = MongoDB.get_db()
+    queue = JobQueue(db)
+    await queue.enqueue("crawl", key="crawl")
+    await queue.enqueue(
+        "publish", token=token, key=f"publish:{token}", payload={"trigger": "schedule"}
+    )
 
-        from .depends import get_minio
 
-        minio = await get_minio()
+def create_job_runner(db: AsyncIOMotorDatabase) -> JobRunner:
+    """
+    创建任务执行器，注册爬取、合并和发布三个阶段
 
-        # Build config for the token
-        config = await build_config(token, db)
+    各阶段的并发数由JOB_CRAWL_WORKERS、JOB_MERGE_WORKERS和JOB_PUBLISH_WORKERS配置。
 
-        # Run the main function with the token, config, database and minio
-        await run(token, config, db, minio)
+    Args:
+        db (AsyncIOMotorDatabase): 数据库连接
 
-    # Return the task function
-    return task_function
+    Returns:
+        JobRunner: 任务执行器
+    """
+    runner = JobRunner(db)
+    runner.register(
+        "crawl", crawl_job, concurrency=int(os.getenv("JOB_CRAWL_WORKERS", 1))
+    )
+    runner.register(
+        "merge", merge_job, concurrency=int(os.getenv("JOB_MERGE_WORKERS", 1))
+    )
+    runner.register(
+        "publish", publish_job, concurrency=int(os.getenv("JOB_PUBLISH_WORKERS", 4))
+    )
+    return runner
 
 
-async def run(token: str, config, db: AsyncIOMotorDatabase, minio: Minio):
+async def expire_user(token: str, db: AsyncIOMotorDatabase):
     """
-    执行用户关联的主要任务
-    
-    根据用户配置，执行数据抓取、商品合并及上传操作的完整流程。
-    
+    标记用户登录失效并删除其定时任务
+
+    Args:
+        token (str): 用户认证令牌
+        db (AsyncIOMotorDatabase): 数据库连接
+    """
+    from .sche import unschedule_token_task
+
+    await db.users.update_one({"token": token}, {"$set": {"expired": True}})
+    await unschedule_token_task(token)
+
+
+async def login_ctrip(token: str, db: AsyncIOMotorDatabase, minio: Minio) -> CtripApi:
+    """
+    检查用户的携程登录状态并创建携程API客户端
+
     Args:
         token (str): 用户认证令牌
-        config (dict): 用户配置信息
         db (AsyncIOMotorDatabase): 数据库连接
         minio (Minio): MinIO客户端连接
-        
+
+    Returns:
+        CtripApi: 带有该用户推广参数的携程API客户端
+
     Raises:
-        ValueError: 当用户不存在或登录失效时抛出
+        UserAuthError: 当用户不存在或登录失效时抛出
     """
     user = await db.users.find_one({"token": token})
 
     if not user:
-        raise ValueError("User not found")
+        raise UserAuthError("User not found")
 
     ctrip_cookies = user["ctrip"]["cookies"]
-    agiso_cookies = user["goofish"]["cookies"]
 
     if not await check_login(platform="ctrip", cookies=ctrip_cookies):
-        raise ValueError("User not logged in")
+        raise UserAuthError("User not logged in")
     async with async_playwright() as p:
         ctrip_login_helper = CtripLoginHelper(
             playwright=p,
@@ -91,12 +127,9 @@ async def run(token: str, config, db: AsyncIOMotorDatabase, minio: Minio):
         await ctrip_login_helper.init(cookies=ctrip_cookies)
 
         if await ctrip_login_helper.check_login_state() != LoginState.LOGINED:
-            await db.users.update_one(
-                {"token": token},
-                {"$set": {"expired": True}},
-            )
+            await expire_user(token, db)
 
-            raise ValueError("Ctrip login failed")
+            raise UserAuthError("Ctrip login failed")
         alliance_id = ctrip_login_helper.alliance_id()
         sid = ctrip_login_helper.sid()
 
@@ -104,7 +137,7 @@ async def run(token: str, config, db: AsyncIOMotorDatabase, minio: Minio):
         {"name": cookie.get("name"), "value": cookie["value"]}
         for cookie in ctrip_cookies
     ]
-    ctrip_api = CtripApi(
+    return CtripApi(
         cookies=ctrip_cookies,
         db=db,
         minio=minio,
@@ -112,193 +145,286 @@ async def run(token: str, config, db: AsyncIOMotorDatabase, minio: Minio):
         sid=sid,
     )
 
-    # 爬虫
-    await ctrip_api.run("上海")
 
-    # 合并商品
-    template = config["template"]["template"]
-    await GoodsManager(db).merge_all(template=template)
+async def ctrip_account(db: AsyncIOMotorDatabase, minio: Minio) -> CtripApi:
+    """
+    选择一个登录有效的携程账号并创建携程API客户端
 
-    # 上传商品
-    async with async_playwright() as p:
-        agiso_login_helper = AgisoLoginHelper(playwright=p)
-        await agiso_login_helper.init(cookies=agiso_cookies)
+    爬取结果为所有用户共享，任一用户的携程登录信息均可用于爬取。
 
-        if await agiso_login_helper.check_login_state() != LoginState.LOGINED:
-            await db.users.update_one(
-                {"token": token},
-                {"$set": {"expired": True}},
-            )
-        token = await agiso_login_helper.get_token()
+    Args:
+        db (AsyncIOMotorDatabase): 数据库连接
+        minio (Minio): MinIO客户端连接
 
-    agiso_cookies = [
-        {"name": cookie.get("name"), "value": cookie["value"]}
-        for cookie in agiso_cookies
-    ]
-    agiso_api = AgisoApi(cookies=agiso_cookies, minio=minio, token=token)
-
-    # 已经上传的不要上传
-    uploaded_goods = await agiso_api.search_good_list()
-    uploaded_set = set()
-    for uploaded in uploaded_goods:
-        if id := uploaded.get("outerGoodsId"):
-            uploaded_set.add(id)
-
-    uploaded_count = len(uploaded_goods)
-    items = db.items.find()
-
-    async for item in items:
-        # 检查商品是否已经上传
-        if item["productId"] in uploaded_set:
-            logger.info(f"Already uploaded, skip", productId=item["productId"])
+    Returns:
+        CtripApi: 携程API客户端
+
+    Raises:
+        JobAbort: 没有登录有效的携程账号时抛出
+    """
+    async for user in db.users.find(
+        {"expired": {"$ne": True}, "ctrip.cookies": {"$exists": True}}, {"token": 1}
+    ):
+        try:
+            ctrip_api = await login_ctrip(user["token"], db, minio)
+        except UserAuthError as e:
+            logger.info("Ctrip account unavailable", token=user["token"], error=str(e))
             continue
 
-        # 应用过滤器
-        if config["filter"]["keywords_filter_enabled"]:
-            if filters := config["filter"]["keywords_filter"]:
-                for keyword in filters:
-                    if (
-                        keyword
-                        in item["subName"] + item["copywriterInfo"] + item["title"]
-                    ):
-                        logger.info(
-                            f"Product name match filter, skip",
-                            productId=item["productId"],
-                        )
-                        break
-
-        # 应用价格过滤器
-        limits = int(config["configt"]["item_limits"])
-        if uploaded_count >= limits:
-            logger.info(f"Reached the limits, stopping", limits=limits)
-            break
+        logger.info("Crawling with Ctrip account", token=user["token"])
+        return ctrip_api
+
+    raise JobAbort("No logged-in Ctrip account")
 
+
+async def crawl_job(job: dict):
+    """
+    爬取任务：按城市和标签组合并行爬取，每个分片完成后触发合并
+
+    Args:
+        job (dict): 任务文档
+    """
+    from .depends import get_minio
+
+    db = MongoDB.get_db()
+    coordinator = CrawlCoordinator(db)
+    cities = _env_list("CTRIP_CITIES", os.getenv("CTRIP_CITYNAME", "上海"))
+    tabs = _env_list("CTRIP_TABS", "hotPush")
+    max_age = timedelta(seconds=int(os.getenv("CRAWL_MAX_AGE", 3000)))
+
+    # 所有分片都在新鲜期内时不需要登录携程
+    if not await coordinator.stale(cities, tabs, max_age=max_age):
+        logger.info("All shards are fresh, skip crawl")
+        return {
+            coordinator.shard(city_name, tab_value): False
+            for city_name in cities
+            for tab_value in tabs
+        }
+
+    ctrip_api = await ctrip_account(db, await get_minio())
+    queue = JobQueue(db)
+
+    async def on_shard(shard: str, result):
+        # 分片使用已有结果时不需要合并，爬取失败的分片可能已保存了部分商品
+        if result is not False:
+            await queue.enqueue("merge", key="merge", payload={"shard": shard})
+
+    # 同一分片在新鲜期内只爬取一次，所有用户共用爬取结果
+    results = await coordinator.ensure_matrix(
+        ctrip_api,
+        cities=cities,
+        tabs=tabs,
+        max_age=max_age,
+        checkpoint_age=timedelta(
+            seconds=int(os.getenv("CRAWL_CHECKPOINT_MAX_AGE", 6 * 3600))
+        ),
+        concurrency=int(os.getenv("CRAWL_CONCURRENCY", 10)),
+        page_size=int(os.getenv("CTRIP_PAGE_SIZE", 10)),
+        on_shard=on_shard,
+    )
+    return {
+        shard: result if isinstance(result, bool) else str(result)
+        for shard, result in results.items()
+    }
+
+
+async def merge_job(job: dict):
+    """
+    合并任务：合并爬取后发生变化的商品分组并生成标题，完成后触发所有已调度用户的发布
+
+    合并结果为所有用户共享，提示词使用templates集合中的prompt模板，并发数和限流由
+    MERGE_AI_CONCURRENCY、MERGE_AI_QPS和MERGE_AI_BATCH_SIZE配置。
+
+    Args:
+        job (dict): 任务文档
+    """
+    db = MongoDB.get_db()
+    goods_manager = GoodsManager(db, batch_size=int(os.getenv("MERGE_BATCH_SIZE", 100)))
+    await goods_manager.merge_all(
+        template=await Template(db).get("prompt", DEFAULT_PROMPT),
+        concurrency=int(os.getenv("MERGE_AI_CONCURRENCY", 4)),
+        limiter=get_bucket("ai", float(os.getenv("MERGE_AI_QPS", 2))),
+        title_batch_size=int(os.getenv("MERGE_AI_BATCH_SIZE", 10)),
+    )
+
+    queue = JobQueue(db)
+    for token in await db.schedules.distinct("_id"):
+        await queue.enqueue(
+            "publish", token=token, key=f"publish:{token}", payload={"trigger": "merge"}
+        )
+
+
+async def publish_job(job: dict):
+    """
+    发布任务：生成用户的推广短链接，并将未上传的商品发布到Agiso
+
+    同一用户同一时间只执行一轮发布，上一轮仍在执行时按RUN_OVERLAP跳过或在结束后补跑一轮。
+
+    Args:
+        job (dict): 任务文档
+    """
+    from .depends import get_minio
+
+    token = job["token"]
+    db = MongoDB.get_db()
+    trigger = job["payload"].get("trigger", "schedule")
+
+    async with RunTracker(db).hold(token, trigger=trigger) as current:
+        if current is None:
+            return {"deferred": True}
+
+        minio = await get_minio()
+        config = await build_config(token, db)
         try:
-            await agiso_api.upload_item(
-                item,
-                draft=False,
-                price_mode=config["configt"]["price"]["mode"],
-                price=config["configt"]["price"]["value"],
-                template=config["description"]["template"],
-            )
-            uploaded_count += 1
-            logger.info(f"Uploaded item", productId=item["productId"])
-        except Exception as e:
-            logger.warn(
-                f"Failed to upload production",
-                productId=item["productId"],
-                error=str(e),
-            )
-
-        # 建立itemId和outerId的绑定
-        items = await agiso_api.search_good_list()
-        for item in items:
-            db_item = await db.items.find_one({"productId": item["outerGoodsId"]})
-            if db_item:
-                await db.items.update_one(
-                    {"productId": item["outerGoodsId"]},
-                    {"$set": {"itemId": item["goodsId"]}},
-                )
-
-
-async def create_im_task(token: str, user: Dict[str, Any], db: AsyncIOMotorDatabase):
+            await run(token, config, db, minio)
+        except UserAuthError as e:
+            # 用户已删除或登录失效，重试无法恢复
+            raise JobAbort(str(e)) from e
+
+    if current["rerun"]:
+        await JobQueue(db).enqueue(
+            "publish", token=token, key=f"publish:{token}", payload={"trigger": "rerun"}
+        )
+    return {"runId": str(current["_id"])}
+
+
+async def run(token: str, config, db: AsyncIOMotorDatabase, minio: Minio):
     """
-    为用户创建即时通讯任务
+    执行用户的发布流程
     
-    如果用户尚未创建即时通讯任务，则创建新任务以处理消息通知。
+    为共享的商品生成该用户的推广短链接，并将未上传的商品发布到Agiso。
+    爬取和合并由独立的任务完成，见crawl_job和merge_job。
     
     Args:
         token (str): 用户认证令牌
-        user (Dict[str, Any]): 用户信息字典
+        config (dict): 用户配置信息
         db (AsyncIOMotorDatabase): 数据库连接
+        minio (Minio): MinIO客户端连接
         
-    Returns:
-        Task: 如果创建了新任务则返回该任务对象，否则返回None
+    Raises:
+        UserAuthError: 当用户不存在或登录失效时抛出
     """
-    if token in im_tasks and im_tasks[token].get("running"):
-        logger.debug(f"IM task already exists for token", token=token)
-        return
-
-    logger.info(f"Creating new IM task for user", token=token)
+    # 为共享的商品生成带有该用户推广参数的短链接
+    ctrip_api = await login_ctrip(token, db, minio)
+    await ctrip_api.bind_short_urls(ShortUrlStore(db, token))
 
-    im_tasks[token] = {"task": None, "running": False, "last_check": None}
-
-    async def im_task_runner():
-        logger.info(f"Starting IM task for user", token=token)
-        im_tasks[token]["running"] = True
+    user = await db.users.find_one({"token": token})
+    agiso_cookies = user["goofish"]["cookies"]
 
-        try:
-            cookies = user["goofish"]["cookies"]
+    # 上传商品
+    async with async_playwright() as p:
+        agiso_login_helper = AgisoLoginHelper(playwright=p)
+        await agiso_login_helper.init(cookies=agiso_cookies)
 
-            async with async_playwright() as p:
-                im_client = GoofishIM(db=db, playwright=p, cookies=cookies, token=token)
-                await im_client.init(cookies=cookies)
-                await asyncio.sleep(5)
-                await im_client.start()
+        if await agiso_login_helper.check_login_state() != LoginState.LOGINED:
+            await expire_user(token, db)
+        agiso_token = await agiso_login_helper.get_token()
 
-                # Keep the task running indefinitely
-                while True:
-                    await asyncio.sleep(60)  # Sleep for 1 minute
+    agiso_cookies = [
+        {"name": cookie.get("name"), "value": cookie["value"]}
+        for cookie in agiso_cookies
+    ]
+    configt = config["configt"]
+    mirror = AgisoGoodsMirror(db, account=token)
+    agiso_api = AgisoApi(
+        cookies=agiso_cookies,
+        minio=minio,
+        token=agiso_token,
+        media_cache=AgisoMediaCache(db, account=token),
+        limiter=get_bucket(f"agiso:{token}", float(configt.get("upload_qps", 2))),
+        mirror=mirror,
+    )
 
-                    # Check if user is still valid
-                    current_user = await db.users.find_one({"token": token})
-                    if not current_user or current_user.get("expired", False):
-                        logger.info(
-                            f"User expired or not found, stopping IM task", token=token
-                        )
-                        break
+    # 本地商品镜像过期时与Agiso商品列表对账
+    await sync_mirror(agiso_api, mirror)
+
+    item_filter = compile_filter(config.get("filter"))
+
+    async def candidates():
+        # 在数据库中筛选未上传的商品，只取剩余名额数量；发布失败释放名额后再补取
+        attempted: list[str] = []
+        while not pipeline.stopped and (remaining := pipeline.remaining) > 0:
+            fetched = 0
+            async for item in mirror.pending_items(
+                remaining, exclude=attempted, batch_size=pipeline.workers * 2
+            ):
+                fetched += 1
+                attempted.append(item["productId"])
+
+                # 应用过滤器
+                if item_filter and (reason := item_filter.reject_reason(item)):
+                    logger.info(
+                        f"Product name match filter, skip",
+                        productId=item["productId"],
+                        reason=reason,
+                    )
+                    continue
+
+                yield item
+
+            if fetched == 0:
+                break
+
+    # 并发发布商品，从流水线开始运行起超过一个触发间隔后停止
+    pipeline = PublishPipeline(
+        token,
+        agiso_api,
+        db,
+        workers=int(configt.get("upload_workers", 4)),
+        limit=int(configt["item_limits"]),
+        uploaded_count=await mirror.count(),
+        upload_options={
+            "draft": False,
+            "price_mode": configt["price"]["mode"],
+            "price": configt["price"]["value"],
+            "template": config["description"]["template"],
+        },
+        timeout=int(configt["time_delta"]),
+    )
+    await pipeline.run(candidates())
 
-                await im_client.stop()
+    # 建立itemId和outerId的绑定：合并发布响应中的goodsId与本地镜像中对账得到的goodsId
+    await sync_mirror(agiso_api, mirror)
+    await bind_goods(db, pipeline.bindings, await mirror.goods())
 
-        except Exception as e:
-            logger.exception(f"Error in IM task", token=token, error=str(e))
-        finally:
-            im_tasks[token]["running"] = False
 
-    # Create the task but don't await it
-    im_tasks[token]["task"] = asyncio.create_task(im_task_runner())
-    return im_tasks[token]["task"]
+def _env_list(name: str, default: str) -> list[str]:
+    """
+    读取以逗号分隔的环境变量
 
+    Args:
+        name (str): 环境变量名称
+        default (str): 未设置时的默认值
 
-async def check_and_create_im_tasks():
-    """
-    检查并创建即时通讯任务
-    
-    检查所有未过期用户并为其创建即时通讯任务，如果任务尚未创建。
-    
     Returns:
-        None: 此函数通过副作用工作，不返回值
+        list[str]: 去除空白后的非空值列表
     """
-    # logger.info("Checking for non-expired users to create IM tasks")
+    return [value.strip() for value in os.getenv(name, default).split(",") if value.strip()]
 
-    db = MongoDB.get_db()
-    users = await db.users.find({"expired": False}).to_list()
 
-    for user in users:
-        token = user.get("token")
-        if not token:
-            continue
+async def sync_mirror(agiso_api: AgisoApi, mirror: AgisoGoodsMirror):
+    """
+    本地商品镜像超过对账间隔时，并发拉取Agiso商品列表进行对账
 
-        await create_im_task(token, user, db)
+    Args:
+        agiso_api (AgisoApi): Agiso API客户端
+        mirror (AgisoGoodsMirror): 本地商品镜像
+    """
+    interval = timedelta(seconds=int(os.getenv("AGISO_MIRROR_SYNC_INTERVAL", 3600)))
+    if not await mirror.stale(interval):
+        return
 
-    # logger.info(f"IM task check completed, active tasks: {sum(1 for t in im_tasks.values() if t.get('running'))}")
+    concurrency = int(os.getenv("AGISO_SEARCH_CONCURRENCY", 4))
+    await mirror.reconcile(await agiso_api.search_good_list(concurrency=concurrency))
 
 
 async def start_im_task_scheduler():
     """
     启动即时通讯任务调度器
     
-    启动一个后台任务，定期检查并创建用户的即时通讯任务。
+    运行IM会话监督器，根据用户的登录和过期事件启动或停止即时通讯任务。
     
     Returns:
         None: 此函数会持续运行，直到被取消
     """
-    logger.info("Starting IM task scheduler")
-
-    while True:
-        try:
-            await check_and_create_im_tasks()
-        except Exception as e:
-            logger.exception("Error checking IM tasks", error=str(e))
-
-        await asyncio.sleep(5)  # Run every minute
+    await ImSupervisor(MongoDB.get_db()).run()
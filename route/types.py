@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import Any, Generic, Optional, TypeVar
 
 from pydantic import BaseModel
@@ -73,11 +74,15 @@ class ConfigT(BaseModel):
         item_limits (str): 商品数量限制，默认为"3000"
         price (Price): 价格配置对象，默认使用Price默认值
         item_type (str): 商品类型，默认为"家居/服务/跑腿代办/酒店代订"
+        upload_workers (str): 并发发布商品的工作协程数，默认为"4"
+        upload_qps (str): 每秒请求Agiso的次数上限，默认为"2"
     """
     time_delta: str = "60"
     item_limits: str = "3000"
     price: Price = Price()
     item_type: str = "家居/服务/跑腿代办/酒店代订"
+    upload_workers: str = "4"
+    upload_qps: str = "2"
 
 class Upload(BaseModel):
     """
@@ -99,10 +104,12 @@ class ShortUrl(BaseModel):
     存储商品相关的短链接信息。
     
     Attributes:
-        shortUrl (str): 短链接URL
+        productId (str | None): 原始商品ID，用于获取用户的短链接
+        shortUrl (str | None): 短链接URL，仅旧数据包含
         description (str): 短链接描述
     """
-    shortUrl: str
+    productId: str | None = None
+    shortUrl: str | None = None
     description: str
 
 
@@ -131,4 +138,48 @@ class Item(BaseModel):
     price: int
     shortUrls: list[ShortUrl]
     subName: str
-    title: str
\ No newline at end of file
+    title: str
+
+
+class Run(BaseModel):
+    """
+    运行记录模型
+    
+    记录用户的一轮发布任务。
+    
+    Attributes:
+        id (str): 运行记录ID
+        trigger (str): 触发来源，schedule、merge或rerun
+        status (str): 运行状态，running、done、failed或abandoned
+        startedAt (datetime): 开始时间
+        finishedAt (datetime | None): 结束时间
+        elapsed (float | None): 耗时（秒）
+        coalesced (int): 执行期间被跳过或合并的触发次数
+        error (str | None): 失败原因
+    """
+    id: str
+    trigger: str
+    status: str
+    startedAt: datetime
+    finishedAt: datetime | None = None
+    elapsed: float | None = None
+    coalesced: int = 0
+    error: str | None = None
+
+
+class RunState(BaseModel):
+    """
+    运行状态模型
+    
+    Attributes:
+        running (bool): 是否有一轮任务正在执行
+        pending (bool): 当前轮结束后是否补跑一轮
+        leaseUntil (datetime | None): 当前轮的租约到期时间
+        lastFinishedAt (datetime | None): 上一轮的结束时间
+        runs (list[Run]): 最近的运行记录
+    """
+    running: bool = False
+    pending: bool = False
+    leaseUntil: datetime | None = None
+    lastFinishedAt: datetime | None = None
+    runs: list[Run] = []
@@ -3,6 +3,7 @@ from typing import Literal
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from playwright.async_api import async_playwright
 
+from db.configs import ConfigCache
 from helpers.agiso import AgisoLoginHelper
 from helpers.base import LoginState
 from helpers.ctrip import CtripLoginHelper
@@ -13,7 +14,7 @@ async def build_config(token: str, db: AsyncIOMotorDatabase):
     """
     构建用户配置
     
-    根据用户token从数据库中获取并组装用户的所有配置项。
+    根据用户token从数据库中获取并组装用户的所有配置项，配置缓存在进程内，修改配置时清除。
     
     Args:
         token (str): 用户认证令牌
@@ -22,13 +23,7 @@ async def build_config(token: str, db: AsyncIOMotorDatabase):
     Returns:
         dict: 包含所有用户配置的字典，键为配置名称，值为配置内容
     """
-    config = db.configs.find({"token": token})
-    built_config = {}
-
-    async for item in config:
-        built_config[item["name"]] = item["value"]
-
-    return built_config
+    return await ConfigCache.get(db, token)
 
 
 async def check_login(
@@ -16,7 +16,7 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 # 导入路由和中间件组件
-from route import AuthRouter, ConfigRouter, ItemRouter, LogRouter, UploadRouter
+from route import AuthRouter, ConfigRouter, ItemRouter, LogRouter, RunRouter, UploadRouter
 from route.filter import global_exception_handler
 from route.lifespan import lifespan
 from route.log import sse_processor
@@ -75,3 +75,4 @@ app.include_router(ConfigRouter)  # 配置相关路由
 app.include_router(AuthRouter)    # 认证相关路由
 app.include_router(ItemRouter)    # 项目相关路由
 app.include_router(UploadRouter)  # 上传相关路由
+app.include_router(RunRouter)     # 运行记录相关路由
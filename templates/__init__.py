@@ -1,20 +1,143 @@
+import os
+import time
+from string import Formatter
 from typing import Any
+
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+
+# 各模板允许使用的格式化字段，未列出的模板不限制字段
+FIELDS: dict[str, set[str]] = {
+    "prompt": {"title", "description", "price"},
+}
+
+# 默认的商品标题提示词
+DEFAULT_PROMPT = "根据要求和信息，写一句话。\n# 使用短句。\n# 直接回答，不要出现其他话。\n# 先突出价格，向下取整。有多天的价格就把价格算成一天的。\n# 再突出地点。\n# 然后有品牌突出品牌。\n少于20个字\n####信息####\n{title}\n{description}\n{price}元\n##例子##\n600悦榕庄！九寨沟悦榕庄！送餐饮!行政酒廊！\n400五星级套房！成都上层名人酒店!"
+
+
+def parse_fields(value: str) -> set[str]:
+    """
+    解析模板中的str.format字段
+
+    参数:
+        value: 模板字符串
+
+    返回:
+        set[str]: 字段名集合
+
+    异常:
+        ValueError: 模板格式错误，如括号不匹配或使用了位置参数
+    """
+    fields = set()
+    for _, field, _, _ in Formatter().parse(value):
+        if field is None:
+            continue
+        name = field.split(".", 1)[0].split("[", 1)[0]
+        if not name or name.isdigit():
+            raise ValueError(f"Template uses positional field: {{{field}}}")
+        fields.add(name)
+    return fields
+
+
+def validate(name: str, value: str) -> set[str]:
+    """
+    校验模板的格式化字段
+
+    参数:
+        name: 模板名称
+        value: 模板字符串
+
+    返回:
+        set[str]: 字段名集合
+
+    异常:
+        ValueError: 模板格式错误或使用了不允许的字段
+    """
+    fields = parse_fields(value)
+    if name in FIELDS and (unknown := fields - FIELDS[name]):
+        raise ValueError(
+            f"Template {name} uses unknown fields: {', '.join(sorted(unknown))}"
+        )
+    return fields
 
 
 class Template:
+    """
+    模板仓库。
+
+    模板读取后缓存在进程内，缓存为所有实例共用，热路径上读取模板不产生数据库查询；
+    Template.set写入时校验格式化字段、递增版本号并更新缓存。其它进程写入的模板在缓存
+    超过TEMPLATE_CACHE_TTL（秒）后重新读取；直接写入数据库的模板在读取时同样校验，
+    校验失败时抛出ValueError且不缓存。
+    """
+
+    # 模板名称到（版本号，模板内容，读取时间）的缓存
+    _cache: dict[str, tuple[int, Any, float]] = {}
+    _max_age = float(os.getenv("TEMPLATE_CACHE_TTL", 300))
+
     def __init__(self, db: AsyncIOMotorDatabase) -> None:
         self._db = db
 
-    async def get(self, name: str, default: Any = None) -> str | Any:
+    async def _load(self, name: str) -> tuple[int, Any, float]:
+        cached = self._cache.get(name)
+        if cached is not None and time.monotonic() - cached[2] < self._max_age:
+            return cached
+
         result = await self._db.templates.find_one({"name": name})
+        cached = (
+            (result.get("version", 0), result.get("value"), time.monotonic())
+            if result
+            else (0, None, time.monotonic())
+        )
+        # 未经Template.set写入的模板在读取时校验
+        if isinstance(cached[1], str):
+            validate(name, cached[1])
+        self._cache[name] = cached
+        return cached
+
+    async def get(self, name: str, default: Any = None) -> str | Any:
+        """
+        获取模板内容，模板不存在时返回default
 
-        if not result:
-            return default
+        异常:
+            ValueError: 模板格式错误或使用了不允许的字段
+        """
+        _, value, _ = await self._load(name)
+        return default if value is None else value
 
-        return result.get("value")
+    async def version(self, name: str) -> int:
+        """
+        获取模板的版本号，每次写入递增，模板不存在时为0
+        """
+        version, _, _ = await self._load(name)
+        return version
 
     async def set(self, name: str, value: str, *, upsert: bool = False):
-        await self._db.templates.update_one(
-            {"name": name}, {"$set": {"value": value}}, upsert=upsert
+        """
+        写入模板
+
+        异常:
+            ValueError: 模板格式错误或使用了不允许的字段
+        """
+        fields = validate(name, value)
+
+        result = await self._db.templates.find_one_and_update(
+            {"name": name},
+            {"$set": {"value": value, "fields": sorted(fields)}, "$inc": {"version": 1}},
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER,
         )
+        if result is None:
+            self.invalidate(name)
+        else:
+            self._cache[name] = (result["version"], value, time.monotonic())
+
+    @classmethod
+    def invalidate(cls, name: str | None = None):
+        """
+        清除模板缓存，name为None时清除全部
+        """
+        if name is None:
+            cls._cache.clear()
+        else:
+            cls._cache.pop(name, None)
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+import structlog
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class TokenBucket:
+    """
+    令牌桶限流器。
+
+    以固定速率生成令牌，调用方每次请求前获取令牌，令牌不足时等待，
+    用于将对外部接口的调用速率限制在配额以内。
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        """
+        初始化令牌桶
+
+        参数:
+            rate: 每秒生成的令牌数
+            capacity: 桶容量，即允许的最大突发量，默认等于rate（至少为1）
+        """
+        self._lock = asyncio.Lock()
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self.configure(rate, capacity)
+        self._tokens = self._capacity
+
+    def configure(self, rate: float, capacity: float | None = None):
+        """
+        更新令牌生成速率和桶容量
+
+        参数:
+            rate: 每秒生成的令牌数
+            capacity: 桶容量，默认等于rate（至少为1）
+        """
+        assert rate > 0, "rate must be positive"
+        self._rate = rate
+        self._capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = min(self._tokens, self._capacity)
+
+    async def acquire(self, tokens: float = 1.0):
+        """
+        获取令牌，令牌不足时等待
+
+        参数:
+            tokens: 需要的令牌数
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._capacity, self._tokens + (now - self._updated) * self._rate
+                )
+                self._updated = now
+
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+
+                await asyncio.sleep((tokens - self._tokens) / self._rate)
+
+
+# 按名称共享的令牌桶，同一账号的所有调用方共用一个配额
+_buckets: dict[str, TokenBucket] = {}
+
+
+def get_bucket(name: str, rate: float, capacity: float | None = None) -> TokenBucket:
+    """
+    获取指定名称的共享令牌桶，不存在时创建，速率变化时更新
+
+    参数:
+        name: 令牌桶名称，例如账号标识
+        rate: 每秒生成的令牌数
+        capacity: 桶容量
+
+    返回:
+        TokenBucket: 共享的令牌桶
+    """
+    bucket = _buckets.get(name)
+    if bucket is None:
+        bucket = _buckets[name] = TokenBucket(rate, capacity)
+        logger.debug("Token bucket created", name=name, rate=rate)
+    elif bucket._rate != rate:
+        bucket.configure(rate, capacity)
+        logger.debug("Token bucket reconfigured", name=name, rate=rate)
+
+    return bucket